@@ -0,0 +1,88 @@
+# coding: utf-8
+
+import json
+import logging
+import sqlite3
+import time
+
+log = logging.getLogger(__name__)
+
+
+class MetadataCache(object):
+    """
+    Persistent cache for the metadata parsed from meta.xml files.
+
+    The entries are stored in a local SQLite database, the number of entries
+    is bounded by `max_size`, the least recently used entries are evicted
+    first. Errors of the underlying database are logged and treated like a
+    cache miss, so a broken cache never breaks a harvest job.
+    """
+
+    def __init__(self, path, max_size=10000):
+        self.path = path
+        self.max_size = max_size
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS metadata_cache ("
+                "key TEXT PRIMARY KEY, metadata TEXT NOT NULL, last_used REAL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS metadata_cache_last_used "
+                "ON metadata_cache (last_used)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key):
+        """
+        Return the cached metadata dict for `key` or None
+        """
+        try:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT metadata FROM metadata_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE metadata_cache SET last_used = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            conn.commit()
+            return json.loads(row[0])
+        except sqlite3.Error as e:
+            log.warning("Could not read from metadata cache %s: %r" % (self.path, e))
+            return None
+
+    def set(self, key, metadata):
+        """
+        Store the metadata dict for `key` and evict the least recently
+        used entries if the cache is full
+        """
+        try:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO metadata_cache (key, metadata, last_used) "
+                "VALUES (?, ?, ?)",
+                (key, json.dumps(metadata), time.time()),
+            )
+            conn.execute(
+                "DELETE FROM metadata_cache WHERE key IN ("
+                "SELECT key FROM metadata_cache ORDER BY last_used DESC "
+                "LIMIT -1 OFFSET ?)",
+                (self.max_size,),
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            log.warning("Could not write to metadata cache %s: %r" % (self.path, e))
+
+    def __len__(self):
+        return (
+            self._connection()
+            .execute("SELECT COUNT(*) FROM metadata_cache")
+            .fetchone()[0]
+        )
@@ -0,0 +1,134 @@
+# coding: utf-8
+
+import logging
+import sqlite3
+import time
+
+log = logging.getLogger(__name__)
+
+GATHERED = "gathered"
+IMPORTED = "imported"
+FAILED = "failed"
+
+
+class CheckpointStore(object):
+    """
+    Stores the progress of harvest runs per dataset folder in a local
+    SQLite database.
+
+    A run starts with a harvest job and is completed once all gathered
+    datasets have been imported (or failed). If a job dies before that
+    (e.g. mount outage, worker restart), the next job of the source resumes
+    the run: datasets that were already imported with the same fingerprint
+    are skipped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS runs ("
+                "source_id TEXT PRIMARY KEY, run_id TEXT NOT NULL, "
+                "job_id TEXT, completed INTEGER NOT NULL DEFAULT 0, started REAL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints ("
+                "source_id TEXT NOT NULL, folder TEXT NOT NULL, "
+                "run_id TEXT NOT NULL, fingerprint TEXT, state TEXT NOT NULL, "
+                "updated REAL, PRIMARY KEY (source_id, folder))"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def start_run(self, source_id, job_id):
+        """
+        Start a new run for the given job or resume the last run of the
+        source if it has not been completed.
+        Returns a tuple (run_id, resumed).
+        """
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT run_id, completed FROM runs WHERE source_id = ?", (source_id,)
+        ).fetchone()
+        if row and not row[1]:
+            conn.execute(
+                "UPDATE runs SET job_id = ? WHERE source_id = ?", (job_id, source_id)
+            )
+            conn.commit()
+            log.info("Job %s resumes run %s of source %s" % (job_id, row[0], source_id))
+            return (row[0], True)
+
+        conn.execute(
+            "INSERT OR REPLACE INTO runs (source_id, run_id, job_id, completed, "
+            "started) VALUES (?, ?, ?, 0, ?)",
+            (source_id, job_id, job_id, time.time()),
+        )
+        conn.commit()
+        return (job_id, False)
+
+    def get(self, source_id, folder):
+        """
+        Return the checkpoint of a folder as tuple (run_id, fingerprint, state)
+        or None
+        """
+        return (
+            self._connection()
+            .execute(
+                "SELECT run_id, fingerprint, state FROM checkpoints "
+                "WHERE source_id = ? AND folder = ?",
+                (source_id, folder),
+            )
+            .fetchone()
+        )
+
+    def mark(self, source_id, folder, run_id, fingerprint, state):
+        conn = self._connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO checkpoints "
+            "(source_id, folder, run_id, fingerprint, state, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (source_id, folder, run_id, fingerprint, state, time.time()),
+        )
+        conn.commit()
+
+    def is_completed(self, source_id, folder, run_id, fingerprint):
+        """
+        Check if the folder has already been imported in the given run and
+        did not change since then
+        """
+        checkpoint = self.get(source_id, folder)
+        return checkpoint == (run_id, fingerprint, IMPORTED)
+
+    def finish(self, source_id, folder, state):
+        """
+        Record the result of the import of a folder and complete the run
+        if no gathered folder is left
+        """
+        checkpoint = self.get(source_id, folder)
+        if checkpoint is None:
+            return
+        run_id, fingerprint, _ = checkpoint
+        self.mark(source_id, folder, run_id, fingerprint, state)
+        self.complete_if_done(source_id, run_id)
+
+    def complete_if_done(self, source_id, run_id):
+        """
+        Complete the run if no gathered folder is left to import
+        """
+        conn = self._connection()
+        pending = conn.execute(
+            "SELECT COUNT(*) FROM checkpoints "
+            "WHERE source_id = ? AND run_id = ? AND state = ?",
+            (source_id, run_id, GATHERED),
+        ).fetchone()[0]
+        if not pending:
+            conn.execute(
+                "UPDATE runs SET completed = 1 WHERE source_id = ? AND run_id = ?",
+                (source_id, run_id),
+            )
+            conn.commit()
+            log.info("Run %s of source %s completed" % (run_id, source_id))
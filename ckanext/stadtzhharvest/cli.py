@@ -0,0 +1,235 @@
+# coding: utf-8
+
+import datetime
+import logging
+from contextlib import nullcontext
+
+import ckan.plugins.toolkit as tk
+import click
+from ckan import model
+
+from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestSource
+from ckanext.harvest.queue import get_fetch_publisher
+from ckanext.stadtzhharvest import profiling, retention
+from ckanext.stadtzhharvest.harvester import StadtzhHarvester
+from ckanext.stadtzhharvest.utils import stadtzhharvest_create_new_context
+from ckanext.stadtzhharvest.watcher import DropzoneWatcher
+
+log = logging.getLogger(__name__)
+
+
+def get_commands():
+    return [stadtzhharvest]
+
+
+@click.group()
+def stadtzhharvest():
+    """Commands of the harvester for the City of Zurich"""
+
+
+@stadtzhharvest.command()
+@click.argument("source_id")
+@click.option(
+    "--debounce",
+    default=60,
+    show_default=True,
+    help="Seconds a folder must stay unchanged before it is harvested",
+)
+@click.option(
+    "--poll-interval",
+    default=30,
+    show_default=True,
+    help="Seconds between two checks of the dropzone",
+)
+@click.option(
+    "--polling",
+    is_flag=True,
+    help="Compare snapshots instead of using inotify (e.g. for WebDAV mounts)",
+)
+def watch(source_id, debounce, poll_interval, polling):
+    """Watch the dropzone of a harvest source and harvest changed folders"""
+    source = _get_harvest_source(source_id)
+    harvester = StadtzhHarvester()
+    harvester._set_config(source.config)
+
+    watcher = DropzoneWatcher(
+        harvester.config["data_path"],
+        debounce=debounce,
+        poll_interval=poll_interval,
+        use_inotify=not polling,
+    )
+
+    def harvest_changed_folders(folders):
+        if _has_active_job(source):
+            # try again later, the running job might harvest them anyway
+            log.info("Harvest job running, postpone folders %s" % folders)
+            for folder in folders:
+                watcher.mark_changed(folder)
+            return
+        click.echo("Harvesting changed folders: %s" % ", ".join(folders))
+        _harvest_folders(harvester, source, folders)
+
+    watcher.run(harvest_changed_folders)
+
+
+@stadtzhharvest.command()
+@click.argument("source_id")
+@click.option(
+    "--keep",
+    default=5,
+    show_default=True,
+    help="Number of previous harvest objects to keep per dataset",
+)
+@click.option(
+    "--batch-size",
+    default=1000,
+    show_default=True,
+    help="Number of harvest objects deleted per transaction",
+)
+@click.option("--dry-run", is_flag=True, help="Only count the objects to delete")
+def compact(source_id, keep, batch_size, dry_run):
+    """Delete old harvest objects of a harvest source
+
+    The current harvest object of each dataset and the last KEEP objects
+    before it are kept, older objects are deleted with their errors.
+    """
+    source = _get_harvest_source(source_id)
+    retention.ensure_harvest_object_index()
+
+    object_ids = retention.outdated_harvest_object_ids(source.id, keep)
+    if dry_run:
+        click.echo("%d harvest objects would be deleted" % len(object_ids))
+        return
+    deleted = retention.delete_harvest_objects(object_ids, batch_size=batch_size)
+    click.echo("Deleted %d harvest objects" % deleted)
+
+
+@stadtzhharvest.command()
+@click.argument("source_id")
+@click.option(
+    "--import-sample",
+    default=0,
+    show_default=True,
+    help="Number of gathered datasets to import after the gather stage",
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    help="Roll back all database changes and do not write uploaded files",
+)
+@click.option(
+    "--output",
+    default="stadtzhharvest-profile",
+    show_default=True,
+    help="Prefix of the files to write the profile to",
+)
+@click.option(
+    "--sort",
+    default="cumulative",
+    show_default=True,
+    help="Sort order of the profile stats (see pstats.Stats.sort_stats)",
+)
+@click.option(
+    "--interval",
+    default=0.005,
+    show_default=True,
+    help="Seconds of CPU time between two samples of the stack",
+)
+def profile(source_id, import_sample, dry_run, output, sort, interval):
+    """Run a harvest job of a harvest source under a profiler
+
+    The gather stage and (with --import-sample) the import of some of the
+    gathered datasets are run in this process. The profile is written as
+    sorted stats (OUTPUT.txt), as binary stats (OUTPUT.pstats) and as
+    collapsed stacks for flame graphs (OUTPUT.collapsed).
+    """
+    source = _get_harvest_source(source_id)
+    if not dry_run and _has_active_job(source):
+        raise click.ClickException("A harvest job of this source is running")
+
+    harvester = StadtzhHarvester()
+    if dry_run:
+        harvester.disable_writes()
+    with profiling.writes_disabled() if dry_run else nullcontext():
+        with profiling.profiled(output, interval=interval, sort=sort) as files:
+            ids = _profile_job(harvester, source, import_sample)
+    click.echo(
+        "Gathered %d datasets, imported %d" % (len(ids), min(len(ids), import_sample))
+    )
+    click.echo("Profile written to %s" % ", ".join(files))
+
+
+def _profile_job(harvester, source, import_sample):
+    """
+    Run the gather stage of a new harvest job and import the first
+    `import_sample` harvest objects directly (without the queues)
+    """
+    job = HarvestJob()
+    job.source = source
+    job.status = "Running"
+    job.gather_started = datetime.datetime.utcnow()
+    job.save()
+
+    ids = harvester.gather_stage(job)
+    job.gather_finished = datetime.datetime.utcnow()
+    job.save()
+
+    for id in ids[:import_sample]:
+        harvest_object = HarvestObject.get(id)
+        harvest_object.import_started = datetime.datetime.utcnow()
+        harvester.fetch_stage(harvest_object)
+        result = harvester.import_stage(harvest_object)
+        harvest_object.state = "COMPLETE" if result else "ERROR"
+        harvest_object.import_finished = datetime.datetime.utcnow()
+        harvest_object.save()
+
+    job.status = "Finished"
+    job.finished = datetime.datetime.utcnow()
+    job.save()
+    return ids
+
+
+def _get_harvest_source(source_id):
+    context = stadtzhharvest_create_new_context()
+    try:
+        source_dict = tk.get_action("harvest_source_show")(context, {"id": source_id})
+    except tk.ObjectNotFound:
+        raise click.ClickException("Harvest source %s not found" % source_id)
+    return HarvestSource.get(source_dict["id"])
+
+
+def _has_active_job(source):
+    return (
+        model.Session.query(HarvestJob)
+        .filter(HarvestJob.source_id == source.id)
+        .filter(HarvestJob.status.in_(["New", "Running"]))
+        .count()
+        > 0
+    )
+
+
+def _harvest_folders(harvester, source, folders):
+    """
+    Create a harvest job for the given folders, gather them and send the
+    harvest objects to the fetch queue
+    """
+    job = HarvestJob()
+    job.source = source
+    job.status = "Running"
+    job.gather_started = datetime.datetime.utcnow()
+    job.save()
+
+    ids = harvester.gather_folders(job, folders)
+
+    job.gather_finished = datetime.datetime.utcnow()
+    if not ids:
+        job.status = "Finished"
+        job.finished = job.gather_finished
+    job.save()
+
+    publisher = get_fetch_publisher()
+    for id in ids:
+        publisher.send({"harvest_object_id": id})
+    publisher.close()
+    log.info("Sent %d objects of job %s to the fetch queue" % (len(ids), job.id))
+    return job
@@ -0,0 +1,164 @@
+# coding: utf-8
+
+import csv
+import logging
+import re
+
+import sqlalchemy as sa
+from ckan import model
+from ckan.logic import get_action
+
+log = logging.getLogger(__name__)
+
+# number of bytes read from the beginning of a CSV file to infer the types
+SAMPLE_SIZE = 1024 * 1024
+
+# keywords in the name or description of an attribute of the attributliste
+# hinting at the type of the field, the first match wins
+TYPE_HINTS = [
+    ("text", re.compile(r"\bchar\b|\bcode\b|\btext\b")),
+    ("timestamp", re.compile(r"yyyy-mm-dd[t ]hh|zeitstempel|\btimestamp\b")),
+    ("date", re.compile(r"yyyy-mm-dd|\bdatum\b|\bdate\b")),
+    (
+        "number",
+        re.compile(r"\banzahl\b|\bjahr\b|jahreszahl|numerisch|\bzahl\b|\bnumber\b"),
+    ),
+]
+
+# patterns the values of a field must match to get the hinted type
+VALUE_PATTERNS = [
+    ("int8", "number", re.compile(r"^-?\d{1,18}$")),
+    ("numeric", "number", re.compile(r"^-?\d+(\.\d+)?$")),
+    ("timestamp", "timestamp", re.compile(r"^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}")),
+    ("date", "date", re.compile(r"^\d{4}-\d{2}-\d{2}$")),
+]
+
+
+def attribute_hint(name, description):
+    """
+    Return the type hinted at by the name and description of an attribute
+    (text, timestamp, date or number) or None
+    """
+    text = ("%s %s" % (name or "", description or "")).lower()
+    for hint, pattern in TYPE_HINTS:
+        if pattern.search(text):
+            return hint
+    return None
+
+
+def read_sample(f):
+    """
+    Read the header and the first rows of a CSV file, returns a tuple with
+    the column names, the rows and the delimiter
+    """
+    sample = f.read(SAMPLE_SIZE)
+    lines = sample.decode("utf-8-sig", errors="replace").splitlines(True)
+    if len(sample) == SAMPLE_SIZE:
+        # the last line is probably incomplete
+        lines = lines[:-1]
+    if not lines:
+        return ([], [], ",")
+    delimiter = ";" if lines[0].count(";") > lines[0].count(",") else ","
+    rows = list(csv.reader(lines, delimiter=delimiter))
+    return (rows[0], rows[1:], delimiter)
+
+
+def infer_fields(columns, rows, hints):
+    """
+    Return the DataStore fields of the columns. A column gets the type
+    hinted at by the attributliste if all values of the sample match the
+    type, all other columns are text.
+    """
+    fields = []
+    for i, column in enumerate(columns):
+        values = [row[i] for row in rows if i < len(row) and row[i] != ""]
+        fields.append({"id": column, "type": _column_type(hints.get(column), values)})
+    return fields
+
+
+def _column_type(hint, values):
+    if not hint or not values:
+        return "text"
+    for field_type, value_hint, pattern in VALUE_PATTERNS:
+        if value_hint == hint and all(pattern.match(value) for value in values):
+            return field_type
+    return "text"
+
+
+def load_csv(resource_id, f, hints, context):
+    """
+    Load a CSV file into the DataStore table of a resource with COPY. The
+    table is replaced, if loading fails with the inferred types (e.g.
+    because of a value after the sample), all fields are loaded as text.
+    """
+    columns, rows, delimiter = read_sample(f)
+    fields = infer_fields(columns, rows, hints)
+    try:
+        _load(resource_id, f, fields, delimiter, context)
+    except Exception as e:
+        if all(field["type"] == "text" for field in fields):
+            raise
+        log.warning(
+            "Could not load %s with the inferred types, loading all fields "
+            "as text: %r" % (resource_id, e)
+        )
+        fields = [{"id": field["id"], "type": "text"} for field in fields]
+        _load(resource_id, f, fields, delimiter, context)
+    return fields
+
+
+def _load(resource_id, f, fields, delimiter, context):
+    _replace_table(resource_id, f, fields, delimiter)
+    _set_datastore_active(resource_id, context)
+
+
+def _replace_table(resource_id, f, fields, delimiter):
+    """
+    Replace the DataStore table of a resource and COPY the file into it in
+    one transaction, the previous table is kept if loading fails
+    """
+    from ckanext.datastore.backend import postgres as backend
+
+    engine = backend.get_write_engine()
+    backend._cache_types(engine)
+    data_dict = {"resource_id": resource_id, "fields": fields}
+    with engine.begin() as connection:
+        connection.execute(
+            sa.text("DROP TABLE IF EXISTS %s CASCADE" % backend.identifier(resource_id))
+        )
+        backend.create_table({"connection": connection}, data_dict, {})
+        # the trigger fills the full text index of the copied rows
+        backend._create_fulltext_trigger(connection, resource_id)
+        f.seek(0)
+        copy_csv(
+            connection, resource_id, f, [field["id"] for field in fields], delimiter
+        )
+        # building the indexes after loading the rows is faster
+        backend.create_indexes({"connection": connection}, data_dict)
+
+
+def _set_datastore_active(resource_id, context):
+    resource = model.Resource.get(resource_id)
+    if resource is not None and not resource.extras.get("datastore_active"):
+        get_action("resource_patch")(
+            context.copy(), {"id": resource_id, "datastore_active": True}
+        )
+
+
+def copy_csv(connection, resource_id, f, columns, delimiter):
+    """
+    Stream a CSV file into the DataStore table of a resource with COPY
+    """
+    from ckanext.datastore.backend.postgres import identifier
+
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(
+        "COPY %s (%s) FROM STDIN "
+        "WITH (FORMAT csv, HEADER true, DELIMITER '%s', ENCODING 'UTF8')"
+        % (
+            identifier(resource_id),
+            ", ".join(identifier(column) for column in columns),
+            delimiter,
+        ),
+        f,
+    )
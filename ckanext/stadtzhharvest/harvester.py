@@ -1,28 +1,48 @@
 # coding: utf-8
 
+import base64
 import datetime
+import fnmatch
 import hashlib
 import logging
 import os
 import re
+import time
 import traceback
 import uuid
-from contextlib import contextmanager
-from functools import cmp_to_key
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from functools import cmp_to_key, partial
 
 import ckan.lib.navl.validators as validators
 import ckan.plugins.toolkit as tk
 import defusedxml.ElementTree as etree
 from ckan import model
 from ckan import plugins as p
+from ckan.lib import uploader
+from ckan.lib.dictization import model_dictize
 from ckan.lib.helpers import json
 from ckan.lib.munge import munge_tag, munge_title_to_name
+from ckan.lib.search.common import make_connection
 from ckan.logic import NotFound, get_action
 from ckan.model import Session
+from ckan.model.follower import user_following_dataset_table
+from lxml import etree as lxml_etree
+from sqlalchemy import BigInteger, and_, cast, func, or_, select
+from sqlalchemy.orm import aliased
 from werkzeug.datastructures import FileStorage as FlaskFileStorage
 
+from ckanext.harvest import model as harvest_model
 from ckanext.harvest.harvesters import HarvesterBase
-from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestObject, HarvestObjectExtra
+from ckanext.stadtzhharvest import checkpoint, status
+from ckanext.stadtzhharvest.cache import MetadataCache
+from ckanext.stadtzhharvest.datastore import attribute_hint, load_csv
+from ckanext.stadtzhharvest.metrics import HarvestMetrics
+from ckanext.stadtzhharvest.prefetch import Prefetcher, read_file
+from ckanext.stadtzhharvest.spool import FileSpool
+from ckanext.stadtzhharvest.throttle import AdaptiveThrottle
 from ckanext.stadtzhharvest.utils import (
     stadtzhharvest_create_new_context,
     stadtzhharvest_find_or_create_organization,
@@ -34,6 +54,65 @@ log = logging.getLogger(__name__)
 
 FILE_NOT_FOUND_URL = "https://data.stadt-zuerich.ch/filenotfound"
 
+# bump this version whenever the structure of the metadata dict changes,
+# so that outdated entries of the metadata cache are no longer used
+METADATA_CACHE_VERSION = 4
+
+# fields of a resource set by the uploader when a file is staged
+STAGED_UPLOAD_FIELDS = ["url", "url_type", "mimetype"]
+
+# fields of a resource describing its file, they are only updated if the
+# file changed (or if they are missing)
+FILE_FIELDS = ["size", "last_modified", "etag"]
+
+# patterns of hidden and temporary files (e.g. of uploads in progress),
+# which are ignored in the dropzone
+IGNORED_FILE_PATTERNS = [".*", "~*", "*.tmp", "*.part"]
+
+# prefix of compressed harvest object contents
+COMPRESSED_CONTENT_PREFIX = "zlib:"
+
+# number of datasets removed from the search index with one delete query,
+# each dataset adds a clause to the query and Solr rejects queries with
+# more than `maxBooleanClauses` (1024 by default) clauses
+SOLR_DELETE_CHUNK_SIZE = 1000
+
+# default values of the optional harvest source config options
+DEFAULT_CONFIG = {
+    "metafile_dir": "",
+    "update_datasets": False,
+    "update_date_last_modified": False,
+    "dataset_prefix": "",
+    "delete_missing_datasets": False,
+    "validate_xml": False,
+    "include_folders": [],
+    "exclude_folders": [],
+    "shard_index": 0,
+    "shard_count": 1,
+    "resume_jobs": False,
+    "delete_batch_size": 0,
+    "max_delete_fraction": 1.0,
+    "compress_content_threshold": 0,
+    "import_order": "gather",
+    "upload_workers": 1,
+    "hash_workers": 1,
+    "quiet_period": 0,
+    "prefetch_datasets": 0,
+    "prefetch_budget": 512,
+    "datastore_load": False,
+    "throttle_latency": 0,
+    "throttle_max_pause": 60,
+}
+
+# options of a source which write outside of the database session and are
+# turned off for a dry run
+DRY_RUN_CONFIG = {
+    "datastore_load": False,
+    "delete_batch_size": 0,
+}
+
+SCHEMA_DIR = os.path.join(os.path.dirname(__file__), "schemas")
+
 
 class MetaXmlNotFoundError(Exception):
     pass
@@ -43,6 +122,53 @@ class MetaXmlInvalid(Exception):
     pass
 
 
+class LinkXmlInvalid(Exception):
+    pass
+
+
+class ResourceFileChanged(Exception):
+    pass
+
+
+_xml_schemas = {}
+
+
+def get_xml_schema(name):
+    """
+    Return the compiled XML schema with the given name (`meta` or `link`).
+    The schemas are only compiled once per process.
+    """
+    if name not in _xml_schemas:
+        schema_path = os.path.join(SCHEMA_DIR, "%s.xsd" % name)
+        _xml_schemas[name] = lxml_etree.XMLSchema(lxml_etree.parse(schema_path))
+    return _xml_schemas[name]
+
+
+def validate_xml(content, schema_name, error_class):
+    """
+    Validate the given XML content against the schema `schema_name`,
+    raises `error_class` with the validation errors if the content is invalid
+    """
+    parser = lxml_etree.XMLParser(resolve_entities=False, no_network=True)
+    try:
+        document = lxml_etree.fromstring(content, parser)
+    except lxml_etree.XMLSyntaxError as e:
+        raise error_class("%s.xml is not well-formed: %s" % (schema_name, e))
+    schema = get_xml_schema(schema_name)
+    if not schema.validate(document):
+        raise error_class(
+            "%s.xml does not match %s.xsd: %s"
+            % (
+                schema_name,
+                schema_name,
+                "; ".join(
+                    "line %s: %s" % (error.line, error.message)
+                    for error in schema.error_log
+                ),
+            )
+        )
+
+
 @contextmanager
 def retry_open_file(path, mode, tries=10, close=True):
     """
@@ -69,9 +195,125 @@ def retry_open_file(path, mode, tries=10, close=True):
         if the_file and not the_file.closed:
             the_file.close()
         raise error
-    yield the_file
-    if close:
-        the_file.close()
+    try:
+        yield the_file
+    finally:
+        if close:
+            the_file.close()
+
+
+def encode_content(metadata, compress_threshold=0):
+    """
+    Encode a metadata dict as content of a harvest object. Contents with at
+    least `compress_threshold` characters are compressed with zlib (a
+    threshold of 0 disables the compression).
+    """
+    content = json.dumps(metadata, ensure_ascii=False, separators=(",", ":"))
+    if compress_threshold and len(content) >= compress_threshold:
+        compressed = zlib.compress(content.encode("utf-8"))
+        content = COMPRESSED_CONTENT_PREFIX + base64.b64encode(compressed).decode(
+            "ascii"
+        )
+    return content
+
+
+def decode_content(content):
+    """
+    Decode the content of a harvest object (compressed or not)
+    """
+    if content.startswith(COMPRESSED_CONTENT_PREFIX):
+        compressed = base64.b64decode(content[len(COMPRESSED_CONTENT_PREFIX) :])
+        content = zlib.decompress(compressed).decode("utf-8")
+    return json.loads(content)
+
+
+@contextmanager
+def savepoint():
+    """
+    Run the enclosed block in a savepoint of the current transaction,
+    the savepoint is rolled back if an exception is raised
+    """
+    nested = Session.begin_nested()
+    try:
+        yield
+    except Exception:
+        if nested.is_active:
+            nested.rollback()
+        raise
+    if nested.is_active:
+        nested.commit()
+
+
+def purge_packages(package_ids):
+    """
+    Purge the given datasets with bulk SQL statements. Unlike
+    `Package.purge`, this bypasses the ORM session, so the datasets are
+    not removed from the search index one by one.
+    """
+    resource_ids = select(model.resource_table.c.id).where(
+        model.resource_table.c.package_id.in_(package_ids)
+    )
+    member = model.member_table
+    relationship = model.package_relationship_table
+    harvest_object = harvest_model.harvest_object_table
+    statements = [
+        # the harvest objects are kept for the history of the harvest jobs
+        harvest_object.update()
+        .where(harvest_object.c.package_id.in_(package_ids))
+        .values(package_id=None, current=False),
+        model.resource_view_table.delete().where(
+            model.resource_view_table.c.resource_id.in_(resource_ids)
+        ),
+        model.resource_table.delete().where(
+            model.resource_table.c.package_id.in_(package_ids)
+        ),
+        model.package_tag_table.delete().where(
+            model.package_tag_table.c.package_id.in_(package_ids)
+        ),
+        model.package_member_table.delete().where(
+            model.package_member_table.c.package_id.in_(package_ids)
+        ),
+        user_following_dataset_table.delete().where(
+            user_following_dataset_table.c.object_id.in_(package_ids)
+        ),
+        # the same cleanup as the dataset_purge action
+        member.delete()
+        .where(member.c.table_name == "package")
+        .where(member.c.table_id.in_(package_ids)),
+        relationship.delete().where(
+            or_(
+                relationship.c.subject_package_id.in_(package_ids),
+                relationship.c.object_package_id.in_(package_ids),
+            )
+        ),
+    ]
+    # the extras are stored in a separate table before CKAN 2.12
+    package_extra = getattr(model, "package_extra_table", None)
+    if package_extra is not None:
+        statements.append(
+            package_extra.delete().where(package_extra.c.package_id.in_(package_ids))
+        )
+    statements.append(
+        model.package_table.delete().where(model.package_table.c.id.in_(package_ids))
+    )
+    for statement in statements:
+        Session.execute(statement)
+
+
+def delete_from_search_index(package_ids):
+    """
+    Remove the given datasets from the search index with one delete query
+    per `SOLR_DELETE_CHUNK_SIZE` datasets
+    """
+    connection = make_connection()
+    commit = tk.asbool(tk.config.get("ckan.search.solr_commit", True))
+    for i in range(0, len(package_ids), SOLR_DELETE_CHUNK_SIZE):
+        chunk = package_ids[i : i + SOLR_DELETE_CHUNK_SIZE]
+        query = '+entity_type:package +site_id:"%s" +id:(%s)' % (
+            tk.config.get("ckan.site_id"),
+            " OR ".join('"%s"' % id for id in chunk),
+        )
+        connection.delete(q=query, commit=commit)
 
 
 class StadtzhHarvester(HarvesterBase):
@@ -79,6 +321,10 @@ class StadtzhHarvester(HarvesterBase):
     Harvester for the City of Zurich
     """
 
+    p.implements(p.IClick)
+    p.implements(p.IActions)
+    p.implements(p.IAuthFunctions)
+
     def __init__(self, **kwargs):
         HarvesterBase.__init__(self, **kwargs)
         try:
@@ -86,6 +332,60 @@ class StadtzhHarvester(HarvesterBase):
         except KeyError as e:
             raise Exception("'%s' not found in config" % e.message)
 
+        self.metadata_cache = None
+        cache_path = tk.config.get("ckanext.stadtzhharvest.metadata_cache_path")
+        if cache_path:
+            self.metadata_cache = MetadataCache(
+                cache_path,
+                max_size=int(
+                    tk.config.get("ckanext.stadtzhharvest.metadata_cache_size", 10000)
+                ),
+            )
+
+        self.checkpoints = None
+        checkpoint_path = tk.config.get("ckanext.stadtzhharvest.checkpoint_path")
+        if checkpoint_path:
+            self.checkpoints = checkpoint.CheckpointStore(checkpoint_path)
+        self._run = None
+        self._object_costs = {}
+        self.throttle = None
+
+        self.metrics = HarvestMetrics()
+        self.metrics_dir = tk.config.get("ckanext.stadtzhharvest.metrics_dir")
+        self._metrics_source = None
+
+        self.prefetcher = None
+        self._prefetch_job = None
+        self._datastore_loads = []
+        self._dataset_changed = False
+        self._oldest_pending_change = None
+
+        self.dry_run = False
+
+        self.spool = None
+        spool_path = tk.config.get("ckanext.stadtzhharvest.spool_path")
+        if spool_path:
+            # the size of the spool is configured in megabytes
+            spool_size = int(tk.config.get("ckanext.stadtzhharvest.spool_size", 1024))
+            self.spool = FileSpool(
+                spool_path,
+                max_size=spool_size * 1024 * 1024,
+                open_source=partial(retry_open_file, mode="rb"),
+            )
+
+    def disable_writes(self):
+        """
+        Disable everything that is written outside of the database session
+        (e.g. for a dry run): uploaded files, the checkpoints, the metadata
+        cache, the spool, the metrics files, the status of the source,
+        DataStore loads and purging datasets in batches
+        """
+        self.dry_run = True
+        self.checkpoints = None
+        self.metadata_cache = None
+        self.spool = None
+        self.metrics_dir = None
+
     def info(self):
         return {
             "name": "stadtzh_harvester",
@@ -93,6 +393,23 @@ class StadtzhHarvester(HarvesterBase):
             "description": "Harvester for the DWH and GEO dropzones of the City of Zurich",
         }
 
+    # IClick
+
+    def get_commands(self):
+        from ckanext.stadtzhharvest.cli import get_commands
+
+        return get_commands()
+
+    # IActions
+
+    def get_actions(self):
+        return status.get_actions()
+
+    # IAuthFunctions
+
+    def get_auth_functions(self):
+        return status.get_auth_functions()
+
     def validate_config(self, config_str):
         config_obj = json.loads(config_str)
         self._validate_string_config(config_obj, "data_path", required=True)
@@ -103,14 +420,38 @@ class StadtzhHarvester(HarvesterBase):
         self._validate_boolean_config(
             config_obj, "delete_missing_datasets", required=False
         )
+        self._validate_boolean_config(config_obj, "validate_xml", required=False)
+        self._validate_list_config(config_obj, "include_folders")
+        self._validate_list_config(config_obj, "exclude_folders")
+        self._validate_boolean_config(config_obj, "resume_jobs", required=False)
+        self._validate_integer_config(config_obj, "delete_batch_size")
+        self._validate_number_config(config_obj, "max_delete_fraction", 0, 1)
+        self._validate_integer_config(config_obj, "compress_content_threshold")
+        self._validate_string_config(
+            config_obj, "import_order", choices=["gather", "cost"]
+        )
+        self._validate_integer_config(config_obj, "upload_workers", minimum=1)
+        self._validate_integer_config(config_obj, "hash_workers", minimum=1)
+        self._validate_integer_config(config_obj, "quiet_period")
+        self._validate_integer_config(config_obj, "prefetch_datasets")
+        self._validate_integer_config(config_obj, "prefetch_budget", minimum=1)
+        self._validate_boolean_config(config_obj, "datastore_load", required=False)
+        self._validate_number_config(config_obj, "throttle_latency", 0, 3600)
+        self._validate_number_config(config_obj, "throttle_max_pause", 0, 3600)
+        self._validate_integer_config(config_obj, "shard_index")
+        self._validate_integer_config(config_obj, "shard_count", minimum=1)
+        if config_obj.get("shard_index", 0) >= config_obj.get("shard_count", 1):
+            raise ValueError("shard_index must be lower than shard_count")
 
         return config_str
 
-    def _validate_string_config(self, source, field, required=False):
+    def _validate_string_config(self, source, field, required=False, choices=None):
         if field in source:
             value = source[field]
             if not isinstance(value, str):
                 raise ValueError("%s must be a string" % field)
+            if choices is not None and value not in choices:
+                raise ValueError("%s must be one of %s" % (field, ", ".join(choices)))
         elif required:
             raise ValueError("%s is required" % field)
 
@@ -122,25 +463,87 @@ class StadtzhHarvester(HarvesterBase):
         elif required:
             raise ValueError("%s is required" % field)
 
+    def _validate_list_config(self, source, field, required=False):
+        if field in source:
+            value = source[field]
+            if not isinstance(value, list) or not all(
+                isinstance(item, str) for item in value
+            ):
+                raise ValueError("%s must be a list of strings" % field)
+        elif required:
+            raise ValueError("%s is required" % field)
+
+    def _validate_integer_config(self, source, field, required=False, minimum=0):
+        if field in source:
+            value = source[field]
+            if not isinstance(value, int) or isinstance(value, bool):
+                raise ValueError("%s must be an integer" % field)
+            if value < minimum:
+                raise ValueError("%s must be at least %s" % (field, minimum))
+        elif required:
+            raise ValueError("%s is required" % field)
+
+    def _validate_number_config(self, source, field, minimum, maximum):
+        if field in source:
+            value = source[field]
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                raise ValueError("%s must be a number" % field)
+            if not minimum <= value <= maximum:
+                raise ValueError(
+                    "%s must be between %s and %s" % (field, minimum, maximum)
+                )
+
     def _set_config(self, config_str):
         self.config = json.loads(config_str)
 
-        if "metafile_dir" not in self.config:
-            self.config["metafile_dir"] = ""
-        if "update_datasets" not in self.config:
-            self.config["update_datasets"] = False
-        if "update_date_last_modified" not in self.config:
-            self.config["update_date_last_modified"] = False
-        if "dataset_prefix" not in self.config:
-            self.config["dataset_prefix"] = ""
-        if "delete_missing_datasets" not in self.config:
-            self.config["delete_missing_datasets"] = False
+        for key, value in DEFAULT_CONFIG.items():
+            self.config.setdefault(key, value)
+        if self.dry_run:
+            self.config.update(DRY_RUN_CONFIG)
 
         log.debug("Using config: %r" % self.config)
 
     def gather_stage(self, harvest_job):
         log.debug("In StadtzhHarvester gather_stage")
+        with self._gather_measured(harvest_job):
+            return self._gather(harvest_job)
+
+    @contextmanager
+    def _gather_measured(self, harvest_job):
+        """
+        Collect the metrics of a gather stage, the metrics are written and
+        saved in the status of the source at the end
+        """
+        started = time.monotonic()
+        started_at = datetime.datetime.utcnow()
+        self._start_metrics(harvest_job.source_id, harvest_job.id)
+        self._oldest_pending_change = None
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - started
+            self._observe_metric("stadtzhharvest_gather_duration_seconds", duration)
+            self._write_metrics("gather")
+            self._save_gather_status(harvest_job, started_at, duration)
+            log.info(
+                "Gathered %d datasets of job %s"
+                % (
+                    self.metrics.get(
+                        "stadtzhharvest_datasets_gathered_total",
+                        source=harvest_job.source_id,
+                    ),
+                    harvest_job.id,
+                )
+            )
+
+    def _gather(self, harvest_job):
         self._set_config(harvest_job.source.config)
+        self._run = None
+        self._object_costs = {}
+        if self.checkpoints is not None and self.config["resume_jobs"]:
+            self._run = self.checkpoints.start_run(
+                harvest_job.source_id, harvest_job.id
+            )
 
         # generated ids of the harvest objects
         ids = []
@@ -148,45 +551,27 @@ class StadtzhHarvester(HarvesterBase):
         gathered_dataset_ids = []
         try:
             # list directories in dropzone folder
-            datasets = self._remove_hidden_files(os.listdir(self.config["data_path"]))
+            folders = self._remove_hidden_files(os.listdir(self.config["data_path"]))
+            datasets = self._select_folders(folders)
             log.debug("Directories in %s: %s" % (self.config["data_path"], datasets))
 
             # foreach -> meta.xml -> create entry
             for dataset in datasets:
-                # use dataset_prefix to make dataset names unique
-                dataset_name = "%s%s" % (self.config["dataset_prefix"], dataset)
-                dataset_id = self._validate_package_id(dataset_name)
-                log.debug("Gather %s" % dataset_id)
+                dataset_id, id = self._gather_dataset(dataset, harvest_job)
                 if dataset_id:
                     gathered_dataset_ids.append(dataset_id)
-                    meta_xml_path = os.path.join(
-                        self.config["data_path"],
-                        dataset,
-                        self.config["metafile_dir"],
-                        "meta.xml",
-                    )
-                    try:
-                        metadata = self._load_metadata_from_path(
-                            meta_xml_path, dataset_id, dataset
-                        )
-                    except Exception as e:
-                        log.exception(e)
-                        self._save_gather_error(
-                            "Could not parse metadata in %s: %s / %s"
-                            % (meta_xml_path, str(e), traceback.format_exc()),
-                            harvest_job,
-                        )
-                        continue
-
-                    id = self._save_harvest_object(metadata, harvest_job)
+                if id:
                     ids.append(id)
+            if self._run:
+                # complete the run right away if there is nothing to import
+                self.checkpoints.complete_if_done(harvest_job.source_id, self._run[0])
             if self.config["delete_missing_datasets"]:
                 delete_ids = self._check_for_deleted_datasets(
-                    harvest_job, gathered_dataset_ids
+                    harvest_job, gathered_dataset_ids, folders
                 )
                 ids.extend(delete_ids)
 
-            return ids
+            return self._order_objects(ids)
         except Exception as e:
             log.exception(e)
             self._save_gather_error(
@@ -196,24 +581,418 @@ class StadtzhHarvester(HarvesterBase):
             )
             return []
 
-    def _load_metadata_from_path(self, meta_xml_path, dataset_id, dataset):
+    def gather_folders(self, harvest_job, folders):
+        """
+        Gather only the given dataset folders of the dropzone, e.g. the
+        changed folders reported by the watcher. Folders that no longer
+        exist are marked for deletion if `delete_missing_datasets` is set.
+        Returns the ids of the created harvest objects.
+        """
+        with self._gather_measured(harvest_job):
+            return self._gather_folders(harvest_job, folders)
+
+    def _gather_folders(self, harvest_job, folders):
+        self._set_config(harvest_job.source.config)
+        self._run = None
+        self._object_costs = {}
+        ids = []
+        missing_folders = []
+        for dataset in self._select_folders(self._remove_hidden_files(folders)):
+            if os.path.isdir(os.path.join(self.config["data_path"], dataset)):
+                _, id = self._gather_dataset(dataset, harvest_job)
+                if id:
+                    ids.append(id)
+            else:
+                missing_folders.append(dataset)
+        if missing_folders and self.config["delete_missing_datasets"]:
+            ids.extend(self._check_for_deleted_folders(harvest_job, missing_folders))
+        return self._order_objects(ids)
+
+    def _order_objects(self, ids):
+        """
+        Return the ids of the harvest objects in the order they should be
+        imported. The fetch queue processes the objects in the order they
+        are returned by the gather stage, with `import_order` set to `cost`
+        the cheapest objects (e.g. deletions and small datasets) come first.
+        """
+        if self.config["import_order"] != "cost":
+            return ids
+        return sorted(ids, key=lambda id: self._object_costs.get(id, (0, 0)))
+
+    def _select_folders(self, folders):
+        """
+        Return the folders that are harvested by this source, according to
+        the `include_folders`/`exclude_folders` patterns and the shard
+        """
+        return [
+            folder
+            for folder in folders
+            if self._folder_matches_patterns(folder)
+            and self._in_shard(
+                self._validate_package_id(
+                    "%s%s" % (self.config["dataset_prefix"], folder)
+                )
+            )
+        ]
+
+    def _folder_matches_patterns(self, folder):
+        def matches(patterns):
+            for pattern in patterns:
+                if fnmatch.fnmatchcase(folder, pattern):
+                    return True
+            return False
+
+        include = self.config["include_folders"]
+        if include and not matches(include):
+            return False
+        return not matches(self.config["exclude_folders"])
+
+    def _in_shard(self, dataset_id):
+        """
+        Check if the dataset belongs to the shard of this source. The shard
+        is determined by a stable hash of the dataset id.
+        """
+        if self.config["shard_count"] <= 1 or not dataset_id:
+            return True
+        digest = hashlib.md5(dataset_id.encode("utf-8")).hexdigest()
+        return int(digest, 16) % self.config["shard_count"] == (
+            self.config["shard_index"]
+        )
+
+    def _package_in_scope(self, package_name, folder):
+        """
+        Check if an existing package of this source is in the scope of the
+        folder patterns and the shard, only those packages can be deleted.
+        The patterns are matched against the dropzone folder of the package,
+        if the folder is unknown the package is only in scope if no patterns
+        are set.
+        """
+        if folder is None:
+            if self.config["include_folders"] or self.config["exclude_folders"]:
+                return False
+        elif not self._folder_matches_patterns(folder):
+            return False
+        return self._in_shard(package_name)
+
+    def _get_package_folders(self, package_names, folders):
+        """
+        Return a dict with the dropzone folders of the given packages. The
+        folders are looked up in the listing of the dropzone, for packages
+        whose folder no longer exists the `datasetFolder` of their current
+        harvest object is used.
+        """
+        package_names = set(package_names)
+        package_folders = {}
+        for folder in folders:
+            name = self._validate_package_id(
+                "%s%s" % (self.config["dataset_prefix"], folder)
+            )
+            if name in package_names:
+                package_folders[name] = folder
+
+        missing = package_names - set(package_folders)
+        if missing:
+            package_folders.update(self._get_harvested_folders(missing))
+        return package_folders
+
+    def _get_harvested_folders(self, package_names):
+        """
+        Return a dict with the `datasetFolder` of the current harvest
+        objects of the given packages
+        """
+        rows = (
+            model.Session.query(model.Package.name, HarvestObject.content)
+            .join(HarvestObject, HarvestObject.package_id == model.Package.id)
+            .filter(HarvestObject.current == True)  # noqa: E712
+            .filter(model.Package.name.in_(package_names))
+        )
+        package_folders = {}
+        for name, content in rows:
+            folder = decode_content(content).get("datasetFolder") if content else None
+            if folder:
+                package_folders[name] = folder
+        return package_folders
+
+    def _gather_dataset(self, dataset, harvest_job):
+        """
+        Gather a single dataset folder of the dropzone.
+        Returns a tuple with the dataset id and the id of the created harvest
+        object, both are None if the folder could not be gathered.
+        """
+        # use dataset_prefix to make dataset names unique
+        dataset_name = "%s%s" % (self.config["dataset_prefix"], dataset)
+        dataset_id = self._validate_package_id(dataset_name)
+        log.debug("Gather %s" % dataset_id)
+        if not dataset_id:
+            return (None, None)
+
+        if self._is_settling(dataset):
+            # the dataset still counts as gathered, so it is not deleted
+            log.info(
+                "Defer %s, its files were modified in the last %d minutes"
+                % (dataset_id, self.config["quiet_period"])
+            )
+            self._inc_metric("stadtzhharvest_datasets_deferred_total")
+            self._add_pending_change(dataset)
+            return (dataset_id, None)
+
+        fingerprint = None
+        if self._run:
+            fingerprint = self._dataset_fingerprint(dataset)
+            if self._already_imported(harvest_job, dataset, fingerprint):
+                log.info("Skip %s, it was already imported in this run" % dataset_id)
+                return (dataset_id, None)
+
+        meta_xml_path = os.path.join(
+            self.config["data_path"],
+            dataset,
+            self.config["metafile_dir"],
+            "meta.xml",
+        )
+        try:
+            metadata = self._load_metadata_from_path(
+                meta_xml_path,
+                dataset_id,
+                dataset,
+                validate=self.config["validate_xml"],
+            )
+        except Exception as e:
+            log.exception(e)
+            self._save_gather_error(
+                "Could not parse metadata in %s: %s / %s"
+                % (meta_xml_path, str(e), traceback.format_exc()),
+                harvest_job,
+            )
+            return (dataset_id, None)
+
+        try:
+            metadata["resource_manifest"] = self._generate_resources_from_folder(
+                dataset
+            )
+        except Exception as e:
+            log.exception(e)
+            self._save_gather_error(
+                "Could not read the resources of %s: %s / %s"
+                % (dataset, str(e), traceback.format_exc()),
+                harvest_job,
+            )
+            return (dataset_id, None)
+
+        # only the new and changed files are uploaded in the import stage
+        existing_package = self._get_existing_package(
+            {"id": metadata["datasetID"], "name": metadata["datasetID"]}
+        )
+        cost = self._estimate_cost(
+            self._changed_files(metadata["resource_manifest"], existing_package)
+        )
+        id = self._save_harvest_object(
+            metadata,
+            harvest_job,
+            extras={"estimated_bytes": cost[0], "estimated_files": cost[1]},
+        )
+        self._object_costs[id] = cost
+        self._inc_metric("stadtzhharvest_datasets_gathered_total")
+        if self._run:
+            self.checkpoints.mark(
+                harvest_job.source_id,
+                dataset,
+                self._run[0],
+                fingerprint,
+                checkpoint.GATHERED,
+            )
+        return (dataset_id, id)
+
+    def _already_imported(self, harvest_job, dataset, fingerprint):
+        """
+        Check if a resumed run already imported the unchanged dataset
+        """
+        run_id, resumed = self._run
+        return resumed and self.checkpoints.is_completed(
+            harvest_job.source_id, dataset, run_id, fingerprint
+        )
+
+    def _is_settling(self, dataset):
+        """
+        Check if any file of a dataset folder was modified within the
+        `quiet_period`, i.e. if the folder might still be written
+        """
+        if not self.config["quiet_period"]:
+            return False
+        newest = self._newest_change(dataset)
+        if newest is None:
+            return False
+        return time.time() - newest < self.config["quiet_period"] * 60
+
+    def _newest_change(self, dataset):
+        """
+        Return the newest modification time of the files of a dataset folder
+        (as timestamp) or None if the folder can not be read
+        """
+        folder_path = os.path.join(
+            self.config["data_path"], dataset, self.config["metafile_dir"]
+        )
+        try:
+            newest = os.stat(folder_path).st_mtime
+            for entry in os.scandir(folder_path):
+                newest = max(newest, entry.stat().st_mtime)
+        except OSError as e:
+            log.warning("Could not check the age of %s: %r" % (dataset, e))
+            return None
+        return newest
+
+    def _add_pending_change(self, dataset):
+        """
+        Remember the oldest change of the dataset folders that are not
+        harvested in this job
+        """
+        newest = self._newest_change(dataset)
+        if newest is None:
+            return
+        changed = datetime.datetime.utcfromtimestamp(newest)
+        if self._oldest_pending_change is None or changed < self._oldest_pending_change:
+            self._oldest_pending_change = changed
+
+    def _save_gather_status(self, harvest_job, started_at, duration):
+        """
+        Save the results of the gather stage in the status of the source
+        """
+        if self.dry_run:
+            return
+
+        def metric(name, **labels):
+            return self.metrics.get(name, source=harvest_job.source_id, **labels)
+
+        try:
+            status.record_gather(
+                harvest_job.source_id,
+                harvest_job.id,
+                {
+                    "gather_started": started_at,
+                    "gather_finished": datetime.datetime.utcnow(),
+                    "gather_duration": duration,
+                    "datasets_gathered": metric(
+                        "stadtzhharvest_datasets_gathered_total"
+                    ),
+                    "datasets_deferred": metric(
+                        "stadtzhharvest_datasets_deferred_total"
+                    ),
+                    "cache_hits": metric(
+                        "stadtzhharvest_metadata_cache_total", result="hit"
+                    ),
+                    "cache_misses": metric(
+                        "stadtzhharvest_metadata_cache_total", result="miss"
+                    ),
+                    "oldest_pending_change": self._oldest_pending_change,
+                },
+            )
+        except Exception as e:
+            # the status is only used for monitoring, never fail the job
+            log.warning(
+                "Could not save the status of source %s: %r"
+                % (harvest_job.source_id, e)
+            )
+
+    def _save_import_status(self, harvest_object, result, duration):
+        """
+        Add the import of a dataset to the status of the source
+        """
+        if self.dry_run:
+            return
+        try:
+            status.record_import(
+                harvest_object.job.source_id,
+                harvest_object.job.id,
+                duration,
+                result,
+                self._dataset_changed,
+                gathered=harvest_object.gathered,
+            )
+        except Exception as e:
+            log.warning(
+                "Could not save the status of source %s: %r"
+                % (harvest_object.job.source_id, e)
+            )
+
+    def _estimate_cost(self, resources):
+        """
+        Estimate the cost to import a dataset from its resources, returns a
+        tuple with the total size (in bytes) and the number of its files
+        """
+        files = [r for r in resources if r.get("url_type") == "upload"]
+        return (sum(r.get("size", 0) for r in files), len(files))
+
+    def _dataset_fingerprint(self, dataset):
+        """
+        Return a fingerprint of the files of a dataset folder based on their
+        names, sizes and modification times
+        """
+        folder_path = os.path.join(
+            self.config["data_path"], dataset, self.config["metafile_dir"]
+        )
+        md5 = hashlib.md5()
+        for entry in sorted(os.scandir(folder_path), key=lambda e: e.name):
+            if entry.is_file():
+                stat = entry.stat()
+                md5.update(
+                    (
+                        "%s:%s:%s\n" % (entry.name, stat.st_size, stat.st_mtime_ns)
+                    ).encode("utf-8")
+                )
+        return md5.hexdigest()
+
+    def _load_metadata_from_path(
+        self, meta_xml_path, dataset_id, dataset, validate=False
+    ):
         if not os.path.exists(meta_xml_path):
             raise MetaXmlNotFoundError(
                 "meta.xml not found for dataset %s (path: %s)"
                 % (dataset_id, meta_xml_path)
             )
 
-        with retry_open_file(meta_xml_path, "r") as meta_xml:
-            tree = etree.parse(meta_xml)
-            meta_xml = tree.getroot()
-            dataset_node = meta_xml.find("datensatz")
-            resources_node = dataset_node.find("ressourcen")
+        with retry_open_file(meta_xml_path, "rb") as meta_xml:
+            content = meta_xml.read()
+
+        if validate:
+            validate_xml(content, "meta", MetaXmlInvalid)
+            link_xml_path = os.path.join(os.path.dirname(meta_xml_path), "link.xml")
+            if os.path.exists(link_xml_path):
+                with retry_open_file(link_xml_path, "rb") as link_xml:
+                    validate_xml(link_xml.read(), "link", LinkXmlInvalid)
+
+        cache_key = None
+        metadata = None
+        if self.metadata_cache is not None:
+            cache_key = "%s:%s:%s:%s" % (
+                METADATA_CACHE_VERSION,
+                dataset_id,
+                dataset,
+                hashlib.sha256(content).hexdigest(),
+            )
+            metadata = self.metadata_cache.get(cache_key)
+            if metadata is not None:
+                log.debug("Using cached metadata for %s" % dataset_id)
+                self._inc_metric("stadtzhharvest_metadata_cache_total", result="hit")
+            else:
+                self._inc_metric("stadtzhharvest_metadata_cache_total", result="miss")
+
+        if metadata is None:
+            metadata = self._parse_metadata(content, dataset_id, dataset)
+            if cache_key:
+                self.metadata_cache.set(cache_key, metadata)
+
+        # the groups are resolved on every lookup, so that missing groups
+        # are created again even if the metadata is cached
+        metadata["groups"] = self._dropzone_get_groups(metadata.pop("group_titles"))
+        return metadata
+
+    def _parse_metadata(self, content, dataset_id, dataset):
+        dataset_node = etree.fromstring(content).find("datensatz")
+        resources_node = dataset_node.find("ressourcen")
 
         metadata = self._dropzone_get_metadata(dataset_id, dataset, dataset_node)
 
         # add resource metadata
         metadata["resource_metadata"] = self._get_resources_metadata(resources_node)
-
         return metadata
 
     def fetch_stage(self, harvest_object):
@@ -222,8 +1001,18 @@ class StadtzhHarvester(HarvesterBase):
         return True
 
     def import_stage(self, harvest_object):
+        """
+        Import a harvest object. The whole import of a harvest object is
+        done in a single transaction, which is committed at the end.
+        """
         log.debug("In StadtzhHarvester import_stage")
         self._set_config(harvest_object.job.source.config)
+        self._set_throttle()
+        started = time.monotonic()
+        self._start_metrics(harvest_object.job.source_id, harvest_object.job.id)
+        self._prefetch(harvest_object)
+        self._datastore_loads = []
+        self._dataset_changed = False
 
         if not harvest_object:
             log.error("No harvest object received")
@@ -231,9 +1020,22 @@ class StadtzhHarvester(HarvesterBase):
             return False
 
         try:
-            return self._import_package(harvest_object)
+            result = self._import_package(harvest_object)
+        except ResourceFileChanged as e:
+            # discard the changes, the dataset is imported again in the
+            # next run once its files are complete
+            Session.rollback()
+            log.warning("Could not import %s: %s" % (harvest_object.guid, e))
+            self._save_object_error(
+                "%s, the dataset is imported again in the next run" % e,
+                harvest_object,
+                "Import",
+            )
+            result = False
         except Exception as e:
             log.exception(e)
+            # discard the partial import of the dataset
+            Session.rollback()
             self._save_object_error(
                 (
                     "Unable to get content for package: %s: %r / %s"
@@ -241,39 +1043,293 @@ class StadtzhHarvester(HarvesterBase):
                 ),
                 harvest_object,
             )
-            return False
+            result = False
+        finally:
+            # the datasets are indexed on commit
+            with self._measure():
+                Session.commit()
+            if self.prefetcher:
+                self.prefetcher.release(harvest_object.id)
+
+        if result:
+            self._load_datastore(harvest_object)
+        self._save_checkpoint(harvest_object, result)
+        duration = time.monotonic() - started
+        self._inc_metric(
+            "stadtzhharvest_datasets_imported_total",
+            result="success" if result else "error",
+        )
+        self._observe_metric("stadtzhharvest_import_duration_seconds", duration)
+        self._write_metrics("import")
+        self._save_import_status(harvest_object, result, duration)
+        return result
+
+    def _prefetch(self, harvest_object):
+        """
+        Schedule the prefetch of the files of the next `prefetch_datasets`
+        datasets of the job, which are read while this one is imported
+        """
+        if not self.config["prefetch_datasets"]:
+            return
+        if self.prefetcher is None:
+            self.prefetcher = Prefetcher(warm=self._warm_file)
+        if self._prefetch_job != harvest_object.harvest_job_id:
+            self.prefetcher.reset()
+            self._prefetch_job = harvest_object.harvest_job_id
+        self.prefetcher.budget = self.config["prefetch_budget"] * 1024 * 1024
+
+        try:
+            upcoming_ids = self._upcoming_object_ids(harvest_object)
+            # release the datasets which are no longer waiting, as they were
+            # imported by another fetch process
+            self.prefetcher.retain(set(upcoming_ids) | {harvest_object.id})
+            for id in upcoming_ids:
+                if self.prefetcher.is_scheduled(id):
+                    continue
+                files = self._files_to_upload(HarvestObject.get(id))
+                if not self.prefetcher.schedule(id, files):
+                    break
+        except Exception as e:
+            # prefetching is only an optimization, never fail the import
+            log.warning("Could not prefetch the next datasets: %r" % e)
+
+    def _upcoming_object_ids(self, harvest_object):
+        """
+        Return the ids of the next harvest objects of the job waiting to be
+        imported, in the same order as returned by `_order_objects`
+        """
+        query = (
+            model.Session.query(HarvestObject.id)
+            .filter(HarvestObject.harvest_job_id == harvest_object.harvest_job_id)
+            .filter(HarvestObject.state == "WAITING")
+            .filter(HarvestObject.id != harvest_object.id)
+        )
+        if self.config["import_order"] == "cost":
+            order = []
+            for key in ["estimated_bytes", "estimated_files"]:
+                extra = aliased(HarvestObjectExtra)
+                query = query.outerjoin(
+                    extra,
+                    and_(extra.harvest_object_id == HarvestObject.id, extra.key == key),
+                )
+                # objects without costs (e.g. deletions) come first
+                order.append(func.coalesce(cast(extra.value, BigInteger), 0))
+            query = query.order_by(*order)
+        rows = (
+            query.order_by(HarvestObject.gathered)
+            .limit(self.config["prefetch_datasets"])
+            .all()
+        )
+        return [row.id for row in rows]
+
+    def _files_to_upload(self, harvest_object):
+        """
+        Return the paths and sizes of the files of a harvest object which
+        will be uploaded, i.e. the files of new and changed resources
+        """
+        package_dict = decode_content(harvest_object.content)
+        manifest = package_dict.get("resource_manifest") or []
+        existing_package = self._get_existing_package(
+            {"id": harvest_object.guid, "name": harvest_object.guid}
+        )
+        return [
+            (os.path.join(self.config["data_path"], r["path"]), r.get("size", 0))
+            for r in self._changed_files(manifest, existing_package)
+        ]
+
+    def _changed_files(self, manifest, existing_package):
+        """
+        Return the resources of the manifest whose file is new or differs
+        from the file of the resource with the same name in the existing
+        package
+        """
+        hashes = {}
+        if existing_package:
+            hashes = dict(
+                (r["name"], r.get("zh_hash")) for r in existing_package["resources"]
+            )
+        return [
+            r
+            for r in manifest
+            if "path" in r
+            and (not r.get("zh_hash") or hashes.get(r["name"]) != r["zh_hash"])
+        ]
+
+    def _warm_file(self, path):
+        if self.spool:
+            size = self.spool.fetch(path)
+        else:
+            size = read_file(path)
+        self._inc_metric("stadtzhharvest_bytes_prefetched_total", size)
+        return size
+
+    def _queue_datastore_loads(self, actions, resource_ids, attribute_hints):
+        """
+        Remember the CSV files of the imported resources whose file changed,
+        they are loaded into the DataStore after the import is committed
+        """
+        if not self.config["datastore_load"]:
+            return
+        for action in actions:
+            # only uploaded files are loaded, links and deletions are skipped
+            if not action.get("staged"):
+                continue
+            resource = action["new_resource"]
+            old_resource = action.get("old_resource") or {}
+            resource_id = resource.get("id") or old_resource.get("id")
+            if (
+                resource_id in resource_ids
+                and resource.get("format", "").lower() == "csv"
+            ):
+                self._datastore_loads.append(
+                    (resource_id, action["file_path"], attribute_hints)
+                )
+
+    def _load_datastore(self, harvest_object):
+        """
+        Load the queued CSV files directly from the dropzone into the
+        DataStore with COPY
+        """
+        for resource_id, path, attribute_hints in self._datastore_loads:
+            try:
+                with _open_resource_file(path, self.spool) as f:
+                    with self._measure():
+                        fields = load_csv(
+                            resource_id,
+                            f,
+                            attribute_hints,
+                            stadtzhharvest_create_new_context(),
+                        )
+                log.info(
+                    "Loaded %s into the DataStore with the fields %s"
+                    % (path, ", ".join("%(id)s (%(type)s)" % field for field in fields))
+                )
+                self._inc_metric(
+                    "stadtzhharvest_datastore_loads_total", result="success"
+                )
+            except Exception as e:
+                log.exception(e)
+                self._save_object_error(
+                    "Could not load %s into the DataStore: %r / %s"
+                    % (path, e, traceback.format_exc()),
+                    harvest_object,
+                    "Import",
+                )
+                self._inc_metric("stadtzhharvest_datastore_loads_total", result="error")
+        self._datastore_loads = []
+
+    def _start_metrics(self, source_id, job_id):
+        self._metrics_source = source_id
+        self.metrics.start_job(source_id, job_id)
+
+    def _inc_metric(self, name, value=1, **labels):
+        self.metrics.inc(name, value, source=self._metrics_source, **labels)
+
+    def _observe_metric(self, name, value, **labels):
+        self.metrics.observe(name, value, source=self._metrics_source, **labels)
+
+    def _write_metrics(self, stage):
+        """
+        Write the metrics for the Prometheus textfile collector, if the
+        `ckanext.stadtzhharvest.metrics_dir` option is set
+        """
+        if self.metrics_dir:
+            self.metrics.write(self.metrics_dir, stage)
+
+    def _set_throttle(self):
+        """
+        Set up the throttle of the import according to the source config,
+        the throttle is kept between imports to track the latency
+        """
+        threshold = self.config["throttle_latency"]
+        max_pause = self.config["throttle_max_pause"]
+        if not threshold:
+            self.throttle = None
+        elif self.throttle is None or (
+            self.throttle.threshold,
+            self.throttle.max_pause,
+        ) != (threshold, max_pause):
+            self.throttle = AdaptiveThrottle(threshold, max_pause=max_pause)
+
+    def _measure(self):
+        """
+        Context manager to throttle and measure a call to CKAN
+        """
+        if self.throttle is None:
+            return nullcontext()
+        return self.throttle.measure()
+
+    def _call_action(self, name, context, data_dict):
+        """
+        Call a CKAN action, throttled if the latency of CKAN is too high
+        """
+        started = time.monotonic()
+        try:
+            with self._measure():
+                return get_action(name)(context, data_dict)
         finally:
-            Session.commit()
+            self._inc_metric("stadtzhharvest_action_calls_total", action=name)
+            self._observe_metric(
+                "stadtzhharvest_action_duration_seconds",
+                time.monotonic() - started,
+                action=name,
+            )
+
+    def _save_checkpoint(self, harvest_object, result):
+        if self.checkpoints is None or not self.config["resume_jobs"]:
+            return
+        content = decode_content(harvest_object.content)
+        if "datasetFolder" not in content:
+            # objects to delete datasets are not checkpointed
+            return
+        self.checkpoints.finish(
+            harvest_object.job.source_id,
+            content["datasetFolder"],
+            checkpoint.IMPORTED if result else checkpoint.FAILED,
+        )
+
+    def _get_new_resources(self, package_dict):
+        """
+        Return the resources found in the gather stage with their metadata
+        """
+        resource_metadata = package_dict.pop("resource_metadata", {})
+        new_resources = package_dict.pop("resource_manifest", None)
+        if new_resources is None:
+            # harvest object gathered without resources
+            new_resources = self._generate_resources_from_folder(
+                package_dict["datasetFolder"]
+            )
+        for resource in new_resources:
+            if resource["name"] in resource_metadata:
+                resource.update(resource_metadata[resource["name"]])
+        return new_resources
 
     def _import_package(self, harvest_object):
-        package_dict = json.loads(harvest_object.content)
+        package_dict = self._get_package_dict(harvest_object)
+        attribute_hints = package_dict.pop("attribute_hints", {})
         package_dict["id"] = harvest_object.guid
         package_dict["name"] = munge_title_to_name(package_dict["datasetID"])
         context = stadtzhharvest_create_new_context()
+        context["defer_commit"] = True
 
         # check if dataset must be deleted
         import_action = package_dict.pop("import_action", "update")
         if import_action == "delete":
             harvest_object.current = False
+            self._dataset_changed = True
             return self._delete_dataset(package_dict)
 
         # check if package already exists and
         existing_package = self._get_existing_package(package_dict)
 
-        # get metadata for resources
-        resource_metadata = package_dict.pop("resource_metadata", {})
-        new_resources = self._generate_resources_from_folder(
-            package_dict["datasetFolder"]
-        )
-        for resource in new_resources:
-            if resource["name"] in resource_metadata:
-                resource.update(resource_metadata[resource["name"]])
+        new_resources = self._get_new_resources(package_dict)
 
         # set the actions to do with the resources after the package is
         # updated or created
         actions, resources_changed = self._resources_actions(
             existing_package, new_resources
         )
+        self._dataset_changed = resources_changed
 
         if existing_package and "resources" in existing_package:
             package_dict["resources"] = existing_package["resources"]
@@ -300,10 +1356,13 @@ class StadtzhHarvester(HarvesterBase):
             schema_context = stadtzhharvest_create_new_context()
             schema_context["ignore_auth"] = True
             schema_context["schema"] = package_schema
+            schema_context["defer_commit"] = True
             today = datetime.datetime.now().strftime("%d.%m.%Y")
             try:
-                get_action("package_patch")(
-                    schema_context, {"id": dataset_id, "dateLastUpdated": today}
+                self._call_action(
+                    "package_patch",
+                    schema_context,
+                    {"id": dataset_id, "dateLastUpdated": today},
                 )
             except p.toolkit.ValidationError as e:
                 self._save_object_error(
@@ -320,30 +1379,75 @@ class StadtzhHarvester(HarvesterBase):
             )
 
         # handle all resources (create, update, delete)
-        resource_ids = self._import_resources(actions, package_dict, harvest_object)
+        resource_ids, deleted_ids = self._import_resources(
+            actions, package_dict, harvest_object
+        )
         ordered_resource_ids = _keep_order_of_existing_resources(
             package_dict, resource_ids
         )
-        reorder = {"id": str(package_dict["id"]), "order": ordered_resource_ids}
-        tk.get_action("package_resource_reorder")(context.copy(), data_dict=reorder)
-        Session.commit()
+        self._save_resource_list(
+            package_dict["id"], ordered_resource_ids, deleted_ids, context
+        )
+        self._queue_datastore_loads(actions, resource_ids, attribute_hints)
         return True
 
+    def _get_package_dict(self, harvest_object):
+        """
+        Return the package dict stored in the content of the harvest object
+        """
+        package_dict = decode_content(harvest_object.content)
+        if "sszFields" in package_dict and not isinstance(
+            package_dict["sszFields"], str
+        ):
+            # the attributes are stored as list in the harvest object, but
+            # the dataset expects a JSON string
+            package_dict["sszFields"] = json.dumps(package_dict["sszFields"])
+        return package_dict
+
     def _delete_dataset(self, package_dict):
         context = stadtzhharvest_create_new_context()
-        get_action("dataset_purge")(context.copy(), package_dict)
+        self._call_action("dataset_purge", context.copy(), package_dict)
         return True
 
     def _get_existing_package(self, package_dict):
-        context = stadtzhharvest_create_new_context()
-        try:
-            existing_package = get_action("package_show")(
-                context, {"id": package_dict["id"]}
+        """
+        Return the id, name and resources of the existing package or None.
+        The package and its resources are read with a single query from the
+        model instead of calling package_show, which validates the whole
+        package, runs all after_show hooks and might hit Solr.
+        """
+        package_ref = package_dict["id"]
+        rows = (
+            model.Session.query(model.Package, model.Resource)
+            .outerjoin(
+                model.Resource,
+                and_(
+                    model.Resource.package_id == model.Package.id,
+                    model.Resource.state == "active",
+                ),
             )
-        except NotFound:
-            existing_package = None
+            .filter(
+                or_(model.Package.id == package_ref, model.Package.name == package_ref)
+            )
+            .order_by(model.Resource.position)
+            .all()
+        )
+        if not rows:
             log.debug("Could not find pkg %s" % package_dict["name"])
-        return existing_package
+            return None
+
+        # like package_show, prefer a match on the id over a match on the name
+        package = next((pkg for pkg, _ in rows if pkg.id == package_ref), rows[0][0])
+        context = {"model": model, "session": model.Session}
+        return {
+            "id": package.id,
+            "name": package.name,
+            "resources": [
+                model_dictize.resource_dictize(resource, context)
+                for pkg, resource in rows
+                if resource is not None and pkg.id == package.id
+            ],
+        }
 
     def _get_existing_packages_names(self, harvest_job):
         context = stadtzhharvest_create_new_context()
@@ -388,6 +1492,12 @@ class StadtzhHarvester(HarvesterBase):
                 )
         else:
             old_resources = existing_package["resources"]
+            # index the old resources by name, if several resources share the
+            # same name, the first one is used
+            old_resources_by_name = {}
+            for old in old_resources:
+                old_resources_by_name.setdefault(old["name"], old)
+
             for r in new_resources:
                 action = {
                     "action": "create",
@@ -395,25 +1505,20 @@ class StadtzhHarvester(HarvesterBase):
                     "old_resource": None,
                     "res_name": r["name"],
                 }
-                for old in old_resources:
-                    if old["name"] == r["name"]:
-                        action["action"] = "update"
-                        action["old_resource"] = old
-
-                        # check if the resource changed
-                        if (
-                            r.get("zh_hash")
-                            and old.get("zh_hash")
-                            and r["zh_hash"] != old["zh_hash"]
-                        ):
-                            resources_changed = True
-                        break
+                old = old_resources_by_name.get(r["name"])
+                if old is not None:
+                    action["action"] = "update"
+                    action["old_resource"] = old
+                    if _resource_hash_changed(r, old):
+                        resources_changed = True
                 actions.append(action)
 
+            # delete old resources that have no action yet (only the first
+            # resource with a given name is deleted)
+            handled_names = set(r["name"] for r in new_resources)
             for old in old_resources:
-                if not [
-                    action for action in actions if action["res_name"] == old["name"]
-                ]:
+                if old["name"] not in handled_names:
+                    handled_names.add(old["name"])
                     actions.append(
                         {
                             "action": "delete",
@@ -424,80 +1529,229 @@ class StadtzhHarvester(HarvesterBase):
         return (actions, resources_changed)
 
     def _import_resources(self, actions, package_dict, harvest_object):
+        """
+        Run all resource actions, returns the ids of the created or updated
+        resources and the ids of the resources to delete
+        """
         actions.sort(key=_sort_new_resources_by_name)
+        actions = self._stage_uploads(actions, package_dict, harvest_object)
+
         resource_ids = []
+        deleted_ids = []
         context = stadtzhharvest_create_new_context()
+        context["defer_commit"] = True
         for action in actions:
-            res_name = action["res_name"]
             try:
-                resource_id = None
-                log.debug("Resource %s, action: %s" % (res_name, action))
-                if action["action"] == "create":
-                    resource = dict(action["new_resource"])
-                    resource["package_id"] = package_dict["id"]
-                    resource_id = get_action("resource_create")(
-                        context.copy(), resource
-                    )["id"]
-                    resource_ids.append(resource_id)
-                    log.debug("Dataset resource `%s` has been created" % resource_id)
-
-                elif action["action"] == "update":
-                    resource = dict(action["old_resource"])
-                    resource["package_id"] = package_dict["id"]
-
-                    if "upload" in action["new_resource"]:
-                        # if the resource is an upload, replace the file
-                        resource["upload"] = action["new_resource"]["upload"]
-                    elif action["new_resource"]["resource_type"] == "api":
-                        # for APIs, update the URL
-                        resource["url"] = action["new_resource"]["url"]
-
-                    # update fields from new resource
-                    resource["description"] = action["new_resource"].get("description")
-                    resource["format"] = action["new_resource"].get("format")
-                    resource["zh_hash"] = action["new_resource"].get("zh_hash")
-
-                    log.debug("Trying to update resource: %s" % resource)
-                    resource_id = get_action("resource_update")(
-                        context.copy(), resource
-                    )["id"]
+                # run each action in a savepoint, so that a failing resource
+                # does not roll back the rest of the import
+                with savepoint():
+                    resource_id = self._import_resource(action, package_dict, context)
+                if action["action"] == "delete":
+                    deleted_ids.append(action["old_resource"]["id"])
+                elif resource_id:
                     resource_ids.append(resource_id)
-                    log.debug("Dataset resource `%s` has been updated" % resource_id)
+                self._inc_metric(
+                    "stadtzhharvest_resources_total", action=_metrics_action(action)
+                )
+            except Exception as e:
+                self._save_resource_error(action, package_dict, harvest_object, e)
+                continue
+        return (resource_ids, deleted_ids)
 
-                elif action["action"] == "delete":
-                    replace_upload = get_action("resource_patch")(
-                        context.copy(),
-                        {
-                            "id": action["old_resource"]["id"],
-                            "url": FILE_NOT_FOUND_URL,
-                            "clear_upload": "true",
-                        },
-                    )
-                    log.debug("Dataset resource has been cleared: %s" % replace_upload)
+    def _stage_uploads(self, actions, package_dict, harvest_object):
+        """
+        Copy the files of all new and changed resources to the storage
+        (concurrently if `upload_workers` is greater than 1), so that only
+        the metadata of the resources must be saved afterwards. Returns the
+        actions whose files could be staged (and all actions without upload)
+        in the same order. Raises ResourceFileChanged if a file changed since
+        the gather stage: all files are checked before the first upload, and
+        the files of new resources staged so far are removed again if a
+        file changes during the upload.
+        """
+        uploads = []
+        for action in actions:
+            path = action.get("new_resource", {}).pop("path", None)
+            if path and _file_changed(action):
+                path = os.path.join(self.config["data_path"], path)
+                action["file_path"] = path
+                if self.prefetcher:
+                    self.prefetcher.wait(path)
+                uploads.append((action, path))
+
+        _check_files_unchanged(uploads)
+        with ThreadPoolExecutor(max_workers=self.config["upload_workers"]) as pool:
+            futures = [
+                (
+                    action,
+                    pool.submit(_stage_upload, action, path, self.spool, self.dry_run),
+                )
+                for action, path in uploads
+            ]
 
-                    result = get_action("resource_delete")(
-                        context.copy(), {"id": action["old_resource"]["id"]}
-                    )
-                    log.debug("Dataset resource has been deleted: %s" % result)
+        failed = []
+        changed = []
+        for action, future in futures:
+            try:
+                future.result()
+                self._inc_metric(
+                    "stadtzhharvest_bytes_uploaded_total",
+                    action["new_resource"].get("size", 0),
+                )
+            except ResourceFileChanged as e:
+                changed.append(e)
+            except Exception as e:
+                self._save_resource_error(action, package_dict, harvest_object, e)
+                failed.append(action)
+        if changed:
+            self._discard_staged_uploads(uploads)
+            raise changed[0]
+        return [action for action in actions if action not in failed]
+
+    def _discard_staged_uploads(self, uploads):
+        """
+        Remove the staged files of new resources from the storage. The
+        files of updated resources have already replaced the previous files,
+        they are uploaded again in the next run as their hash differs.
+        """
+        for action, _ in uploads:
+            if action.get("staged") and action["action"] == "create":
+                self._clear_resource_file(action["new_resource"]["id"])
+
+    def _save_resource_error(self, action, package_dict, harvest_object, error):
+        self._save_object_error(
+            "Error while handling action %s for resource %s in pkg %s: %r %s"
+            % (
+                action,
+                action["res_name"],
+                package_dict["name"],
+                error,
+                traceback.format_exc(),
+            ),
+            harvest_object,
+            "Import",
+        )
 
-                else:
-                    raise ValueError("Unknown action, we should never reach this point")
+    def _import_resource(self, action, package_dict, context):
+        """
+        Create, update or delete a single resource according to the given
+        action, returns the id of the created or updated resource
+        """
+        res_name = action["res_name"]
+        log.debug("Resource %s, action: %s" % (res_name, action))
+        if action["action"] == "create":
+            resource = dict(action["new_resource"])
+            resource["package_id"] = package_dict["id"]
+            resource_id = self._call_action(
+                "resource_create", context.copy(), resource
+            )["id"]
+            log.debug("Dataset resource `%s` has been created" % resource_id)
+            return resource_id
+
+        elif action["action"] == "update":
+            resource = dict(action["old_resource"])
+            resource["package_id"] = package_dict["id"]
+
+            if action.get("staged"):
+                # the file has already been replaced in _stage_uploads
+                for key in STAGED_UPLOAD_FIELDS:
+                    if key in action["new_resource"]:
+                        resource[key] = action["new_resource"][key]
+            elif action["new_resource"]["resource_type"] == "api":
+                # for APIs, update the URL
+                resource["url"] = action["new_resource"]["url"]
+
+            # the size, modification time and etag are only updated if the
+            # file changed
+            for key in FILE_FIELDS:
+                if key in action["new_resource"] and (
+                    action.get("staged") or not resource.get(key)
+                ):
+                    resource[key] = action["new_resource"][key]
+
+            # update fields from new resource
+            resource["description"] = action["new_resource"].get("description")
+            resource["format"] = action["new_resource"].get("format")
+            resource["zh_hash"] = action["new_resource"].get("zh_hash")
+
+            log.debug("Trying to update resource: %s" % resource)
+            resource_id = self._call_action(
+                "resource_update", context.copy(), resource
+            )["id"]
+            log.debug("Dataset resource `%s` has been updated" % resource_id)
+            return resource_id
+
+        elif action["action"] == "delete":
+            # only clear the resource here, the resource itself is deleted
+            # together with all other deleted resources of the package in
+            # _save_resource_list
+            self._clear_resource(action["old_resource"])
+            return None
 
-            except Exception as e:
-                self._save_object_error(
-                    "Error while handling action %s for resource %s in pkg %s: %r %s"
-                    % (
-                        action,
-                        res_name,
-                        package_dict["name"],
-                        e,
-                        traceback.format_exc(),
-                    ),
-                    harvest_object,
-                    "Import",
-                )
-                continue
-        return resource_ids
+        raise ValueError("Unknown action, we should never reach this point")
+
+    def _clear_resource(self, resource):
+        """
+        Remove the uploaded file of a resource from the storage and point
+        its URL to FILE_NOT_FOUND_URL, without updating the package
+        """
+        if resource.get("url_type") == "upload":
+            self._clear_resource_file(resource["id"])
+
+        resource_obj = model.Resource.get(resource["id"])
+        resource_obj.url = FILE_NOT_FOUND_URL
+        resource_obj.url_type = ""
+        log.debug("Dataset resource %s has been cleared" % resource["id"])
+
+    def _clear_resource_file(self, resource_id):
+        """Remove the uploaded file of a resource from the storage"""
+        if self.dry_run:
+            return
+        upload = uploader.get_resource_uploader(
+            {"url": FILE_NOT_FOUND_URL, "clear_upload": True}
+        )
+        upload.upload(resource_id, uploader.get_max_resource_size())
+
+    def _save_resource_list(self, package_id, order, deleted_ids, context):
+        """
+        Delete the given resources and reorder the remaining resources of
+        the package directly on the model, instead of a package_show and a
+        package_update of the whole package. The package is reindexed when
+        the import is committed.
+        """
+        package = model.Package.get(package_id)
+        context = dict(context, model=model, session=Session, package=package)
+        deleted_ids = set(deleted_ids)
+        deleted = [r for r in package.resources if r.id in deleted_ids]
+        resources = [r for r in package.resources if r.id not in deleted_ids]
+        resource_dicts = [model_dictize.resource_dictize(r, context) for r in resources]
+        for resource in deleted:
+            resource_dict = model_dictize.resource_dictize(resource, context)
+            for plugin in p.PluginImplementations(p.IResourceController):
+                plugin.before_resource_delete(context, resource_dict, resource_dicts)
+            resource.state = "deleted"
+
+        # same as package_resource_reorder: the ordered resources first,
+        # followed by all other resources in their current order
+        positions = dict((id, i) for i, id in enumerate(order))
+        resources.sort(key=lambda r: positions.get(r.id, len(order)))
+        changed = bool(deleted)
+        for position, resource in enumerate(resources):
+            if resource.position != position:
+                resource.position = position
+                changed = True
+        if not changed:
+            return
+        package.metadata_modified = datetime.datetime.utcnow()
+        Session.flush()
+
+        if deleted:
+            resource_dicts = [
+                model_dictize.resource_dictize(r, context) for r in resources
+            ]
+            for plugin in p.PluginImplementations(p.IResourceController):
+                plugin.after_resource_delete(context, resource_dicts)
+            log.debug("Deleted %d resources of dataset %s" % (len(deleted), package_id))
 
     def _create_package(self, dataset, harvest_object):
         theme_plugin = StadtzhThemePlugin()
@@ -515,6 +1769,7 @@ class StadtzhHarvester(HarvesterBase):
             "user": site_user["name"],
             "return_id_only": True,
             "ignore_auth": True,
+            "defer_commit": True,
             "schema": package_schema,
         }
 
@@ -533,7 +1788,7 @@ class StadtzhHarvester(HarvesterBase):
         model.Session.flush()
 
         try:
-            p.toolkit.get_action("package_create")(context, dataset)
+            self._call_action("package_create", context, dataset)
         except p.toolkit.ValidationError as e:
             self._save_object_error(
                 "Create validation Error: %s" % str(e.error_summary),
@@ -544,8 +1799,6 @@ class StadtzhHarvester(HarvesterBase):
 
         log.info("Created dataset %s", dataset["name"])
 
-        model.Session.commit()
-
         return dataset["id"]
 
     def _update_package(self, dataset, harvest_object):
@@ -588,10 +1841,11 @@ class StadtzhHarvester(HarvesterBase):
                 "user": site_user["name"],
                 "return_id_only": True,
                 "ignore_auth": True,
+                "defer_commit": True,
                 "schema": theme_plugin.update_package_schema(),
             }
             try:
-                get_action("package_update")(context, dataset)
+                self._call_action("package_update", context, dataset)
             except p.toolkit.ValidationError as e:
                 self._save_object_error(
                     "Update validation Error: %s" % str(e.error_summary),
@@ -606,37 +1860,50 @@ class StadtzhHarvester(HarvesterBase):
                 "config is set to `false`" % dataset["name"]
             )
 
-        model.Session.commit()
         return dataset["id"]
 
-    def _save_harvest_object(self, metadata, harvest_job):
+    def _save_harvest_object(self, metadata, harvest_job, extras=None):
         """
         Save the harvest object with the given metadata dict and harvest_job
         """
 
         obj = HarvestObject(
-            guid=metadata["datasetID"], job=harvest_job, content=json.dumps(metadata)
+            guid=metadata["datasetID"],
+            job=harvest_job,
+            content=encode_content(metadata, self.config["compress_content_threshold"]),
+            extras=[
+                HarvestObjectExtra(key=key, value=str(value))
+                for key, value in (extras or {}).items()
+            ],
         )
         obj.save()
         log.debug("adding " + metadata["datasetID"] + " to the queue")
 
         return obj.id
 
-    def _dropzone_get_groups(self, dataset_node):
+    def _dropzone_get_group_titles(self, dataset_node):
         """
-        Get the groups from the node, normalize them and get the names.
+        Get the titles of the groups from the node.
         """
         categories = self._get(dataset_node, "kategorie")
         if categories:
-            group_titles = categories.split(", ")
-            groups = []
-            for title in group_titles:
-                name = munge_title_to_name(title)
-                groups.append((name, title))
-            return stadtzhharvest_get_group_names(groups)
+            return categories.split(", ")
         else:
             return []
 
+    def _dropzone_get_groups(self, group_titles):
+        """
+        Normalize the group titles and get the names, missing groups are
+        created.
+        """
+        if not group_titles:
+            return []
+        groups = []
+        for title in group_titles:
+            name = munge_title_to_name(title)
+            groups.append((name, title))
+        return stadtzhharvest_get_group_names(groups)
+
     def _dropzone_get_metadata(self, dataset_id, dataset_folder, dataset_node):
         """
         For the given dataset node return the metadata dict.
@@ -653,7 +1920,7 @@ class StadtzhHarvester(HarvesterBase):
             "maintainer_email": "opendata@zuerich.ch",
             "license_id": self._get(dataset_node, "lizenz", default="cc-zero"),
             "tags": self._generate_tags(dataset_node),
-            "groups": self._dropzone_get_groups(dataset_node),
+            "group_titles": self._dropzone_get_group_titles(dataset_node),
             "spatialRelationship": self._get(dataset_node, "raeumliche_beziehung"),
             "dateFirstPublished": self._get(
                 dataset_node, "erstmalige_veroeffentlichung"
@@ -665,9 +1932,8 @@ class StadtzhHarvester(HarvesterBase):
             "version": self._get(dataset_node, "aktuelle_version"),
             "timeRange": self._get(dataset_node, "zeitraum"),
             "sszBemerkungen": self._convert_comments(dataset_node),
-            "sszFields": self._json_encode_attributes(
-                self._get_attributes(dataset_node)
-            ),
+            "sszFields": self._filter_attributes(self._get_attributes(dataset_node)),
+            "attribute_hints": self._get_attribute_hints(dataset_node),
             "dataQuality": self._get(dataset_node, "datenqualitaet"),
         }
 
@@ -690,11 +1956,14 @@ class StadtzhHarvester(HarvesterBase):
 
     def _remove_hidden_files(self, file_list):
         """
-        Removes dotfiles from a list of files
+        Removes dotfiles and temporary files from a list of files
         """
         cleaned_file_list = []
         for file in file_list:
-            if not file.startswith("."):
+            if not any(
+                fnmatch.fnmatchcase(file.lower(), pattern)
+                for pattern in IGNORED_FILE_PATTERNS
+            ):
                 cleaned_file_list.append(file)
         return cleaned_file_list
 
@@ -751,86 +2020,103 @@ class StadtzhHarvester(HarvesterBase):
 
     def _generate_resources_from_folder(self, dataset):
         """
-        Given a dataset folder, it'll return a list of resource metadata
+        Given a dataset folder, it'll return a list of resource metadata.
+        The files are not opened for upload, instead their path (relative to
+        the data_path) is stored on the resource. The files are hashed
+        concurrently by `hash_workers` threads.
         """
-        resources = []
+        folder = os.path.join(dataset, self.config["metafile_dir"])
+        folder_path = os.path.join(self.config["data_path"], folder)
         file_list = [
             f
-            for f in os.listdir(
-                os.path.join(
-                    self.config["data_path"], dataset, self.config["metafile_dir"]
-                )
-            )
-            if os.path.isfile(
-                os.path.join(
-                    self.config["data_path"], dataset, self.config["metafile_dir"], f
-                )
-            )
+            for f in os.listdir(folder_path)
+            if os.path.isfile(os.path.join(folder_path, f))
         ]
         resource_files = self._remove_hidden_files(file_list)
         log.debug(resource_files)
 
-        # for resource_file in resource_files:
-        for resource_file in (x for x in resource_files if x != "meta.xml"):
-            resource_path = os.path.join(
-                self.config["data_path"],
-                dataset,
-                self.config["metafile_dir"],
-                resource_file,
-            )
-            if resource_file == "link.xml":
-                with retry_open_file(resource_path, "r") as links_xml:
-                    links = etree.parse(links_xml).findall("link")
-
-                    for link in links:
-                        url = self._get(link, "url")
-                        if url:
-                            # generate hash for URL
-                            md5 = hashlib.md5()
-                            md5.update(url.encode("utf-8"))
-                            resources.append(
-                                {
-                                    "url": url,
-                                    "zh_hash": md5.hexdigest(),
-                                    "name": self._get(link, "lable"),
-                                    "description": self._get(link, "description"),
-                                    "format": self._get(link, "type"),
-                                    "resource_type": "api",
-                                }
-                            )
-            else:
-                resource_file = self._validate_filename(resource_file)
-                if resource_file:
-                    resource_dict = {
-                        "name": resource_file,
-                        "url": "",
-                        "description": "",
-                        "url_type": "upload",
-                        "format": resource_file.split(".")[-1],
-                        "resource_type": "file",
-                    }
-
-                    # calculate the hash of this file
-                    BUF_SIZE = 65536  # lets read stuff in 64kb chunks!
-                    md5 = hashlib.md5()
-                    with retry_open_file(resource_path, "rb") as f:
-                        while True:
-                            data = f.read(BUF_SIZE)
-                            if not data:
-                                break
-                            md5.update(data)
-                        resource_dict["zh_hash"] = md5.hexdigest()
-
-                    # add file to FieldStorage
-                    with retry_open_file(resource_path, "rb", close=False) as f:
-                        field_storage = FlaskFileStorage(f, f.name)
-                        resource_dict["upload"] = field_storage
+        # collect the resources in the order of the files (not in the order
+        # the hashes complete): the sort below keeps the input order of
+        # resources with the same format (and of unknown formats)
+        entries = []
+        with ThreadPoolExecutor(max_workers=self.config["hash_workers"]) as pool:
+            for resource_file in (x for x in resource_files if x != "meta.xml"):
+                if resource_file == "link.xml":
+                    entries.append(
+                        self._get_link_resources(
+                            os.path.join(folder_path, resource_file)
+                        )
+                    )
+                elif self._validate_filename(resource_file):
+                    entries.append(
+                        pool.submit(self._get_file_resource, folder, resource_file)
+                    )
 
-                    resources.append(resource_dict)
+        resources = []
+        for entry in entries:
+            if isinstance(entry, list):
+                resources.extend(entry)
+            else:
+                resources.append(entry.result())
 
         sorted_resources = sorted(resources, key=cmp_to_key(self._sort_resource))
         return sorted_resources
 
+    def _get_link_resources(self, link_xml_path):
+        """
+        Return the metadata of the resources in a link.xml
+        """
+        resources = []
+        with retry_open_file(link_xml_path, "r") as links_xml:
+            links = etree.parse(links_xml).findall("link")
+
+            for link in links:
+                url = self._get(link, "url")
+                if url:
+                    # generate hash for URL
+                    md5 = hashlib.md5()
+                    md5.update(url.encode("utf-8"))
+                    resources.append(
+                        {
+                            "url": url,
+                            "zh_hash": md5.hexdigest(),
+                            "name": self._get(link, "lable"),
+                            "description": self._get(link, "description"),
+                            "format": self._get(link, "type"),
+                            "resource_type": "api",
+                        }
+                    )
+        return resources
+
+    def _get_file_resource(self, folder, resource_file):
+        """
+        Return the metadata of a resource file, including its hash
+        """
+        resource_dict = {
+            "name": resource_file,
+            "url": "",
+            "description": "",
+            "url_type": "upload",
+            "format": resource_file.split(".")[-1],
+            "resource_type": "file",
+            "path": os.path.join(folder, resource_file),
+        }
+
+        # calculate the hash of this file
+        BUF_SIZE = 65536  # lets read stuff in 64kb chunks!
+        md5 = hashlib.md5()
+        resource_path = os.path.join(self.config["data_path"], folder, resource_file)
+        with _open_resource_file(resource_path, self.spool) as f:
+            while True:
+                data = f.read(BUF_SIZE)
+                if not data:
+                    break
+                md5.update(data)
+            resource_dict["zh_hash"] = md5.hexdigest()
+            self._inc_metric("stadtzhharvest_bytes_hashed_total", f.tell())
+            resource_dict.update(_file_fields(f, resource_dict["zh_hash"]))
+        return resource_dict
+
     def _node_exists_and_is_nonempty(self, dataset_node, element_name):
         element = dataset_node.find(element_name)
         if element is None or element.text is None:
@@ -861,13 +2147,13 @@ class StadtzhHarvester(HarvesterBase):
                     markdown += "[" + label + "](" + url + ")\n\n"
             return markdown
 
-    def _json_encode_attributes(self, properties):
+    def _filter_attributes(self, properties):
         attributes = []
         for key, value in properties:
             if value:
                 attributes.append((key, value))
 
-        return json.dumps(attributes)
+        return attributes
 
     def _get_attributes(self, node):
         attribut_list = node.find("attributliste")
@@ -884,14 +2170,91 @@ class StadtzhHarvester(HarvesterBase):
             attributes.append((attribute_name, attribut.find("feldbeschreibung").text))
         return attributes
 
+    def _get_attribute_hints(self, node):
+        """
+        Return the types of the fields hinted at by the attributliste, by
+        technical and speaking name of the field
+        """
+        hints = {}
+        attribut_list = node.find("attributliste")
+        if attribut_list is None:
+            return hints
+        for attribut in attribut_list:
+            speak_name = self._get(attribut, "sprechenderfeldname")
+            hint = attribute_hint(speak_name, self._get(attribut, "feldbeschreibung"))
+            if hint:
+                for name in (attribut.get("technischerfeldname"), speak_name):
+                    if name:
+                        hints[name] = hint
+        return hints
+
     def _diff_path(self, package_id):
         today = datetime.date.today()
         if package_id:
             return os.path.join(self.DIFF_PATH, "%s-%s.html" % (str(today), package_id))
 
-    def _check_for_deleted_datasets(self, harvest_job, gathered_dataset_names):
+    def _check_for_deleted_datasets(self, harvest_job, gathered_dataset_names, folders):
+        existing_packages_names = self._get_packages_in_scope(harvest_job, folders)
+        delete_names = sorted(
+            set(existing_packages_names) - set(gathered_dataset_names)
+        )
+        return self._delete_datasets(harvest_job, delete_names, existing_packages_names)
+
+    def _check_for_deleted_folders(self, harvest_job, missing_folders):
+        """
+        Delete the datasets of the given folders, which no longer exist in
+        the dropzone. Only datasets of this source are deleted.
+        """
+        folders = self._remove_hidden_files(os.listdir(self.config["data_path"]))
+        existing_packages_names = self._get_packages_in_scope(harvest_job, folders)
+        missing_names = set(
+            self._validate_package_id("%s%s" % (self.config["dataset_prefix"], folder))
+            for folder in missing_folders
+        )
+        delete_names = sorted(set(existing_packages_names) & missing_names)
+        return self._delete_datasets(harvest_job, delete_names, existing_packages_names)
+
+    def _get_packages_in_scope(self, harvest_job, folders):
+        """
+        Return the names of the packages of this source in the scope of the
+        folder patterns and the shard
+        """
         existing_packages_names = self._get_existing_packages_names(harvest_job)
-        delete_names = list(set(existing_packages_names) - set(gathered_dataset_names))
+        package_folders = self._get_package_folders(existing_packages_names, folders)
+        return [
+            name
+            for name in existing_packages_names
+            if self._package_in_scope(name, package_folders.get(name))
+        ]
+
+    def _delete_datasets(self, harvest_job, delete_names, existing_packages_names):
+        """
+        Delete the given packages (or create the harvest objects to delete
+        them), unless this exceeds the `max_delete_fraction` of the existing
+        packages. Returns the ids of the created harvest objects.
+        """
+        if not delete_names:
+            return []
+
+        # safety net, e.g. if a dropzone is only partially mounted
+        delete_fraction = len(delete_names) / float(len(existing_packages_names))
+        if delete_fraction > self.config["max_delete_fraction"]:
+            self._save_gather_error(
+                "Not deleting %d of %d datasets: this exceeds the "
+                "max_delete_fraction of %s"
+                % (
+                    len(delete_names),
+                    len(existing_packages_names),
+                    self.config["max_delete_fraction"],
+                ),
+                harvest_job,
+            )
+            return []
+
+        if self.config["delete_batch_size"]:
+            self._purge_datasets(delete_names, harvest_job)
+            return []
+
         # gather delete harvest ids
         delete_ids = []
 
@@ -906,6 +2269,54 @@ class StadtzhHarvester(HarvesterBase):
                 delete_ids.append(id)
         return delete_ids
 
+    def _purge_datasets(self, package_names, harvest_job):
+        """
+        Purge the given datasets in batches of `delete_batch_size`, each
+        batch is purged in one transaction and removed from the search index
+        with a single delete query
+        """
+        batch_size = self.config["delete_batch_size"]
+        for i in range(0, len(package_names), batch_size):
+            batch = package_names[i : i + batch_size]
+            try:
+                package_ids = self._purge_batch(batch, harvest_job)
+                model.Session.commit()
+                delete_from_search_index(package_ids)
+            except Exception as e:
+                log.exception(e)
+                model.Session.rollback()
+                self._save_gather_error(
+                    "Could not delete datasets %s: %r / %s"
+                    % (batch, e, traceback.format_exc()),
+                    harvest_job,
+                )
+
+    def _purge_batch(self, package_names, harvest_job):
+        packages = (
+            model.Session.query(model.Package.id, model.Package.name)
+            .filter(model.Package.name.in_(package_names))
+            .all()
+        )
+        if not packages:
+            return []
+        purge_packages([id for id, _ in packages])
+
+        for _, package_name in packages:
+            log.info("Purge dataset `%s`", package_name)
+            # add a completed harvest object, so that the deletion shows up
+            # in the report of the harvest job
+            HarvestObject(
+                guid=package_name,
+                job=harvest_job,
+                content=json.dumps(
+                    {"datasetID": package_name, "import_action": "delete"}
+                ),
+                state="COMPLETE",
+                report_status="deleted",
+                current=False,
+            ).add()
+        return [id for id, _ in packages]
+
     def _find_or_create_organization(self, package_dict, context):
         # Find or create the organization the dataset should get assigned to.
         try:
@@ -949,20 +2360,128 @@ class StadtzhHarvester(HarvesterBase):
             return filename
 
 
+def _open_resource_file(path, spool=None):
+    """open a resource file for reading, from the spool if there is one"""
+    if spool:
+        return spool.open(path)
+    return retry_open_file(path, "rb")
+
+
+def _stage_upload(action, path, spool=None, dry_run=False):
+    """
+    Copy the file of a resource action to the storage and update the new
+    resource with the fields set by the uploader (in a dry run, the file is
+    not copied).
+    New resources get their id here, as the storage path depends on it.
+    """
+    if action["action"] == "create":
+        resource_id = str(uuid.uuid4())
+    else:
+        resource_id = action["old_resource"]["id"]
+    resource = dict(action["new_resource"])
+    with _open_resource_file(path, spool) as f:
+        _check_file_unchanged(os.fstat(f.fileno()), resource)
+        resource["upload"] = FlaskFileStorage(f, path)
+        upload = uploader.get_resource_uploader(resource)
+        if not dry_run:
+            upload.upload(resource_id, uploader.get_max_resource_size())
+    if "last_modified" in action["new_resource"]:
+        # keep the modification time of the file instead of the upload time
+        resource["last_modified"] = action["new_resource"]["last_modified"]
+    if action["action"] == "create":
+        resource["id"] = resource_id
+    action["new_resource"] = resource
+    action["staged"] = True
+
+
+def _check_files_unchanged(uploads):
+    """
+    Raise ResourceFileChanged if any file of the given (action, path) tuples
+    changed since the gather stage
+    """
+    for action, path in uploads:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # reported as error of the resource when it is staged
+            continue
+        _check_file_unchanged(stat, action["new_resource"])
+
+
+def _check_file_unchanged(stat, resource):
+    """
+    Raise ResourceFileChanged if the size or modification time of a file
+    (as returned by os.stat) differs from the values found in the gather
+    stage
+    """
+    fields = _stat_fields(stat)
+    for field in ["size", "last_modified"]:
+        if field in resource and resource[field] != fields[field]:
+            raise ResourceFileChanged(
+                "The file of resource %s changed since the gather stage "
+                "(%s: %s, was %s)"
+                % (resource["name"], field, fields[field], resource[field])
+            )
+
+
+def _file_changed(action):
+    """check if the file of a resource must be uploaded"""
+    if action["action"] != "update":
+        return True
+    new_hash = action["new_resource"].get("zh_hash")
+    return not new_hash or new_hash != action["old_resource"].get("zh_hash")
+
+
+def _metrics_action(action):
+    """return the action of a resource action as reported in the metrics"""
+    if action["action"] == "update" and not _resource_hash_changed(
+        action["new_resource"], action["old_resource"]
+    ):
+        return "unchanged"
+    return action["action"]
+
+
+def _file_fields(f, zh_hash):
+    """
+    Return the size, modification time and an etag (based on the hash) of
+    an open file for the resource
+    """
+    return dict(_stat_fields(os.fstat(f.fileno())), etag='"%s"' % zh_hash)
+
+
+def _stat_fields(stat):
+    """return the size and modification time of a file for the resource"""
+    return {
+        "size": stat.st_size,
+        "last_modified": datetime.datetime.utcfromtimestamp(stat.st_mtime).isoformat(),
+    }
+
+
 def _keep_order_of_existing_resources(package_dict, resource_ids):
     """keep order of existing resources and put new resources
     at the end of the list"""
     existing_resource_ids = []
     if package_dict.get("resources"):
+        resource_id_set = set(resource_ids)
         existing_resource_ids = [
             resource["id"]
             for resource in package_dict["resources"]
-            if resource["id"] in resource_ids
+            if resource["id"] in resource_id_set
         ]
-    new_resource_ids = [id for id in resource_ids if id not in existing_resource_ids]
+    existing_resource_id_set = set(existing_resource_ids)
+    new_resource_ids = [id for id in resource_ids if id not in existing_resource_id_set]
     return existing_resource_ids + new_resource_ids
 
 
+def _resource_hash_changed(new_resource, old_resource):
+    """check if the hash of a resource changed"""
+    return bool(
+        new_resource.get("zh_hash")
+        and old_resource.get("zh_hash")
+        and new_resource["zh_hash"] != old_resource["zh_hash"]
+    )
+
+
 def _sort_new_resources_by_name(action):
     """order new resources by their name"""
     if action.get("new_resource"):
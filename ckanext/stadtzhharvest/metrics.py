@@ -0,0 +1,229 @@
+# coding: utf-8
+
+import logging
+import os
+import re
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+# name: (type, help) of all metrics
+METRICS = {
+    "stadtzhharvest_job_info": ("gauge", "Current harvest job of the source"),
+    "stadtzhharvest_datasets_gathered_total": (
+        "counter",
+        "Number of gathered datasets",
+    ),
+    "stadtzhharvest_datasets_deferred_total": (
+        "counter",
+        "Number of datasets deferred to the next run because of the quiet period",
+    ),
+    "stadtzhharvest_datasets_imported_total": (
+        "counter",
+        "Number of imported datasets by result",
+    ),
+    "stadtzhharvest_metadata_cache_total": (
+        "counter",
+        "Number of lookups in the metadata cache by result (hit, miss)",
+    ),
+    "stadtzhharvest_resources_total": (
+        "counter",
+        "Number of handled resources by action (create, update, unchanged, delete)",
+    ),
+    "stadtzhharvest_bytes_hashed_total": (
+        "counter",
+        "Number of bytes read to calculate the hashes of resource files",
+    ),
+    "stadtzhharvest_bytes_prefetched_total": (
+        "counter",
+        "Number of bytes read ahead from the resource files of upcoming datasets",
+    ),
+    "stadtzhharvest_bytes_uploaded_total": (
+        "counter",
+        "Number of bytes of uploaded resource files",
+    ),
+    "stadtzhharvest_datastore_loads_total": (
+        "counter",
+        "Number of CSV files loaded into the DataStore by result",
+    ),
+    "stadtzhharvest_action_calls_total": (
+        "counter",
+        "Number of CKAN action calls by action",
+    ),
+    "stadtzhharvest_action_duration_seconds": (
+        "histogram",
+        "Duration of CKAN action calls by action",
+    ),
+    "stadtzhharvest_gather_duration_seconds": (
+        "histogram",
+        "Duration of the gather stage",
+    ),
+    "stadtzhharvest_import_duration_seconds": (
+        "histogram",
+        "Duration of the import of a dataset",
+    ),
+}
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# name of the metrics files written by `HarvestMetrics.write`
+METRICS_FILE_PATTERN = re.compile(r"^stadtzhharvest_[a-z]+_(\d+)\.prom$")
+
+
+class HarvestMetrics(object):
+    """
+    Counters and histograms of the harvest jobs handled by this process,
+    labelled by harvest source.
+
+    The metrics of a source are reset when a new job of the source starts,
+    so they always describe the current (or last) job. They can be written
+    to a file for the textfile collector of the Prometheus node exporter.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._jobs = {}
+        self._values = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def start_job(self, source_id, job_id):
+        """
+        Reset the metrics of the source if the given job is a new one
+        """
+        with self._lock:
+            if self._jobs.get(source_id) == job_id:
+                return
+            self._jobs[source_id] = job_id
+            for series in (self._values, self._histograms):
+                for key in [k for k in series if dict(k[1])["source"] == source_id]:
+                    del series[key]
+        self.set("stadtzhharvest_job_info", 1, source=source_id, job=job_id)
+
+    def _key(self, name, labels):
+        if name not in METRICS:
+            raise ValueError("Unknown metric %s" % name)
+        return (name, tuple(sorted(labels.items())))
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[self._key(name, labels)] = value
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.setdefault(
+                key, {"buckets": [0] * len(self.buckets), "sum": 0, "count": 0}
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def get(self, name, **labels):
+        return self._values.get(self._key(name, labels), 0)
+
+    def render(self, **extra_labels):
+        """
+        Return all metrics in the Prometheus text format, the given labels
+        are added to all samples
+        """
+        extra_labels = tuple(sorted(extra_labels.items()))
+        lines = []
+        with self._lock:
+            for name, (metric_type, help_text) in sorted(METRICS.items()):
+                if metric_type == "histogram":
+                    samples = self._histogram_samples(name)
+                else:
+                    samples = [
+                        (name, labels, value)
+                        for (metric, labels), value in sorted(self._values.items())
+                        if metric == name
+                    ]
+                if not samples:
+                    continue
+                lines.append("# HELP %s %s" % (name, help_text))
+                lines.append("# TYPE %s %s" % (name, metric_type))
+                for sample_name, labels, value in samples:
+                    lines.append(
+                        "%s%s %s"
+                        % (sample_name, _format_labels(extra_labels + labels), value)
+                    )
+        return "\n".join(lines) + "\n"
+
+    def _histogram_samples(self, name):
+        samples = []
+        for (metric, labels), histogram in sorted(self._histograms.items()):
+            if metric != name:
+                continue
+            for bound, count in zip(self.buckets, histogram["buckets"]):
+                samples.append(
+                    (name + "_bucket", labels + (("le", repr(float(bound))),), count)
+                )
+            samples.append(
+                (name + "_bucket", labels + (("le", "+Inf"),), histogram["count"])
+            )
+            samples.append((name + "_sum", labels, histogram["sum"]))
+            samples.append((name + "_count", labels, histogram["count"]))
+        return samples
+
+    def write(self, directory, stage):
+        """
+        Write the metrics to `<directory>/stadtzhharvest_<stage>_<pid>.prom`.
+        The file is replaced atomically, so the collector never reads a
+        partially written file. All samples are labelled with the `pid` of
+        the process, as several workers may handle jobs of the same source,
+        and the files of exited processes are removed.
+        """
+        pid = os.getpid()
+        path = os.path.join(directory, "stadtzhharvest_%s_%d.prom" % (stage, pid))
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                f.write(self.render(pid=pid))
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+            remove_stale_files(directory)
+        except OSError as e:
+            log.warning("Could not write metrics to %s: %r" % (path, e))
+
+
+def remove_stale_files(directory):
+    """
+    Remove the metrics files of processes which no longer exist
+    """
+    for name in os.listdir(directory):
+        match = METRICS_FILE_PATTERN.match(name)
+        if match and not _process_exists(int(match.group(1))):
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                # removed by another process in the meantime
+                pass
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # the process exists, but belongs to another user
+        return True
+    return True
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in labels
+    )
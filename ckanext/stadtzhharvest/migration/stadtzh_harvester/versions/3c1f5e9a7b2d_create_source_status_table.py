@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+"""create source status table
+
+Revision ID: 3c1f5e9a7b2d
+Revises:
+Create Date: 2026-10-19 09:12:31.482051
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3c1f5e9a7b2d"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "stadtzhharvest_source_status",
+        sa.Column("source_id", sa.UnicodeText, primary_key=True),
+        sa.Column("job_id", sa.UnicodeText),
+        sa.Column("gather_started", sa.DateTime),
+        sa.Column("gather_finished", sa.DateTime),
+        sa.Column("gather_duration", sa.Float),
+        sa.Column("datasets_gathered", sa.Integer),
+        sa.Column("datasets_deferred", sa.Integer),
+        sa.Column("cache_hits", sa.Integer),
+        sa.Column("cache_misses", sa.Integer),
+        sa.Column("import_duration", sa.Float),
+        sa.Column("datasets_changed", sa.Integer),
+        sa.Column("datasets_unchanged", sa.Integer),
+        sa.Column("datasets_failed", sa.Integer),
+        sa.Column("last_import", sa.DateTime),
+        sa.Column("oldest_pending_change", sa.DateTime),
+    )
+
+
+def downgrade():
+    op.drop_table("stadtzhharvest_source_status")
@@ -0,0 +1,114 @@
+# coding: utf-8
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def read_file(path):
+    """
+    Read a file without keeping its content, so that it is cached by the
+    operating system (or the WebDAV mount). Returns the number of bytes read.
+    """
+    size = 0
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            size += len(data)
+    return size
+
+
+class Prefetcher(object):
+    """
+    Warms the files of upcoming datasets in background threads, so that
+    reading the dropzone overlaps with the writes to CKAN.
+
+    The files are scheduled per dataset (by a key, e.g. the id of the harvest
+    object) and `warm` is called for each file. The total size of the files
+    of all scheduled datasets which are not released yet is limited to
+    `budget` bytes, datasets exceeding the budget are not scheduled.
+    """
+
+    def __init__(self, warm=read_file, workers=2, budget=512 * 1024 * 1024):
+        self.warm = warm
+        self.budget = budget
+        self.pending_bytes = 0
+        self._datasets = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="stadtzhharvest-prefetch"
+        )
+
+    def is_scheduled(self, key):
+        return key in self._datasets
+
+    def schedule(self, key, files):
+        """
+        Schedule the given files (list of (path, size) tuples) of a dataset,
+        returns False if the dataset does not fit into the budget
+        """
+        with self._lock:
+            if key in self._datasets:
+                return True
+            size = sum(file_size for _, file_size in files)
+            if self.pending_bytes and self.pending_bytes + size > self.budget:
+                return False
+            self._datasets[key] = (files, size)
+            self.pending_bytes += size
+            for path, _ in files:
+                if path not in self._futures:
+                    self._futures[path] = self._pool.submit(self._warm, path)
+        log.debug("Prefetching %d files (%d bytes) of %s" % (len(files), size, key))
+        return True
+
+    def _warm(self, path):
+        try:
+            return self.warm(path)
+        except Exception as e:
+            # a failed prefetch is not an error, the file is read again
+            log.warning("Could not prefetch %s: %r" % (path, e))
+            return 0
+
+    def wait(self, path):
+        """
+        Wait until the prefetch of a file is done (or cancel it if it did
+        not start yet), so that the file is not read twice at the same time
+        """
+        with self._lock:
+            future = self._futures.pop(path, None)
+        if future is not None and not future.cancel():
+            future.result()
+
+    def release(self, key):
+        """
+        Release the files of a dataset after its import
+        """
+        with self._lock:
+            files, size = self._datasets.pop(key, ([], 0))
+            self.pending_bytes -= size
+            for path, _ in files:
+                future = self._futures.pop(path, None)
+                if future is not None:
+                    future.cancel()
+
+    def retain(self, keys):
+        """
+        Release all scheduled datasets except the given ones, e.g. the
+        datasets imported by other processes in the meantime
+        """
+        for key in [key for key in list(self._datasets) if key not in keys]:
+            self.release(key)
+
+    def reset(self):
+        """
+        Cancel and release all scheduled datasets
+        """
+        for key in list(self._datasets):
+            self.release(key)
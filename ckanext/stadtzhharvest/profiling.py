@@ -0,0 +1,137 @@
+# coding: utf-8
+
+import cProfile
+import io
+import logging
+import os
+import pstats
+import signal
+from collections import Counter
+from contextlib import contextmanager
+
+from ckan import model
+from ckan import plugins as p
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+
+class StackSampler(object):
+    """
+    Statistical profiler which samples the stack of the main thread on
+    every SIGPROF signal (i.e. every `interval` seconds of CPU time) and
+    counts the stacks in the collapsed format used by flamegraph.pl and
+    speedscope.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self._previous_handler = None
+
+    @staticmethod
+    def available():
+        return hasattr(signal, "setitimer") and hasattr(signal, "SIGPROF")
+
+    def start(self):
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(
+                "%s (%s:%d)"
+                % (
+                    code.co_name,
+                    os.path.basename(code.co_filename),
+                    code.co_firstlineno,
+                )
+            )
+            frame = frame.f_back
+        self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write("%s %d\n" % (stack, count))
+
+
+@contextmanager
+def profiled(output_prefix, interval=0.005, sort="cumulative"):
+    """
+    Profile the wrapped code with cProfile and the StackSampler and write
+    the results to `<output_prefix>.pstats` (binary stats, e.g. for
+    snakeviz), `<output_prefix>.txt` (stats sorted by `sort`) and
+    `<output_prefix>.collapsed` (collapsed stacks for flame graphs).
+    Yields the list of written files, which is filled at the end.
+    """
+    files = []
+    profiler = cProfile.Profile()
+    sampler = StackSampler(interval) if StackSampler.available() else None
+    if sampler is None:
+        log.warning("SIGPROF is not available, no collapsed stacks are written")
+
+    if sampler:
+        sampler.start()
+    profiler.enable()
+    try:
+        yield files
+    finally:
+        profiler.disable()
+        if sampler:
+            sampler.stop()
+
+        profiler.dump_stats(output_prefix + ".pstats")
+        files.append(output_prefix + ".pstats")
+
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats(sort).print_stats()
+        with open(output_prefix + ".txt", "w") as f:
+            f.write(stream.getvalue())
+        files.append(output_prefix + ".txt")
+
+        if sampler:
+            sampler.write(output_prefix + ".collapsed")
+            files.append(output_prefix + ".collapsed")
+
+
+@contextmanager
+def writes_disabled():
+    """
+    Run the wrapped code in a database transaction which is rolled back at
+    the end: the session is bound to a connection with an outer transaction,
+    so commits of the session only release a savepoint. The search index is
+    not updated. Files and other writes outside of the database are turned
+    off by `StadtzhHarvester.disable_writes`.
+    """
+    connection = model.meta.engine.connect()
+    transaction = connection.begin()
+    savepoints = [connection.begin_nested()]
+
+    def restart_savepoint(session, session_transaction):
+        # commits and rollbacks of the session end the savepoint
+        if not savepoints[-1].is_active:
+            savepoints.append(connection.begin_nested())
+
+    search_loaded = p.plugin_loaded("synchronous_search")
+    if search_loaded:
+        p.unload("synchronous_search")
+    model.Session.remove()
+    model.Session.configure(bind=connection)
+    event.listen(model.Session, "after_transaction_end", restart_savepoint)
+    try:
+        yield
+    finally:
+        event.remove(model.Session, "after_transaction_end", restart_savepoint)
+        model.Session.remove()
+        model.Session.configure(bind=model.meta.engine)
+        transaction.rollback()
+        connection.close()
+        if search_loaded:
+            p.load("synchronous_search")
@@ -0,0 +1,81 @@
+# coding: utf-8
+
+import logging
+
+from ckan import model
+from sqlalchemy import func
+
+from ckanext.harvest.model import (
+    HarvestJob,
+    HarvestObject,
+    HarvestObjectError,
+    HarvestObjectExtra,
+)
+
+log = logging.getLogger(__name__)
+
+GUID_CURRENT_INDEX = "harvest_object_guid_current_idx"
+
+
+def ensure_harvest_object_index():
+    """
+    Create an index for the lookup of the current harvest object of a
+    dataset (by guid and current), if it does not exist yet
+    """
+    model.Session.execute(
+        "CREATE INDEX IF NOT EXISTS %s ON harvest_object (guid, current)"
+        % GUID_CURRENT_INDEX
+    )
+    model.Session.commit()
+
+
+def outdated_harvest_object_ids(source_id, keep):
+    """
+    Return the ids of the harvest objects of a source that are no longer
+    needed: the current object and the last `keep` objects of each guid
+    are kept, as well as all objects of jobs that are not finished yet
+    """
+    ranked = (
+        model.Session.query(
+            HarvestObject.id.label("id"),
+            func.row_number()
+            .over(
+                partition_by=HarvestObject.guid,
+                order_by=HarvestObject.gathered.desc(),
+            )
+            .label("rank"),
+        )
+        .join(HarvestJob, HarvestObject.harvest_job_id == HarvestJob.id)
+        .filter(HarvestObject.harvest_source_id == source_id)
+        .filter(HarvestObject.current == False)
+        .filter(HarvestJob.status == "Finished")
+        .subquery()
+    )
+    rows = model.Session.query(ranked.c.id).filter(ranked.c.rank > keep).all()
+    return [row.id for row in rows]
+
+
+def delete_harvest_objects(object_ids, batch_size=1000):
+    """
+    Delete the given harvest objects with their errors and extras, each
+    batch is deleted in its own transaction
+    """
+    deleted = 0
+    for i in range(0, len(object_ids), batch_size):
+        batch = object_ids[i : i + batch_size]
+        try:
+            for table, column in (
+                (HarvestObjectError, HarvestObjectError.harvest_object_id),
+                (HarvestObjectExtra, HarvestObjectExtra.harvest_object_id),
+                (HarvestObject, HarvestObject.id),
+            ):
+                model.Session.query(table).filter(column.in_(batch)).delete(
+                    synchronize_session=False
+                )
+            model.Session.commit()
+        except Exception:
+            model.Session.rollback()
+            raise
+        deleted += len(batch)
+        log.info("Deleted %d of %d harvest objects" % (deleted, len(object_ids)))
+    return deleted
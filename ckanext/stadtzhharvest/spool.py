@@ -0,0 +1,169 @@
+# coding: utf-8
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def _open_source(path):
+    return open(path, "rb")
+
+
+class FileSpool(object):
+    """
+    Local read-through copy of the files of the dropzone.
+
+    The first read of a file copies it from the (slow) mount into the spool
+    directory with a single sequential read, all further reads of the same
+    version of the file (e.g. hashing, uploading and retries) use the local
+    copy. A copy is identified by the path of the file and is only used as
+    long as the size and modification time of the file did not change.
+
+    The total size of the spool is limited to `max_size` bytes, the least
+    recently used copies are removed first.
+    """
+
+    def __init__(self, directory, max_size, open_source=_open_source):
+        self.directory = directory
+        self.max_size = max_size
+        self.open_source = open_source
+        self.stats = Counter()
+        self._locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _local_path(self, path):
+        digest = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    def _path_lock(self, local_path):
+        with self._lock:
+            return self._locks[local_path]
+
+    @contextmanager
+    def open(self, path):
+        """
+        Open a file for reading (in binary mode) from the spool, the file is
+        copied to the spool first if needed. Files larger than the spool are
+        read directly from the source.
+        """
+        local_path, _ = self._fetch(path)
+        local_file = None
+        if local_path is not None:
+            try:
+                local_file = open(local_path, "rb")
+            except FileNotFoundError:
+                # evicted in the meantime
+                pass
+        if local_file is None:
+            with self.open_source(path) as f:
+                yield f
+        else:
+            with local_file as f:
+                yield f
+
+    def fetch(self, path):
+        """
+        Copy a file to the spool unless an up-to-date copy exists, returns
+        the number of bytes read from the source
+        """
+        return self._fetch(path)[1]
+
+    def _fetch(self, path):
+        stat = os.stat(path)
+        if stat.st_size > self.max_size:
+            return (None, 0)
+
+        local_path = self._local_path(path)
+        with self._path_lock(local_path):
+            if self._is_current(local_path, stat):
+                self._touch(local_path, stat)
+                self.stats["hits"] += 1
+                return (local_path, 0)
+            size = self._copy(path, local_path, stat)
+        if size is None:
+            # the file changed while it was copied
+            return (None, 0)
+        self.stats["misses"] += 1
+        self.stats["bytes_copied"] += size
+        self._evict()
+        return (local_path, size)
+
+    def _is_current(self, local_path, stat):
+        try:
+            local_stat = os.stat(local_path)
+        except OSError:
+            return False
+        return (
+            local_stat.st_size == stat.st_size
+            and local_stat.st_mtime_ns == stat.st_mtime_ns
+        )
+
+    def _touch(self, local_path, stat):
+        # the access time is used to find the least recently used copies,
+        # the modification time is the one of the source file
+        os.utime(local_path, ns=(time.time_ns(), stat.st_mtime_ns))
+
+    def _copy(self, path, local_path, stat):
+        """
+        Copy a file to the spool, returns the number of copied bytes or None
+        if the file changed while it was copied
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            size = 0
+            with os.fdopen(fd, "wb") as out, self.open_source(path) as source:
+                while True:
+                    data = source.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    out.write(data)
+                    size += len(data)
+            current = os.stat(path)
+            if size != stat.st_size or current.st_mtime_ns != stat.st_mtime_ns:
+                log.warning("%s changed while it was copied to the spool" % path)
+                os.remove(tmp_path)
+                return None
+            self._touch(tmp_path, stat)
+            os.replace(tmp_path, local_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        log.debug("Copied %s (%d bytes) to the spool" % (path, size))
+        return size
+
+    def _evict(self):
+        """
+        Remove the least recently used copies until the spool fits into
+        `max_size`
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp") or not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_atime_ns, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, local_path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(local_path)
+            except OSError:
+                continue
+            total -= size
+            self.stats["evictions"] += 1
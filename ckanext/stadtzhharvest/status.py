@@ -0,0 +1,160 @@
+# coding: utf-8
+
+import datetime
+import logging
+
+import ckan.plugins.toolkit as tk
+from ckan import model
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Float,
+    Integer,
+    MetaData,
+    Table,
+    UnicodeText,
+    func,
+)
+
+log = logging.getLogger(__name__)
+
+# the table is created by the migrations of the plugin, run
+# `ckan db upgrade -p stadtzh_harvester`
+source_status_table = Table(
+    "stadtzhharvest_source_status",
+    MetaData(),
+    Column("source_id", UnicodeText, primary_key=True),
+    Column("job_id", UnicodeText),
+    Column("gather_started", DateTime),
+    Column("gather_finished", DateTime),
+    Column("gather_duration", Float),
+    Column("datasets_gathered", Integer, default=0),
+    Column("datasets_deferred", Integer, default=0),
+    Column("cache_hits", Integer, default=0),
+    Column("cache_misses", Integer, default=0),
+    Column("import_duration", Float, default=0),
+    Column("datasets_changed", Integer, default=0),
+    Column("datasets_unchanged", Integer, default=0),
+    Column("datasets_failed", Integer, default=0),
+    Column("last_import", DateTime),
+    Column("oldest_pending_change", DateTime),
+)
+
+
+def _commit(statements):
+    try:
+        for statement in statements:
+            model.Session.execute(statement)
+        model.Session.commit()
+    except Exception:
+        model.Session.rollback()
+        raise
+
+
+def record_gather(source_id, job_id, values):
+    """
+    Replace the status of a source with the results of the gather stage of
+    a new job, the import counters start at 0
+    """
+    table = source_status_table
+    statements = [
+        table.delete().where(table.c.source_id == source_id),
+        table.insert().values(
+            source_id=source_id,
+            job_id=job_id,
+            import_duration=0,
+            datasets_changed=0,
+            datasets_unchanged=0,
+            datasets_failed=0,
+            **values
+        ),
+    ]
+    _commit(statements)
+
+
+def record_import(source_id, job_id, duration, result, changed, gathered=None):
+    """
+    Add the import of a dataset to the status of the job of a source. The
+    gather time of failed datasets is kept as oldest pending change.
+    """
+    table = source_status_table
+    if not result:
+        counter = table.c.datasets_failed
+    elif changed:
+        counter = table.c.datasets_changed
+    else:
+        counter = table.c.datasets_unchanged
+    values = {
+        counter: counter + 1,
+        table.c.import_duration: table.c.import_duration + duration,
+        table.c.last_import: datetime.datetime.utcnow(),
+    }
+    if not result and gathered:
+        values[table.c.oldest_pending_change] = func.least(
+            func.coalesce(table.c.oldest_pending_change, gathered), gathered
+        )
+    statement = (
+        table.update()
+        .where(table.c.source_id == source_id)
+        .where(table.c.job_id == job_id)
+        .values(values)
+    )
+    _commit([statement])
+
+
+def get_source_status(source_id=None):
+    """
+    Return the status of a source (or of all sources) as list of dicts
+    """
+    query = source_status_table.select().order_by(source_status_table.c.source_id)
+    if source_id:
+        query = query.where(source_status_table.c.source_id == source_id)
+    rows = model.Session.execute(query).fetchall()
+    return [_status_dict(row) for row in rows]
+
+
+def _status_dict(row):
+    status = {}
+    for key, value in dict(row._mapping).items():
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        status[key] = value
+    lookups = (status["cache_hits"] or 0) + (status["cache_misses"] or 0)
+    status["cache_hit_rate"] = (
+        float(status["cache_hits"]) / lookups if lookups else None
+    )
+    return status
+
+
+@tk.side_effect_free
+def stadtzhharvest_source_status(context, data_dict):
+    """
+    Return the status of the last job of a harvest source: the duration of
+    the gather and import stages, the number of gathered, deferred, changed,
+    unchanged and failed datasets, the hit rate of the metadata cache and
+    the oldest change that is not harvested yet.
+
+    :param id: the id of the harvest source (optional, returns the status of
+        all sources if omitted)
+    """
+    tk.check_access("stadtzhharvest_source_status", context, data_dict)
+    source_id = data_dict.get("id")
+    statuses = get_source_status(source_id)
+    if not source_id:
+        return statuses
+    if not statuses:
+        raise tk.ObjectNotFound("No status found for harvest source %s" % source_id)
+    return statuses[0]
+
+
+def stadtzhharvest_source_status_auth(context, data_dict):
+    # only sysadmins
+    return {"success": False}
+
+
+def get_actions():
+    return {"stadtzhharvest_source_status": stadtzhharvest_source_status}
+
+
+def get_auth_functions():
+    return {"stadtzhharvest_source_status": stadtzhharvest_source_status_auth}
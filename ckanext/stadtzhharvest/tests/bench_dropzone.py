@@ -0,0 +1,99 @@
+"""
+Benchmarks of the file system access of the harvester on a simulated
+network drive. They are not run by default, run them explicitly with:
+
+    pytest --ckan-ini=test.ini -s ckanext/stadtzhharvest/tests/bench_dropzone.py
+"""
+
+import json
+import os
+import shutil
+import time
+
+import pytest
+
+import ckanext.stadtzhharvest.harvester as plugin
+from ckanext.stadtzhharvest.tests.faultfs import FaultFS
+
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+MB = 1024 * 1024
+
+SCENARIOS = {
+    "local": {},
+    "webdav": {"latency": 0.02, "bandwidth": 50 * MB},
+    "flaky-webdav": {
+        "latency": 0.02,
+        "bandwidth": 50 * MB,
+        "error_rate": 0.2,
+        "seed": 42,
+    },
+}
+
+
+def _report(capsys, name, scenario, seconds, fs):
+    with capsys.disabled():
+        print(
+            "\n%s [%s]: %.3fs, %s"
+            % (
+                name,
+                scenario,
+                seconds,
+                ", ".join("%s=%s" % i for i in sorted(fs.stats.items())),
+            )
+        )
+
+
+@pytest.fixture
+def big_dropzone(temp_dir):
+    """dropzone with one dataset of 20 files of 2 MB each"""
+    dataset_path = os.path.join(temp_dir, "dropzone", "big_dataset")
+    os.makedirs(dataset_path)
+    for i in range(20):
+        with open(os.path.join(dataset_path, "file_%02d.csv" % i), "wb") as f:
+            f.write(os.urandom(2 * MB))
+    return os.path.join(temp_dir, "dropzone")
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+@pytest.mark.parametrize("scenario", sorted(SCENARIOS))
+def test_bench_hashing(scenario, workers, big_dropzone, capsys):
+    harvester = plugin.StadtzhHarvester()
+    harvester._set_config(
+        json.dumps({"data_path": big_dropzone, "hash_workers": workers})
+    )
+
+    fs = FaultFS(big_dropzone, **SCENARIOS[scenario])
+    started = time.monotonic()
+    with fs.installed():
+        resources = harvester._generate_resources_from_folder("big_dataset")
+    seconds = time.monotonic() - started
+
+    assert len(resources) == 20
+    _report(capsys, "hashing (%d workers)" % workers, scenario, seconds, fs)
+
+
+@pytest.mark.ckan_config("ckan.plugins", "stadtzhtheme harvest stadtzh_harvester")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+@pytest.mark.parametrize("scenario", sorted(SCENARIOS))
+def test_bench_gather_files(scenario, temp_dir, capsys):
+    """file access of the gather stage for each dataset folder"""
+    data_path = os.path.join(temp_dir, "DWH")
+    shutil.copytree(os.path.join(__location__, "fixtures", "DWH"), data_path)
+    harvester = plugin.StadtzhHarvester()
+    harvester._set_config(json.dumps({"data_path": data_path}))
+
+    fs = FaultFS(data_path, **SCENARIOS[scenario])
+    started = time.monotonic()
+    with fs.installed():
+        folders = harvester._remove_hidden_files(os.listdir(data_path))
+        for folder in folders:
+            harvester._dataset_fingerprint(folder)
+            harvester._generate_resources_from_folder(folder)
+            harvester._load_metadata_from_path(
+                os.path.join(data_path, folder, "meta.xml"), folder, folder
+            )
+    seconds = time.monotonic() - started
+
+    assert len(folders) == 3
+    _report(capsys, "gather", scenario, seconds, fs)
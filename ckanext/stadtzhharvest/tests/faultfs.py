@@ -0,0 +1,163 @@
+# coding: utf-8
+"""
+Simulation of a slow and flaky network drive (like the WebDAV mount of the
+dropzones) for tests and benchmarks.
+
+Usage::
+
+    fs = FaultFS(data_path, latency=0.02, bandwidth=10 * 1024 * 1024,
+                 error_rate=0.1, seed=42)
+    with fs.installed():
+        harvester.gather_stage(harvest_job)
+    print(fs.stats)
+"""
+
+import builtins
+import errno
+import os
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from unittest import mock
+
+
+class FaultFS(object):
+    """
+    Patches `open`, `os.listdir`, `os.scandir` and `os.stat` (which is also
+    used by `os.path.exists`, `isfile` etc.) for all paths below `root`:
+
+    * every operation is delayed by `latency` seconds
+    * reading from files is limited to `bandwidth` bytes per second
+    * opening a file fails with EIO with a probability of `error_rate` and
+      for the first `fail_first` attempts to open each file
+    * reading from a file fails with EIO with a probability of
+      `read_error_rate`
+
+    The number of operations and injected errors is counted in `stats`.
+    """
+
+    def __init__(
+        self,
+        root,
+        latency=0.0,
+        bandwidth=None,
+        error_rate=0.0,
+        fail_first=0,
+        read_error_rate=0.0,
+        seed=None,
+        sleep=time.sleep,
+    ):
+        self.root = os.path.realpath(root)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.fail_first = fail_first
+        self.read_error_rate = read_error_rate
+        self.stats = Counter()
+        self._random = random.Random(seed)
+        self._sleep = sleep
+        self._opened = Counter()
+        self._lock = threading.Lock()
+
+    def _affects(self, path):
+        if isinstance(path, int):
+            return False
+        path = os.path.realpath(os.fsdecode(path))
+        return path == self.root or path.startswith(self.root + os.sep)
+
+    def _operation(self, name):
+        with self._lock:
+            self.stats[name] += 1
+        if self.latency:
+            self._sleep(self.latency)
+
+    def _fail(self, name, path):
+        with self._lock:
+            self.stats[name + "_error"] += 1
+        raise IOError(errno.EIO, os.strerror(errno.EIO), path)
+
+    def _chance(self, rate):
+        with self._lock:
+            return rate and self._random.random() < rate
+
+    def _throttle(self, size):
+        if self.bandwidth and size:
+            self._sleep(float(size) / self.bandwidth)
+        with self._lock:
+            self.stats["bytes_read"] += size
+
+    @contextmanager
+    def installed(self):
+        """
+        Context manager to patch the file system functions
+        """
+        real_open = builtins.open
+        real_listdir = os.listdir
+        real_scandir = os.scandir
+        real_stat = os.stat
+
+        def fault_open(file, mode="r", *args, **kwargs):
+            if not self._affects(file):
+                return real_open(file, mode, *args, **kwargs)
+            self._operation("open")
+            with self._lock:
+                self._opened[file] += 1
+                attempt = self._opened[file]
+            if attempt <= self.fail_first or self._chance(self.error_rate):
+                self._fail("open", file)
+            return _FaultFile(self, real_open(file, mode, *args, **kwargs))
+
+        def fault_listdir(path="."):
+            if self._affects(path):
+                self._operation("listdir")
+            return real_listdir(path)
+
+        def fault_scandir(path="."):
+            if self._affects(path):
+                self._operation("scandir")
+            return real_scandir(path)
+
+        def fault_stat(path, *args, **kwargs):
+            if self._affects(path):
+                self._operation("stat")
+            return real_stat(path, *args, **kwargs)
+
+        with mock.patch.object(builtins, "open", fault_open), mock.patch.object(
+            os, "listdir", fault_listdir
+        ), mock.patch.object(os, "scandir", fault_scandir), mock.patch.object(
+            os, "stat", fault_stat
+        ):
+            yield self
+
+
+class _FaultFile(object):
+    """
+    Wrapper of a file object which throttles and breaks reads
+    """
+
+    def __init__(self, fs, f):
+        self._fs = fs
+        self._f = f
+
+    def read(self, *args):
+        if self._fs._chance(self._fs.read_error_rate):
+            self._fs._fail("read", self._f.name)
+        data = self._f.read(*args)
+        self._fs._throttle(len(data))
+        return data
+
+    def __iter__(self):
+        for line in self._f:
+            self._fs._throttle(len(line))
+            yield line
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._f.close()
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
@@ -11,6 +11,7 @@ from ckanext.stadtzhtheme.plugin import create_dataType, create_updateInterval
 def clean_db(reset_db, migrate_db_for):
     reset_db()
     migrate_db_for("harvest")
+    migrate_db_for("stadtzh_harvester")
 
     # Cleaning the db gets rid of our custom tag vocabularies, so create them again
     create_dataType()
@@ -0,0 +1,38 @@
+import os
+
+from ckanext.stadtzhharvest.cache import MetadataCache
+
+
+class TestMetadataCache(object):
+    def test_get_missing_key(self, tmp_path):
+        cache = MetadataCache(os.path.join(str(tmp_path), "cache.db"))
+        assert cache.get("missing") is None
+
+    def test_set_and_get(self, tmp_path):
+        cache = MetadataCache(os.path.join(str(tmp_path), "cache.db"))
+        metadata = {"datasetID": "test_dataset", "tags": [{"name": "test"}]}
+        cache.set("key", metadata)
+        assert cache.get("key") == metadata
+
+    def test_persistent(self, tmp_path):
+        path = os.path.join(str(tmp_path), "cache.db")
+        MetadataCache(path).set("key", {"title": "Zürich"})
+        assert MetadataCache(path).get("key") == {"title": "Zürich"}
+
+    def test_lru_eviction(self, tmp_path):
+        cache = MetadataCache(os.path.join(str(tmp_path), "cache.db"), max_size=2)
+        cache.set("a", {"id": "a"})
+        cache.set("b", {"id": "b"})
+        # use "a", so that "b" is the least recently used entry
+        assert cache.get("a") == {"id": "a"}
+        cache.set("c", {"id": "c"})
+
+        assert len(cache) == 2
+        assert cache.get("a") == {"id": "a"}
+        assert cache.get("b") is None
+        assert cache.get("c") == {"id": "c"}
+
+    def test_broken_cache_is_a_miss(self, tmp_path):
+        cache = MetadataCache(os.path.join(str(tmp_path), "missing", "cache.db"))
+        cache.set("key", {"id": "key"})
+        assert cache.get("key") is None
@@ -0,0 +1,47 @@
+import os
+
+from ckanext.stadtzhharvest import checkpoint
+
+
+class TestCheckpointStore(object):
+    def _store(self, tmp_path):
+        return checkpoint.CheckpointStore(os.path.join(str(tmp_path), "checkpoints.db"))
+
+    def test_new_run(self, tmp_path):
+        store = self._store(tmp_path)
+        assert store.start_run("source", "job1") == ("job1", False)
+
+    def test_resume_incomplete_run(self, tmp_path):
+        store = self._store(tmp_path)
+        run_id, _ = store.start_run("source", "job1")
+        store.mark("source", "a", run_id, "fp-a", checkpoint.GATHERED)
+        store.mark("source", "b", run_id, "fp-b", checkpoint.GATHERED)
+        store.finish("source", "a", checkpoint.IMPORTED)
+
+        # job1 died before "b" was imported, job2 resumes the run
+        assert store.start_run("source", "job2") == ("job1", True)
+        assert store.is_completed("source", "a", "job1", "fp-a")
+        assert not store.is_completed("source", "a", "job1", "fp-changed")
+        assert not store.is_completed("source", "b", "job1", "fp-b")
+
+    def test_completed_run_is_not_resumed(self, tmp_path):
+        store = self._store(tmp_path)
+        run_id, _ = store.start_run("source", "job1")
+        store.mark("source", "a", run_id, "fp-a", checkpoint.GATHERED)
+        store.mark("source", "b", run_id, "fp-b", checkpoint.GATHERED)
+        store.finish("source", "a", checkpoint.IMPORTED)
+        store.finish("source", "b", checkpoint.FAILED)
+
+        assert store.start_run("source", "job2") == ("job2", False)
+        assert not store.is_completed("source", "a", "job2", "fp-a")
+
+    def test_empty_run_completes(self, tmp_path):
+        store = self._store(tmp_path)
+        run_id, _ = store.start_run("source", "job1")
+        store.complete_if_done("source", run_id)
+        assert store.start_run("source", "job2") == ("job2", False)
+
+    def test_runs_per_source(self, tmp_path):
+        store = self._store(tmp_path)
+        store.start_run("source1", "job1")
+        assert store.start_run("source2", "job2") == ("job2", False)
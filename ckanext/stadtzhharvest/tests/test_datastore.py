@@ -0,0 +1,127 @@
+import io
+import os
+from unittest import mock
+
+import pytest
+
+from ckanext.stadtzhharvest import datastore
+
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+
+class TestDatastore(object):
+    def test_attribute_hint(self):
+        assert datastore.attribute_hint("Adresse", "CHAR 70 Zeichen lang") == "text"
+        assert datastore.attribute_hint("Zählstelle (Code)", "") == "text"
+        assert datastore.attribute_hint("Jahr", "Jahreszahl (z.B. 2012)") == "number"
+        assert datastore.attribute_hint("Anzahl Nachnamen", None) == "number"
+        assert (
+            datastore.attribute_hint("Datum", "Datum der Messung. (YYYY-MM-DD)")
+            == "date"
+        )
+        assert datastore.attribute_hint("Ausfall", "0 = kein Ausfall") is None
+
+    def test_read_sample(self):
+        path = os.path.join(
+            __location__, "fixtures", "DWH", "nachnamen_2014", "nachnamen_2014.csv"
+        )
+        with open(path, "rb") as f:
+            columns, rows, delimiter = datastore.read_sample(f)
+        assert columns == ["StichtagDatJahr", "Name", "AnzName"]
+        assert rows[0] == ["2014", "Müller", "24146"]
+        assert delimiter == ","
+        assert all(len(row) == 3 for row in rows)
+
+    def test_read_sample_semicolon(self):
+        f = io.BytesIO(b"Jahr;Anzahl\n2014;3\n")
+        assert datastore.read_sample(f) == (["Jahr", "Anzahl"], [["2014", "3"]], ";")
+
+    def test_infer_fields(self):
+        columns = ["Jahr", "Wert", "Datum", "Name", "Leer"]
+        rows = [["2014", "1.5", "2014-01-01", "Müller", ""], ["", "2", "", "1", ""]]
+        hints = {
+            "Jahr": "number",
+            "Wert": "number",
+            "Datum": "date",
+            "Name": "number",
+            "Leer": "number",
+        }
+        assert datastore.infer_fields(columns, rows, hints) == [
+            {"id": "Jahr", "type": "int8"},
+            {"id": "Wert", "type": "numeric"},
+            {"id": "Datum", "type": "date"},
+            {"id": "Name", "type": "text"},
+            {"id": "Leer", "type": "text"},
+        ]
+        assert datastore.infer_fields(["Jahr"], [["2014"]], {}) == [
+            {"id": "Jahr", "type": "text"}
+        ]
+
+    def test_load_csv_falls_back_to_text(self):
+        f = io.BytesIO(b"Jahr,Name\n2014,M\xc3\xbcller\n")
+        loaded = []
+
+        def replace_table(resource_id, f, fields, delimiter):
+            f.seek(0)
+            loaded.append((f.read(), [field["type"] for field in fields]))
+            if len(loaded) == 1:
+                raise ValueError("invalid input syntax for type bigint")
+
+        with mock.patch.object(
+            datastore, "_replace_table", side_effect=replace_table
+        ), mock.patch.object(datastore, "_set_datastore_active") as set_active:
+            fields = datastore.load_csv("res-id", f, {"Jahr": "number"}, {})
+
+        assert fields == [
+            {"id": "Jahr", "type": "text"},
+            {"id": "Name", "type": "text"},
+        ]
+        assert loaded == [
+            (f.getvalue(), ["int8", "text"]),
+            (f.getvalue(), ["text", "text"]),
+        ]
+        set_active.assert_called_once_with("res-id", {})
+
+    def test_load_csv_text_error_is_raised(self):
+        f = io.BytesIO(b"Name\nMeier\n")
+        with mock.patch.object(
+            datastore, "_replace_table", side_effect=ValueError("broken")
+        ), mock.patch.object(datastore, "_set_datastore_active") as set_active:
+            with pytest.raises(ValueError):
+                datastore.load_csv("res-id", f, {}, {})
+        set_active.assert_not_called()
+
+    def test_replace_table_in_one_transaction(self):
+        from ckanext.datastore.backend import postgres as backend
+
+        engine = mock.MagicMock()
+        connection = engine.begin.return_value.__enter__.return_value
+        connection.connection.cursor.return_value.copy_expert.side_effect = ValueError(
+            "broken"
+        )
+        fields = [{"id": "Jahr", "type": "int8"}]
+        with mock.patch.object(
+            backend, "get_write_engine", return_value=engine
+        ), mock.patch.object(backend, "_cache_types"), mock.patch.object(
+            backend, "create_table"
+        ) as create_table, mock.patch.object(
+            backend, "_create_fulltext_trigger"
+        ) as create_trigger, mock.patch.object(
+            backend, "create_indexes"
+        ) as create_indexes:
+            with pytest.raises(ValueError):
+                datastore._replace_table(
+                    "res-id", io.BytesIO(b"Jahr\n2014\n"), fields, ","
+                )
+
+        # the error leaves the transaction, so the previous table is kept
+        assert engine.begin.return_value.__exit__.call_args[0][0] is ValueError
+        statements = [str(c[0][0]) for c in connection.execute.call_args_list]
+        assert statements == ['DROP TABLE IF EXISTS "res-id" CASCADE']
+        create_table.assert_called_once_with(
+            {"connection": connection},
+            {"resource_id": "res-id", "fields": fields},
+            {},
+        )
+        create_trigger.assert_called_once_with(connection, "res-id")
+        create_indexes.assert_not_called()
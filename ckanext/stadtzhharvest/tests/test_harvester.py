@@ -1,10 +1,15 @@
+import datetime
 import json
 import os
+import time
+from unittest import mock
 
 import pytest
-from ckan.tests import helpers
+from ckan.tests import factories, helpers
 
 import ckanext.stadtzhharvest.harvester as plugin
+from ckanext.harvest.tests import factories as harvest_factories
+from ckanext.stadtzhharvest.tests.faultfs import FaultFS
 
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
@@ -104,7 +109,7 @@ class TestStadtzhHarvester(object):
         assert metadata["datasetFolder"] == dataset_folder
         assert metadata["datasetID"] == dataset_folder
 
-        attributes = json.loads(metadata["sszFields"])
+        attributes = metadata["sszFields"]
         assert len(attributes) == 9
 
         jahr = attributes[1]
@@ -116,6 +121,35 @@ class TestStadtzhHarvester(object):
         assert anzahl[0] == "Gezählte Velofahrten"
         assert anzahl[1] == "Anzahl Velos pro Stunde an der jeweiligen Messstelle"
 
+        hints = metadata["attribute_hints"]
+        assert hints["Zs Text"] == "text"
+        assert hints["Vkjahr Id"] == hints["Jahr"] == "number"
+        assert hints["Zaehlstellezeit2"] == "date"
+        assert hints["Gezählte Velofahrten"] == "number"
+        assert "Ausfall" not in hints
+
+    def test_encode_content(self):
+        metadata = {
+            "datasetID": "velozaehlstellen_stundenwerte",
+            "sszFields": [["Gezählte Velofahrten", "Anzahl Velos pro Stunde"]],
+        }
+        content = plugin.encode_content(metadata)
+        assert not content.startswith(plugin.COMPRESSED_CONTENT_PREFIX)
+        assert json.loads(content) == metadata
+        assert plugin.decode_content(content) == metadata
+
+        compressed = plugin.encode_content(metadata, compress_threshold=10)
+        assert compressed.startswith(plugin.COMPRESSED_CONTENT_PREFIX)
+        assert plugin.decode_content(compressed) == metadata
+
+    def test_get_package_dict_encodes_attributes(self):
+        harvester = plugin.StadtzhHarvester()
+        metadata = {"datasetID": "test", "sszFields": [["Jahr", "Jahreszahl"]]}
+        harvest_object = mock.Mock(content=plugin.encode_content(metadata, 1))
+
+        package_dict = harvester._get_package_dict(harvest_object)
+        assert json.loads(package_dict["sszFields"]) == [["Jahr", "Jahreszahl"]]
+
     def test_load_metadata_groups_and_tags(self):
         harvester = plugin.StadtzhHarvester()
         dataset_folder = "nachnamen_2014"
@@ -149,3 +183,752 @@ class TestStadtzhHarvester(object):
         check_group(metadata["groups"][0]["name"], "tourismus", "Tourismus")
         check_group(metadata["groups"][1]["name"], "freizeit", "Freizeit")
         check_group(metadata["groups"][2]["name"], "bevolkerung", "Bevölkerung")
+
+    def test_get_existing_package(self):
+        dataset = factories.Dataset(
+            resources=[
+                {"url": "http://example.com/b.csv", "name": "b.csv", "zh_hash": "b"},
+                {"url": "http://example.com/a.csv", "name": "a.csv", "zh_hash": "a"},
+            ]
+        )
+        harvester = plugin.StadtzhHarvester()
+
+        existing_package = harvester._get_existing_package(
+            {"id": dataset["name"], "name": dataset["name"]}
+        )
+        assert existing_package["id"] == dataset["id"]
+        assert existing_package["name"] == dataset["name"]
+        assert [
+            (r["id"], r["name"], r["zh_hash"]) for r in existing_package["resources"]
+        ] == [(r["id"], r["name"], r["zh_hash"]) for r in dataset["resources"]]
+
+    def test_get_existing_package_not_found(self):
+        harvester = plugin.StadtzhHarvester()
+        assert (
+            harvester._get_existing_package(
+                {"id": "missing_dataset", "name": "missing_dataset"}
+            )
+            is None
+        )
+
+    def test_load_metadata_from_cache(self, temp_dir):
+        cache_path = os.path.join(temp_dir, "metadata_cache.db")
+        with mock.patch.dict(
+            plugin.tk.config, {"ckanext.stadtzhharvest.metadata_cache_path": cache_path}
+        ):
+            harvester = plugin.StadtzhHarvester()
+        dataset_folder = "test_dataset"
+        data_path = os.path.join(__location__, "fixtures", "test_dropzone")
+
+        test_meta_xml_path = os.path.join(data_path, dataset_folder, "meta.xml")
+
+        metadata = harvester._load_metadata_from_path(
+            test_meta_xml_path, dataset_folder, dataset_folder
+        )
+        with mock.patch.object(
+            harvester, "_dropzone_get_metadata", side_effect=AssertionError
+        ):
+            cached_metadata = harvester._load_metadata_from_path(
+                test_meta_xml_path, dataset_folder, dataset_folder
+            )
+        assert cached_metadata == metadata
+
+        # a different dataset id must not use the cached metadata
+        metadata = harvester._load_metadata_from_path(
+            test_meta_xml_path, "testprefix-test_dataset", dataset_folder
+        )
+        assert metadata["datasetID"] == "testprefix-test_dataset"
+
+    def test_load_metadata_from_cache_creates_missing_groups(self, temp_dir):
+        cache_path = os.path.join(temp_dir, "metadata_cache.db")
+        with mock.patch.dict(
+            plugin.tk.config, {"ckanext.stadtzhharvest.metadata_cache_path": cache_path}
+        ):
+            harvester = plugin.StadtzhHarvester()
+        dataset_folder = "nachnamen_2014"
+        data_path = os.path.join(__location__, "fixtures", "DWH")
+
+        test_meta_xml_path = os.path.join(data_path, dataset_folder, "meta.xml")
+
+        harvester._load_metadata_from_path(
+            test_meta_xml_path, dataset_folder, dataset_folder
+        )
+        helpers.call_action("group_purge", {"ignore_auth": True}, id="tourismus")
+
+        metadata = harvester._load_metadata_from_path(
+            test_meta_xml_path, dataset_folder, dataset_folder
+        )
+        assert [group["name"] for group in metadata["groups"]] == [
+            "tourismus",
+            "freizeit",
+            "bevolkerung",
+        ]
+        group = helpers.call_action("group_show", {}, id="tourismus")
+        assert group["title"] == "Tourismus"
+
+    def test_load_metadata_validate(self):
+        harvester = plugin.StadtzhHarvester()
+        dataset_folder = "amtshaus"
+        data_path = os.path.join(__location__, "fixtures", "GEO")
+
+        test_meta_xml_path = os.path.join(
+            data_path, dataset_folder, "DEFAULT", "meta.xml"
+        )
+
+        metadata = harvester._load_metadata_from_path(
+            test_meta_xml_path, dataset_folder, dataset_folder, validate=True
+        )
+        assert metadata["title"] == "Amtshaus"
+
+    def test_load_metadata_validate_invalid(self):
+        harvester = plugin.StadtzhHarvester()
+        dataset_folder = "nachnamen_2014"
+        data_path = os.path.join(__location__, "fixtures", "DWH")
+
+        test_meta_xml_path = os.path.join(data_path, dataset_folder, "meta.xml")
+
+        with pytest.raises(plugin.MetaXmlInvalid, match="aktualisierungsintervall"):
+            harvester._load_metadata_from_path(
+                test_meta_xml_path, dataset_folder, dataset_folder, validate=True
+            )
+
+    def test_validate_link_xml_not_well_formed(self):
+        with pytest.raises(plugin.LinkXmlInvalid, match="not well-formed"):
+            plugin.validate_xml(b"<linklist><link>", "link", plugin.LinkXmlInvalid)
+
+    def test_select_folders_patterns(self):
+        harvester = plugin.StadtzhHarvester()
+        harvester._set_config(
+            json.dumps(
+                {
+                    "data_path": "/tmp",
+                    "include_folders": ["bev_*", "nachnamen_*"],
+                    "exclude_folders": ["*_2014"],
+                }
+            )
+        )
+        folders = ["bev_geburten", "bev_zuzug", "nachnamen_2014", "velo"]
+        assert harvester._select_folders(folders) == ["bev_geburten", "bev_zuzug"]
+
+        assert harvester._package_in_scope("bev_geburten", "bev_geburten")
+        assert not harvester._package_in_scope("nachnamen_2014", "nachnamen_2014")
+        assert not harvester._package_in_scope("velo", "velo")
+        # packages with an unknown folder are never deleted
+        assert not harvester._package_in_scope("bev_geburten", None)
+
+    def test_check_for_deleted_datasets_matches_folder_names(self):
+        harvester = plugin.StadtzhHarvester()
+        harvester._set_config(
+            json.dumps(
+                {
+                    "data_path": "/tmp",
+                    "delete_missing_datasets": True,
+                    "exclude_folders": ["geo.archive*", "Test Data*"],
+                }
+            )
+        )
+        folders = ["geo.A", "geo.archive_2019", "Test Data 2020"]
+        existing = ["geo-a", "geo-archive_2019", "test-data-2020", "geo-b"]
+        harvest_job = mock.Mock()
+        with mock.patch.object(
+            harvester, "_get_existing_packages_names", return_value=existing
+        ), mock.patch.object(
+            # the folder of geo-b no longer exists
+            harvester,
+            "_get_harvested_folders",
+            return_value={"geo-b": "geo.B"},
+        ) as get_harvested_folders, mock.patch.object(
+            harvester, "_save_harvest_object", side_effect=lambda m, j: m["datasetID"]
+        ):
+            delete_ids = harvester._check_for_deleted_datasets(
+                harvest_job, ["geo-a"], folders
+            )
+        get_harvested_folders.assert_called_once_with({"geo-b"})
+        # the excluded folders are not gathered, but must not be deleted
+        assert delete_ids == ["geo-b"]
+
+        harvester._set_config(
+            json.dumps(
+                {
+                    "data_path": "/tmp",
+                    "delete_missing_datasets": True,
+                    "include_folders": ["geo.*"],
+                }
+            )
+        )
+        package_folders = {"geo-a": "geo.A", "test-data-2020": "Test Data 2020"}
+        assert harvester._package_in_scope("geo-a", package_folders["geo-a"])
+        assert not harvester._package_in_scope(
+            "test-data-2020", package_folders["test-data-2020"]
+        )
+
+    def test_gather_folders_only_deletes_datasets_of_the_source(self, temp_dir):
+        harvester = plugin.StadtzhHarvester()
+        os.mkdir(os.path.join(temp_dir, "geo.A"))
+        harvester._set_config(
+            json.dumps({"data_path": temp_dir, "delete_missing_datasets": True})
+        )
+        harvest_job = mock.Mock()
+        harvest_job.source.config = json.dumps(harvester.config)
+        # geo-c was harvested by another source
+        existing = ["geo-a", "geo-b"]
+        with mock.patch.object(
+            harvester, "_get_existing_packages_names", return_value=existing
+        ), mock.patch.object(
+            harvester, "_get_harvested_folders", return_value={"geo-b": "geo.B"}
+        ), mock.patch.object(
+            harvester, "_gather_dataset", return_value=("geo-a", None)
+        ), mock.patch.object(
+            harvester, "_save_harvest_object", side_effect=lambda m, j: m["datasetID"]
+        ):
+            delete_ids = harvester._gather_folders(
+                harvest_job, ["geo.A", "geo.B", "geo.C"]
+            )
+            assert delete_ids == ["geo-b"]
+
+            # the max_delete_fraction applies to watch jobs as well
+            harvester._save_gather_error = mock.Mock()
+            config = dict(harvester.config, max_delete_fraction=0.4)
+            harvest_job.source.config = json.dumps(config)
+            assert harvester._gather_folders(harvest_job, ["geo.B"]) == []
+            harvester._save_gather_error.assert_called_once()
+
+    def test_delete_from_search_index_in_chunks(self):
+        package_ids = ["id-%d" % i for i in range(plugin.SOLR_DELETE_CHUNK_SIZE + 1)]
+        with mock.patch.object(plugin, "make_connection") as make_connection:
+            plugin.delete_from_search_index(package_ids)
+            plugin.delete_from_search_index([])
+        delete = make_connection.return_value.delete
+        assert delete.call_count == 2
+        first_query = delete.call_args_list[0].kwargs["q"]
+        assert first_query.count(" OR ") == plugin.SOLR_DELETE_CHUNK_SIZE - 1
+        assert '"id-%d"' % plugin.SOLR_DELETE_CHUNK_SIZE in (
+            delete.call_args_list[1].kwargs["q"]
+        )
+
+    def test_disable_writes(self):
+        harvester = plugin.StadtzhHarvester()
+        harvester.checkpoints = mock.Mock()
+        harvester.disable_writes()
+        harvester._set_config(
+            json.dumps(
+                {"data_path": "/tmp", "datastore_load": True, "delete_batch_size": 100}
+            )
+        )
+        assert harvester.checkpoints is None
+        assert not harvester.config["datastore_load"]
+        assert not harvester.config["delete_batch_size"]
+        with mock.patch.object(plugin.status, "record_import") as record_import:
+            harvester._save_import_status(mock.Mock(), True, 1.0)
+        record_import.assert_not_called()
+
+    def test_select_folders_shards(self):
+        harvester = plugin.StadtzhHarvester()
+        folders = ["folder_%d" % i for i in range(50)]
+
+        selected = []
+        for shard_index in range(3):
+            harvester._set_config(
+                json.dumps(
+                    {"data_path": "/tmp", "shard_index": shard_index, "shard_count": 3}
+                )
+            )
+            shard = harvester._select_folders(folders)
+            assert shard, "Shard %s is empty" % shard_index
+            assert all(harvester._package_in_scope(f, f) for f in shard)
+            selected.extend(shard)
+
+        # each folder is part of exactly one shard
+        assert sorted(selected) == sorted(folders)
+
+    def test_validate_config_shards(self):
+        harvester = plugin.StadtzhHarvester()
+        config = {
+            "data_path": "/tmp",
+            "update_datasets": True,
+            "update_date_last_modified": True,
+            "shard_index": 2,
+            "shard_count": 2,
+        }
+        with pytest.raises(ValueError, match="shard_index must be lower"):
+            harvester.validate_config(json.dumps(config))
+
+        config["include_folders"] = "bev_*"
+        with pytest.raises(ValueError, match="must be a list of strings"):
+            harvester.validate_config(json.dumps(config))
+
+    def test_estimate_cost(self):
+        harvester = plugin.StadtzhHarvester()
+        data_path = os.path.join(__location__, "fixtures", "DWH")
+        harvester._set_config(json.dumps({"data_path": data_path}))
+
+        resources = harvester._generate_resources_from_folder(
+            "velozaehlstellen_stundenwerte"
+        )
+        resources.append({"name": "api", "url": "https://example.com"})
+        size, files = harvester._estimate_cost(resources)
+        assert files == 3
+        folder = os.path.join(data_path, "velozaehlstellen_stundenwerte")
+        assert size == sum(
+            os.path.getsize(os.path.join(folder, f))
+            for f in os.listdir(folder)
+            if f != "meta.xml"
+        )
+
+        # only the files that changed since the last import are counted
+        unchanged = resources[0]
+        existing = {
+            "resources": [{"name": unchanged["name"], "zh_hash": unchanged["zh_hash"]}]
+        }
+        changed = harvester._changed_files(resources, existing)
+        assert harvester._estimate_cost(changed) == (size - unchanged["size"], 2)
+
+    def test_order_objects_by_cost(self):
+        harvester = plugin.StadtzhHarvester()
+        harvester._set_config(json.dumps({"data_path": "/tmp"}))
+        harvester._object_costs = {"big": (5000, 2), "small": (10, 1)}
+        ids = ["big", "small", "delete"]
+        assert harvester._order_objects(ids) == ids
+
+        harvester._set_config(json.dumps({"data_path": "/tmp", "import_order": "cost"}))
+        assert harvester._order_objects(ids) == ["delete", "small", "big"]
+
+        config = {
+            "data_path": "/tmp",
+            "update_datasets": True,
+            "update_date_last_modified": True,
+            "import_order": "size",
+        }
+        with pytest.raises(ValueError, match="import_order must be one of"):
+            harvester.validate_config(json.dumps(config))
+
+    def test_upcoming_object_ids_by_cost(self):
+        harvester = plugin.StadtzhHarvester()
+        harvester._set_config(
+            json.dumps(
+                {"data_path": "/tmp", "import_order": "cost", "prefetch_datasets": 5}
+            )
+        )
+        harvest_job = harvest_factories.HarvestJobObj()
+        costs = {"current": (1, 1), "big": (5000, 2), "small": (10, 1), "delete": None}
+        ids = {}
+        for name, cost in costs.items():
+            extras = None
+            if cost:
+                extras = {"estimated_bytes": cost[0], "estimated_files": cost[1]}
+            ids[name] = harvester._save_harvest_object(
+                {"datasetID": name}, harvest_job, extras=extras
+            )
+        current = plugin.HarvestObject.get(ids["current"])
+
+        assert harvester._upcoming_object_ids(current) == [
+            ids["delete"],
+            ids["small"],
+            ids["big"],
+        ]
+
+    def test_stage_uploads(self, tmp_path):
+        harvester = plugin.StadtzhHarvester()
+        harvester._set_config(
+            json.dumps({"data_path": str(tmp_path), "upload_workers": 4})
+        )
+        harvester._save_object_error = mock.Mock()
+        for name in ["a.csv", "b.csv", "unchanged.csv"]:
+            with open(os.path.join(str(tmp_path), name), "wb") as f:
+                f.write(b"Jahr,Anzahl")
+
+        def get_resource_uploader(resource):
+            upload = resource.pop("upload")
+            assert not upload.stream.closed
+            resource["url"] = os.path.basename(upload.filename)
+            resource["url_type"] = "upload"
+            return mock.Mock()
+
+        def upload(name, action="create", **kwargs):
+            return {
+                "action": action,
+                "res_name": name,
+                "new_resource": {
+                    "name": name,
+                    "path": name,
+                    "url": "",
+                    "url_type": "upload",
+                    "zh_hash": "new",
+                },
+                **kwargs,
+            }
+
+        actions = [
+            upload("a.csv"),
+            {
+                "action": "create",
+                "res_name": "api",
+                "new_resource": {"name": "api", "url": "https://example.com"},
+            },
+            upload("b.csv", "update", old_resource={"id": "old-b", "zh_hash": "old"}),
+            upload("missing.csv"),
+            upload(
+                "unchanged.csv",
+                "update",
+                old_resource={"id": "old-u", "zh_hash": "new"},
+            ),
+            {"action": "delete", "res_name": "c.csv", "old_resource": {"id": "c"}},
+        ]
+        with mock.patch.object(plugin, "uploader") as uploader:
+            uploader.get_resource_uploader.side_effect = get_resource_uploader
+            staged = harvester._stage_uploads(
+                list(actions), {"name": "test"}, mock.Mock()
+            )
+
+        assert [a["res_name"] for a in staged] == [
+            "a.csv",
+            "api",
+            "b.csv",
+            "unchanged.csv",
+            "c.csv",
+        ]
+        assert harvester._save_object_error.call_count == 1
+        assert uploader.get_resource_uploader.call_count == 2
+
+        create, api, update, unchanged, _ = staged
+        assert create["staged"] and update["staged"]
+        assert "staged" not in api and "staged" not in unchanged
+        assert create["new_resource"]["id"]
+        assert create["new_resource"]["url"] == "a.csv"
+        assert "upload" not in create["new_resource"]
+        assert "path" not in unchanged["new_resource"]
+        assert "id" not in update["new_resource"]
+
+    def test_retry_open_file(self, tmp_path):
+        path = os.path.join(str(tmp_path), "test.csv")
+        with open(path, "wb") as f:
+            f.write(b"Jahr,Anzahl")
+
+        fs = FaultFS(str(tmp_path), fail_first=3)
+        with fs.installed():
+            with plugin.retry_open_file(path, "rb") as f:
+                assert f.read() == b"Jahr,Anzahl"
+        assert fs.stats["open_error"] == 3
+        assert f.closed
+
+        fs = FaultFS(str(tmp_path), fail_first=10)
+        with fs.installed():
+            with pytest.raises(IOError):
+                with plugin.retry_open_file(path, "rb", tries=5):
+                    pass
+        assert fs.stats["open_error"] == 5
+
+    def test_generate_resources_from_flaky_folder(self):
+        harvester = plugin.StadtzhHarvester()
+        data_path = os.path.join(__location__, "fixtures", "DWH")
+        harvester._set_config(json.dumps({"data_path": data_path}))
+        expected = harvester._generate_resources_from_folder(
+            "velozaehlstellen_stundenwerte"
+        )
+
+        fs = FaultFS(data_path, error_rate=0.3, bandwidth=10 * 1024 * 1024, seed=1)
+        with fs.installed():
+            resources = harvester._generate_resources_from_folder(
+                "velozaehlstellen_stundenwerte"
+            )
+
+        assert fs.stats["open_error"] > 0
+        assert [r["zh_hash"] for r in resources] == [r["zh_hash"] for r in expected]
+
+    def test_generate_resources_file_fields(self):
+        harvester = plugin.StadtzhHarvester()
+        data_path = os.path.join(__location__, "fixtures", "DWH")
+        harvester._set_config(json.dumps({"data_path": data_path}))
+
+        resources = harvester._generate_resources_from_folder("nachnamen_2014")
+        assert len(resources) == 1
+        resource = resources[0]
+        assert resource["path"] == os.path.join("nachnamen_2014", "nachnamen_2014.csv")
+
+        path = os.path.join(data_path, resource["path"])
+        assert resource["size"] == os.path.getsize(path)
+        assert resource["last_modified"].startswith(
+            datetime.datetime.utcfromtimestamp(os.path.getmtime(path)).isoformat()
+        )
+        assert resource["etag"] == '"%s"' % resource["zh_hash"]
+
+    def test_file_changed(self):
+        def action(new_hash, old_hash):
+            return {
+                "action": "update",
+                "new_resource": {"zh_hash": new_hash},
+                "old_resource": {"zh_hash": old_hash},
+            }
+
+        assert not plugin._file_changed(action("abc", "abc"))
+        assert plugin._file_changed(action("def", "abc"))
+        assert plugin._file_changed(action("abc", None))
+        assert plugin._file_changed(action(None, None))
+        assert plugin._file_changed({"action": "create", "new_resource": {}})
+
+    def test_remove_hidden_files(self):
+        harvester = plugin.StadtzhHarvester()
+        files = [
+            "data.csv",
+            ".DS_Store",
+            "data.csv.tmp",
+            "data.CSV.PART",
+            "~$data.xlsx",
+            "meta.xml",
+        ]
+        assert harvester._remove_hidden_files(files) == ["data.csv", "meta.xml"]
+
+    def test_is_settling(self, tmp_path):
+        harvester = plugin.StadtzhHarvester()
+        harvester._set_config(json.dumps({"data_path": str(tmp_path)}))
+        folder = os.path.join(str(tmp_path), "dataset")
+        os.makedirs(folder)
+        path = os.path.join(folder, "data.csv")
+        with open(path, "w") as f:
+            f.write("Jahr,Anzahl")
+        assert not harvester._is_settling("dataset")
+
+        harvester._set_config(
+            json.dumps({"data_path": str(tmp_path), "quiet_period": 10})
+        )
+        assert harvester._is_settling("dataset")
+
+        an_hour_ago = time.time() - 3600
+        os.utime(folder, (an_hour_ago, an_hour_ago))
+        os.utime(path, (an_hour_ago, an_hour_ago))
+        assert not harvester._is_settling("dataset")
+
+        os.utime(path, None)
+        assert harvester._is_settling("dataset")
+
+    def test_stage_upload_file_changed(self, tmp_path):
+        path = os.path.join(str(tmp_path), "data.csv")
+        with open(path, "w") as f:
+            f.write("Jahr,Anzahl")
+        with open(path, "rb") as f:
+            fields = plugin._file_fields(f, "abc")
+
+        with open(path, "a") as f:
+            f.write("\n2024,3")
+        action = {
+            "action": "create",
+            "res_name": "data.csv",
+            "new_resource": dict(fields, name="data.csv", zh_hash="abc"),
+        }
+        with mock.patch.object(plugin, "uploader") as uploader:
+            with pytest.raises(plugin.ResourceFileChanged, match="size"):
+                plugin._stage_upload(action, path)
+        uploader.get_resource_uploader.assert_not_called()
+        assert "staged" not in action
+
+    def test_stage_uploads_file_changed(self, tmp_path):
+        harvester = plugin.StadtzhHarvester()
+        harvester._set_config(
+            json.dumps({"data_path": str(tmp_path), "upload_workers": 1})
+        )
+        actions = []
+        for name in ["a.csv", "b.csv"]:
+            path = os.path.join(str(tmp_path), name)
+            with open(path, "w") as f:
+                f.write("Jahr,Anzahl")
+            with open(path, "rb") as f:
+                fields = plugin._file_fields(f, "abc")
+            actions.append(
+                {
+                    "action": "create",
+                    "res_name": name,
+                    "new_resource": dict(fields, name=name, path=name, zh_hash="abc"),
+                }
+            )
+
+        # all files are checked before the first upload
+        with open(os.path.join(str(tmp_path), "b.csv"), "a") as f:
+            f.write("\n2024,3")
+        with mock.patch.object(plugin, "uploader") as uploader:
+            with pytest.raises(plugin.ResourceFileChanged, match="b.csv"):
+                harvester._stage_uploads(
+                    [dict(a, new_resource=dict(a["new_resource"])) for a in actions],
+                    {"name": "test"},
+                    mock.Mock(),
+                )
+        uploader.get_resource_uploader.assert_not_called()
+
+        # b.csv changes while a.csv is uploaded
+        with open(os.path.join(str(tmp_path), "b.csv"), "rb") as f:
+            actions[1]["new_resource"].update(plugin._file_fields(f, "abc"))
+
+        def get_resource_uploader(resource):
+            with open(os.path.join(str(tmp_path), "b.csv"), "a") as f:
+                f.write("\n2025,4")
+            return mock.Mock()
+
+        with mock.patch.object(plugin, "uploader") as uploader:
+            uploader.get_resource_uploader.side_effect = get_resource_uploader
+            with pytest.raises(plugin.ResourceFileChanged, match="b.csv"):
+                harvester._stage_uploads(actions, {"name": "test"}, mock.Mock())
+        # the staged file of a.csv is removed again
+        assert uploader.get_resource_uploader.call_args_list[-1] == mock.call(
+            {"url": plugin.FILE_NOT_FOUND_URL, "clear_upload": True}
+        )
+        assert uploader.get_resource_uploader.call_count == 2
+
+    def test_stage_upload_dry_run(self, tmp_path):
+        path = os.path.join(str(tmp_path), "data.csv")
+        with open(path, "w") as f:
+            f.write("Jahr,Anzahl")
+        action = {
+            "action": "create",
+            "res_name": "data.csv",
+            "new_resource": {"name": "data.csv", "url_type": "upload"},
+        }
+        with mock.patch.object(plugin, "uploader") as uploader:
+            plugin._stage_upload(action, path, dry_run=True)
+        uploader.get_resource_uploader.assert_called_once()
+        uploader.get_resource_uploader.return_value.upload.assert_not_called()
+        assert action["staged"]
+
+    def test_import_stage_rolls_back_on_error(self):
+        harvester = plugin.StadtzhHarvester()
+        harvest_object = mock.Mock()
+        harvest_object.job.source.config = json.dumps({"data_path": "/tmp"})
+        calls = []
+        harvester._save_object_error = mock.Mock(
+            side_effect=lambda *args: calls.append("error")
+        )
+        with mock.patch.object(
+            harvester, "_import_package", side_effect=ValueError("broken")
+        ), mock.patch.object(plugin, "Session") as session, mock.patch.object(
+            harvester, "_save_checkpoint"
+        ), mock.patch.object(
+            harvester, "_save_import_status"
+        ):
+            session.rollback.side_effect = lambda: calls.append("rollback")
+            session.commit.side_effect = lambda: calls.append("commit")
+            assert harvester.import_stage(harvest_object) is False
+        assert calls == ["rollback", "error", "commit"]
+
+    def test_save_resource_list(self):
+        harvester = plugin.StadtzhHarvester()
+        resources = [
+            mock.Mock(id=id, position=i, state="active")
+            for i, id in enumerate(["a", "b", "c", "d"])
+        ]
+        package = mock.Mock(resources=list(resources))
+        with mock.patch.object(plugin, "model") as model, mock.patch.object(
+            plugin, "Session"
+        ) as session, mock.patch.object(
+            plugin.model_dictize,
+            "resource_dictize",
+            side_effect=lambda r, context: {"id": r.id},
+        ), mock.patch.object(
+            plugin.p, "PluginImplementations", return_value=[]
+        ):
+            model.Package.get.return_value = package
+            harvester._save_resource_list("pkg", ["c", "a"], ["b"], {})
+        assert [r.state for r in resources] == [
+            "active",
+            "deleted",
+            "active",
+            "active",
+        ]
+        positions = dict((r.id, r.position) for r in resources if r.id != "b")
+        assert positions == {"c": 0, "a": 1, "d": 2}
+        session.flush.assert_called_once()
+
+    def test_files_to_upload(self):
+        harvester = plugin.StadtzhHarvester()
+        harvester._set_config(json.dumps({"data_path": "/dropzone"}))
+        manifest = [
+            {"name": "new.csv", "path": "ds/new.csv", "zh_hash": "a", "size": 10},
+            {"name": "changed.csv", "path": "ds/changed.csv", "zh_hash": "b"},
+            {"name": "same.csv", "path": "ds/same.csv", "zh_hash": "c", "size": 5},
+            {"name": "api", "url": "https://example.com", "zh_hash": "d"},
+        ]
+        harvest_object = mock.Mock(
+            guid="ds",
+            content=plugin.encode_content({"resource_manifest": manifest}),
+        )
+        existing = {
+            "resources": [
+                {"name": "changed.csv", "zh_hash": "old"},
+                {"name": "same.csv", "zh_hash": "c"},
+            ]
+        }
+        with mock.patch.object(
+            harvester, "_get_existing_package", return_value=existing
+        ):
+            files = harvester._files_to_upload(harvest_object)
+        assert files == [
+            ("/dropzone/ds/new.csv", 10),
+            ("/dropzone/ds/changed.csv", 0),
+        ]
+
+    def test_generate_resources_from_spool(self, tmp_path):
+        harvester = plugin.StadtzhHarvester()
+        data_path = os.path.join(__location__, "fixtures", "DWH")
+        harvester._set_config(json.dumps({"data_path": data_path}))
+        expected = harvester._generate_resources_from_folder("nachnamen_2014")
+        harvester.spool = plugin.FileSpool(str(tmp_path), 10 * 1024 * 1024)
+
+        fs = FaultFS(data_path)
+        with fs.installed():
+            for _ in range(2):
+                resources = harvester._generate_resources_from_folder("nachnamen_2014")
+                assert resources == expected
+        assert fs.stats["open"] == 1
+
+    def test_queue_datastore_loads(self):
+        harvester = plugin.StadtzhHarvester()
+        actions = [
+            {
+                "action": "create",
+                "staged": True,
+                "file_path": "/dropzone/ds/new.csv",
+                "new_resource": {"id": "new", "format": "CSV"},
+            },
+            {
+                "action": "update",
+                "staged": True,
+                "file_path": "/dropzone/ds/changed.csv",
+                "new_resource": {"format": "csv"},
+                "old_resource": {"id": "changed"},
+            },
+            {
+                "action": "update",
+                "new_resource": {"format": "csv"},
+                "old_resource": {"id": "unchanged"},
+            },
+            {
+                "action": "create",
+                "staged": True,
+                "file_path": "/dropzone/ds/failed.csv",
+                "new_resource": {"id": "failed", "format": "csv"},
+            },
+            {
+                "action": "create",
+                "staged": True,
+                "file_path": "/dropzone/ds/data.json",
+                "new_resource": {"id": "json", "format": "json"},
+            },
+            {
+                "action": "create",
+                "new_resource": {"url": "https://example.com", "format": "CSV"},
+                "old_resource": None,
+            },
+            {"action": "delete", "res_name": "old.csv", "old_resource": {"id": "old"}},
+        ]
+        resource_ids = ["new", "changed", "unchanged", "json"]
+        hints = {"Jahr": "number"}
+
+        harvester._set_config(json.dumps({"data_path": "/dropzone"}))
+        harvester._queue_datastore_loads(actions, resource_ids, hints)
+        assert harvester._datastore_loads == []
+
+        harvester._set_config(
+            json.dumps({"data_path": "/dropzone", "datastore_load": True})
+        )
+        harvester._queue_datastore_loads(actions, resource_ids, hints)
+        assert harvester._datastore_loads == [
+            ("new", "/dropzone/ds/new.csv", hints),
+            ("changed", "/dropzone/ds/changed.csv", hints),
+        ]
@@ -1,13 +1,19 @@
 import json
 import os
 import shutil
+from unittest import mock
 
+import ckan.plugins.toolkit as tk
+import pysolr
 import pytest
+from ckan import model
 from ckan.lib.helpers import url_for
-from ckan.tests import helpers
+from ckan.tests import factories, helpers
 
+from ckanext.harvest.model import HarvestObject, HarvestSource
 from ckanext.harvest.tests import factories as harvest_factories
 from ckanext.harvest.tests.lib import run_harvest
+from ckanext.stadtzhharvest import cli, profiling, retention, status
 from ckanext.stadtzhharvest.harvester import StadtzhHarvester
 
 HARVESTER_URL = "http://stadthzh"
@@ -520,3 +526,284 @@ class TestStadtzhHarvestFunctional(FunctionalHarvestTest):
         result = results["results"][0]
         test_json = next(r for r in result["resources"] if r["name"] == "test.json")
         assert test_json["description"] == "This is a test description (updated)"
+
+    def test_harvest_delete_resources_dwh(self, temp_dir):
+        data_path = os.path.join(__location__, "fixtures", "DWH")
+        temp_data_path = os.path.join(temp_dir, "DWH")
+        shutil.copytree(data_path, temp_data_path)
+
+        test_config = {
+            "data_path": temp_data_path,
+            "metafile_dir": "",
+            "update_datasets": True,
+            "update_date_last_modified": True,
+        }
+        harvest_source = self.create_harvest_source(config=test_config)
+        run_harvest(HARVESTER_URL, StadtzhHarvester())
+
+        # remove two of the three files of a dataset
+        dataset_path = os.path.join(temp_data_path, "velozaehlstellen_stundenwerte")
+        os.remove(os.path.join(dataset_path, "taz_velozaehlung_ausfallprotokoll.csv"))
+        os.remove(os.path.join(dataset_path, "taz_velozaehlung_mappingtabelle.csv"))
+        run_harvest(HARVESTER_URL, StadtzhHarvester())
+
+        dataset = helpers.call_action(
+            "package_show", id="velozaehlstellen_stundenwerte"
+        )
+        assert [r["name"] for r in dataset["resources"]] == [
+            "taz_velozaehlung_stundenwerte_2010.csv"
+        ]
+
+        harvest_source = helpers.call_action(
+            "harvest_source_show", id=harvest_source["id"]
+        )
+        last_job_status = harvest_source["status"]["last_job"]
+        assert len(last_job_status["object_error_summary"]) == 0
+
+    def test_profile_dry_run_does_not_skip_datasets(self, temp_dir):
+        data_path = os.path.join(__location__, "fixtures", "DWH")
+        test_config = {
+            "data_path": data_path,
+            "metafile_dir": "",
+            "update_datasets": True,
+            "resume_jobs": True,
+        }
+        harvest_source = self.create_harvest_source(config=test_config)
+        checkpoint_path = os.path.join(temp_dir, "checkpoints.db")
+        with mock.patch.dict(
+            tk.config, {"ckanext.stadtzhharvest.checkpoint_path": checkpoint_path}
+        ):
+            harvester = StadtzhHarvester()
+            harvester.disable_writes()
+            with profiling.writes_disabled():
+                ids = cli._profile_job(
+                    harvester, HarvestSource.get(harvest_source["id"]), 3
+                )
+            assert len(ids) == 3
+
+            # the sampled datasets are imported by the next real job
+            run_harvest(HARVESTER_URL, StadtzhHarvester())
+
+        fq = "+type:dataset harvest_source_id:{0}".format(harvest_source["id"])
+        results = helpers.call_action("package_search", {}, fq=fq)
+        assert results["count"] == 3
+
+    def test_source_status_of_gathered_folders(self):
+        data_path = os.path.join(__location__, "fixtures", "DWH")
+        test_config = {
+            "data_path": data_path,
+            "metafile_dir": "",
+            "update_datasets": True,
+        }
+        harvest_source = self.create_harvest_source(config=test_config)
+        job = harvest_factories.HarvestJobObj(
+            source=HarvestSource.get(harvest_source["id"])
+        )
+
+        ids = StadtzhHarvester().gather_folders(job, ["nachnamen_2014"])
+        assert len(ids) == 1
+
+        (source_status,) = status.get_source_status(harvest_source["id"])
+        assert source_status["job_id"] == job.id
+        assert source_status["datasets_gathered"] == 1
+
+    def test_compact_harvest_objects(self):
+        data_path = os.path.join(__location__, "fixtures", "DWH")
+        test_config = {
+            "data_path": data_path,
+            "metafile_dir": "",
+            "update_datasets": True,
+        }
+        harvest_source = self.create_harvest_source(config=test_config)
+        for _ in range(3):
+            run_harvest(HARVESTER_URL, StadtzhHarvester())
+
+        objects = model.Session.query(HarvestObject).filter(
+            HarvestObject.harvest_source_id == harvest_source["id"]
+        )
+        assert objects.count() == 9
+
+        # keep the current and the previous object of each dataset
+        object_ids = retention.outdated_harvest_object_ids(harvest_source["id"], 1)
+        assert len(object_ids) == 3
+        assert retention.delete_harvest_objects(object_ids, batch_size=2) == 3
+        assert objects.count() == 6
+        assert objects.filter(HarvestObject.current == True).count() == 3
+
+        retention.ensure_harvest_object_index()
+        assert retention.outdated_harvest_object_ids(harvest_source["id"], 1) == []
+
+    def _test_delete_dataset_second_run(self, extra_config):
+        data_path = os.path.join(__location__, "fixtures", "DWH")
+        test_config = {
+            "data_path": data_path,
+            "delete_missing_datasets": True,
+            "metafile_dir": "",
+            "update_datasets": True,
+            "update_date_last_modified": True,
+        }
+        harvest_source = self.create_harvest_source(config=test_config)
+        run_harvest(HARVESTER_URL, StadtzhHarvester())
+
+        # run a second harvest-job where two datasets are deleted
+        test_config["data_path"] = os.path.join(
+            __location__, "fixtures", "delete_dataset_dropzone"
+        )
+        test_config.update(extra_config)
+        harvest_source = self.update_harvest_source(config=test_config)
+        run_harvest(HARVESTER_URL, StadtzhHarvester())
+
+        fq = "+type:dataset harvest_source_id:{0}".format(harvest_source["id"])
+        results = helpers.call_action("package_search", {}, fq=fq)
+
+        harvest_source = helpers.call_action(
+            "harvest_source_show", id=harvest_source["id"]
+        )
+        return results, harvest_source["status"]["last_job"]
+
+    def test_delete_dataset_in_batches(self):
+        with mock.patch.object(
+            pysolr.Solr, "delete", autospec=True, side_effect=pysolr.Solr.delete
+        ) as solr_delete:
+            results, last_job_status = self._test_delete_dataset_second_run(
+                {"delete_batch_size": 1}
+            )
+        assert results["count"] == 1
+        # one delete query per batch, no delete query per dataset
+        assert solr_delete.call_count == 2
+
+        assert last_job_status["status"] == "Finished"
+        assert len(last_job_status["object_error_summary"]) == 0
+        assert last_job_status["stats"]["updated"] == 1
+        assert last_job_status["stats"]["deleted"] == 2
+
+    def test_delete_dataset_with_folder_patterns(self, temp_dir):
+        dataset_path = os.path.join(
+            __location__, "fixtures", "test_dropzone", "test_dataset"
+        )
+        data_path = os.path.join(temp_dir, "dropzone")
+        folders = ["geo.A", "geo.B", "geo.archive_2019", "Test Data 2020"]
+        for folder in folders:
+            shutil.copytree(dataset_path, os.path.join(data_path, folder))
+        test_config = {
+            "data_path": data_path,
+            "metafile_dir": "",
+            "update_datasets": True,
+        }
+        harvest_source = self.create_harvest_source(config=test_config)
+        run_harvest(HARVESTER_URL, StadtzhHarvester())
+
+        # the folder geo.A is removed, the other folders are out of scope
+        shutil.rmtree(os.path.join(data_path, "geo.A"))
+        test_config.update(
+            {
+                "delete_missing_datasets": True,
+                "include_folders": ["geo.*", "Test Data*"],
+                "exclude_folders": ["geo.archive*", "Test Data*"],
+            }
+        )
+        self.update_harvest_source(config=test_config)
+        run_harvest(HARVESTER_URL, StadtzhHarvester())
+
+        fq = "+type:dataset harvest_source_id:{0}".format(harvest_source["id"])
+        results = helpers.call_action("package_search", {}, fq=fq)
+        assert sorted(result["name"] for result in results["results"]) == [
+            "geo-archive_2019",
+            "geo-b",
+            "test-data-2020",
+        ]
+
+    def test_add_link_resource_with_datastore_load(self, temp_dir):
+        dataset_path = os.path.join(
+            __location__, "fixtures", "test_dropzone", "test_dataset"
+        )
+        data_path = os.path.join(temp_dir, "dropzone")
+        shutil.copytree(dataset_path, os.path.join(data_path, "test_dataset"))
+        test_config = {
+            "data_path": data_path,
+            "metafile_dir": "",
+            "update_datasets": True,
+        }
+        harvest_source = self.create_harvest_source(config=test_config)
+        run_harvest(HARVESTER_URL, StadtzhHarvester())
+
+        # add the links of a web service to the existing dataset
+        link_xml_path = os.path.join(
+            __location__, "fixtures", "GEO2", "jugendtreff", "DEFAULT", "link.xml"
+        )
+        shutil.copy(link_xml_path, os.path.join(data_path, "test_dataset"))
+        test_config["datastore_load"] = True
+        self.update_harvest_source(config=test_config)
+        with mock.patch(
+            "ckanext.stadtzhharvest.harvester.load_csv", autospec=True
+        ) as load_csv:
+            run_harvest(HARVESTER_URL, StadtzhHarvester())
+        # the CSV file did not change, the links are not loaded
+        load_csv.assert_not_called()
+
+        harvest_source = helpers.call_action(
+            "harvest_source_show", id=harvest_source["id"]
+        )
+        last_job_status = harvest_source["status"]["last_job"]
+        assert len(last_job_status["object_error_summary"]) == 0
+        dataset = helpers.call_action("package_show", id="test_dataset")
+        assert sorted(r["name"] for r in dataset["resources"]) == [
+            "Web Feature Service",
+            "Web Map Service",
+            "resource.csv",
+        ]
+
+    def test_delete_dataset_exceeds_max_delete_fraction(self):
+        results, last_job_status = self._test_delete_dataset_second_run(
+            {"max_delete_fraction": 0.5}
+        )
+        # 2 of 3 datasets are missing, nothing is deleted
+        assert results["count"] == 3
+
+        assert last_job_status["stats"]["deleted"] == 0
+        gather_errors = last_job_status["gather_error_summary"]
+        assert len(gather_errors) == 1
+        assert "max_delete_fraction" in gather_errors[0]["message"]
+
+    def test_source_status(self):
+        data_path = os.path.join(__location__, "fixtures", "DWH")
+        test_config = {
+            "data_path": data_path,
+            "metafile_dir": "",
+            "update_datasets": True,
+        }
+        harvest_source = self.create_harvest_source(config=test_config)
+        run_harvest(HARVESTER_URL, StadtzhHarvester())
+
+        sysadmin = factories.Sysadmin()
+        source_status = helpers.call_action(
+            "stadtzhharvest_source_status",
+            context={"user": sysadmin["name"]},
+            id=harvest_source["id"],
+        )
+        assert source_status["datasets_gathered"] == 3
+        assert source_status["datasets_deferred"] == 0
+        assert source_status["datasets_changed"] == 3
+        assert source_status["datasets_unchanged"] == 0
+        assert source_status["datasets_failed"] == 0
+        assert source_status["gather_duration"] > 0
+        assert source_status["import_duration"] > 0
+        assert source_status["oldest_pending_change"] is None
+
+        # the second run does not change any resource
+        run_harvest(HARVESTER_URL, StadtzhHarvester())
+        source_status = helpers.call_action(
+            "stadtzhharvest_source_status",
+            context={"user": sysadmin["name"]},
+            id=harvest_source["id"],
+        )
+        assert source_status["datasets_changed"] == 0
+        assert source_status["datasets_unchanged"] == 3
+
+        user = factories.User()
+        with pytest.raises(tk.NotAuthorized):
+            helpers.call_action(
+                "stadtzhharvest_source_status",
+                context={"user": user["name"], "ignore_auth": False},
+                id=harvest_source["id"],
+            )
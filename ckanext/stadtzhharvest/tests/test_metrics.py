@@ -0,0 +1,94 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from ckanext.stadtzhharvest.metrics import HarvestMetrics
+
+
+class TestHarvestMetrics(object):
+    def test_counters(self):
+        metrics = HarvestMetrics()
+        metrics.start_job("source-1", "job-1")
+        metrics.inc("stadtzhharvest_datasets_gathered_total", source="source-1")
+        metrics.inc("stadtzhharvest_datasets_gathered_total", source="source-1")
+        metrics.inc("stadtzhharvest_bytes_hashed_total", 1024, source='source-"2"')
+
+        text = metrics.render()
+        assert "# TYPE stadtzhharvest_datasets_gathered_total counter" in text
+        assert 'stadtzhharvest_datasets_gathered_total{source="source-1"} 2' in text
+        assert 'stadtzhharvest_bytes_hashed_total{source="source-\\"2\\""} 1024' in text
+        assert 'stadtzhharvest_job_info{job="job-1",source="source-1"} 1' in text
+
+    def test_histogram(self):
+        metrics = HarvestMetrics(buckets=(0.1, 1))
+        for value in (0.05, 0.5, 5):
+            metrics.observe(
+                "stadtzhharvest_action_duration_seconds",
+                value,
+                source="source-1",
+                action="package_update",
+            )
+
+        lines = metrics.render().splitlines()
+        prefix = (
+            'stadtzhharvest_action_duration_seconds_bucket{action="package_update",'
+        )
+        assert prefix + 'source="source-1",le="0.1"} 1' in lines
+        assert prefix + 'source="source-1",le="1.0"} 2' in lines
+        assert prefix + 'source="source-1",le="+Inf"} 3' in lines
+        assert (
+            'stadtzhharvest_action_duration_seconds_count{action="package_update",'
+            'source="source-1"} 3' in lines
+        )
+
+    def test_reset_on_new_job(self):
+        metrics = HarvestMetrics()
+        for source in ("source-1", "source-2"):
+            metrics.start_job(source, "job-1")
+            metrics.inc("stadtzhharvest_datasets_gathered_total", source=source)
+
+        # the same job does not reset the metrics
+        metrics.start_job("source-1", "job-1")
+        assert metrics.get("stadtzhharvest_datasets_gathered_total", source="source-1")
+
+        metrics.start_job("source-1", "job-2")
+        assert not metrics.get(
+            "stadtzhharvest_datasets_gathered_total", source="source-1"
+        )
+        assert metrics.get("stadtzhharvest_datasets_gathered_total", source="source-2")
+
+    def test_unknown_metric(self):
+        with pytest.raises(ValueError):
+            HarvestMetrics().inc("unknown_total", source="source-1")
+
+    def test_write(self, tmp_path):
+        metrics = HarvestMetrics()
+        metrics.start_job("source-1", "job-1")
+        metrics.write(str(tmp_path), "import")
+
+        files = os.listdir(str(tmp_path))
+        assert files == ["stadtzhharvest_import_%d.prom" % os.getpid()]
+        with open(os.path.join(str(tmp_path), files[0])) as f:
+            assert f.read() == metrics.render(pid=os.getpid())
+        assert (
+            'stadtzhharvest_job_info{pid="%d",job="job-1",source="source-1"} 1'
+            % os.getpid()
+            in metrics.render(pid=os.getpid())
+        )
+
+    def test_write_removes_files_of_exited_processes(self, tmp_path):
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        stale_path = tmp_path / ("stadtzhharvest_gather_%d.prom" % process.pid)
+        stale_path.write_text("")
+        other_path = tmp_path / "node_cpu.prom"
+        other_path.write_text("")
+
+        HarvestMetrics().write(str(tmp_path), "import")
+
+        assert sorted(os.listdir(str(tmp_path))) == [
+            "node_cpu.prom",
+            "stadtzhharvest_import_%d.prom" % os.getpid(),
+        ]
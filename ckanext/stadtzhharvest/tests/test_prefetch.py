@@ -0,0 +1,73 @@
+import os
+import threading
+
+from ckanext.stadtzhharvest.prefetch import Prefetcher, read_file
+
+
+class TestPrefetcher(object):
+    def test_read_file(self, tmp_path):
+        path = os.path.join(str(tmp_path), "data.csv")
+        with open(path, "wb") as f:
+            f.write(b"x" * 3000000)
+        assert read_file(path) == 3000000
+
+    def test_schedule_within_budget(self):
+        warmed = []
+        prefetcher = Prefetcher(warm=warmed.append, budget=100)
+        assert prefetcher.schedule("a", [("a1", 40), ("a2", 20)])
+        assert prefetcher.schedule("b", [("b1", 40)])
+        assert not prefetcher.schedule("c", [("c1", 1)])
+        assert prefetcher.pending_bytes == 100
+
+        prefetcher.release("a")
+        assert prefetcher.pending_bytes == 40
+        assert prefetcher.schedule("c", [("c1", 1)])
+        assert not prefetcher.is_scheduled("a")
+        assert prefetcher.is_scheduled("c")
+
+        prefetcher._pool.shutdown(wait=True)
+        assert "b1" in warmed and "c1" in warmed
+
+    def test_retain(self):
+        prefetcher = Prefetcher(warm=lambda path: 0, budget=100)
+        for key in ["a", "b", "c"]:
+            prefetcher.schedule(key, [(key + "1", 30)])
+        # b was imported by another process
+        prefetcher.retain({"a", "c", "d"})
+        assert not prefetcher.is_scheduled("b")
+        assert prefetcher.is_scheduled("a") and prefetcher.is_scheduled("c")
+        assert prefetcher.pending_bytes == 60
+
+    def test_schedule_large_dataset_if_idle(self):
+        prefetcher = Prefetcher(warm=lambda path: 0, budget=10)
+        assert prefetcher.schedule("big", [("big1", 1000)])
+        assert not prefetcher.schedule("small", [("small1", 1)])
+
+    def test_wait_for_running_prefetch(self):
+        started = threading.Event()
+        finish = threading.Event()
+        done = []
+
+        def warm(path):
+            started.set()
+            finish.wait(5)
+            done.append(path)
+
+        prefetcher = Prefetcher(warm=warm, workers=1)
+        prefetcher.schedule("a", [("a1", 1), ("a2", 1)])
+        started.wait(5)
+        # a2 did not start yet and is cancelled
+        prefetcher.wait("a2")
+        finish.set()
+        prefetcher.wait("a1")
+        assert done == ["a1"]
+
+    def test_failed_prefetch_is_ignored(self):
+        def warm(path):
+            raise IOError("Input/output error")
+
+        prefetcher = Prefetcher(warm=warm)
+        prefetcher.schedule("a", [("a1", 1)])
+        prefetcher.wait("a1")
+        prefetcher.reset()
+        assert prefetcher.pending_bytes == 0
@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+from ckanext.stadtzhharvest.profiling import StackSampler, profiled
+
+
+def busy_loop():
+    total = 0
+    for i in range(3000000):
+        total += i * i
+    return total
+
+
+@pytest.mark.skipif(not StackSampler.available(), reason="SIGPROF not available")
+class TestProfiling(object):
+    def test_stack_sampler(self, tmp_path):
+        sampler = StackSampler(interval=0.001)
+        sampler.start()
+        try:
+            busy_loop()
+        finally:
+            sampler.stop()
+
+        assert sampler.stacks
+        assert any("busy_loop (test_profiling.py" in s for s in sampler.stacks)
+
+        path = os.path.join(str(tmp_path), "profile.collapsed")
+        sampler.write(path)
+        with open(path) as f:
+            for line in f:
+                stack, count = line.rsplit(" ", 1)
+                assert int(count) > 0
+
+    def test_profiled(self, tmp_path):
+        prefix = os.path.join(str(tmp_path), "profile")
+        with profiled(prefix, interval=0.001) as files:
+            busy_loop()
+
+        assert files == [prefix + ".pstats", prefix + ".txt", prefix + ".collapsed"]
+        for path in files:
+            assert os.path.getsize(path) > 0
+        with open(prefix + ".txt") as f:
+            assert "busy_loop" in f.read()
@@ -0,0 +1,133 @@
+from hypothesis import given
+from hypothesis import strategies as st
+
+import ckanext.stadtzhharvest.harvester as plugin
+
+
+def _reference_resources_actions(existing_package, new_resources):
+    """previous implementation of _resources_actions (nested loops)"""
+    resources_changed = False
+    actions = []
+
+    if not existing_package:
+        resources_changed = True
+        for r in new_resources:
+            actions.append(
+                {"action": "create", "new_resource": r, "res_name": r["name"]}
+            )
+    else:
+        old_resources = existing_package["resources"]
+        for r in new_resources:
+            action = {
+                "action": "create",
+                "new_resource": r,
+                "old_resource": None,
+                "res_name": r["name"],
+            }
+            for old in old_resources:
+                if old["name"] == r["name"]:
+                    action["action"] = "update"
+                    action["old_resource"] = old
+                    if (
+                        r.get("zh_hash")
+                        and old.get("zh_hash")
+                        and r["zh_hash"] != old["zh_hash"]
+                    ):
+                        resources_changed = True
+                    break
+            actions.append(action)
+
+        for old in old_resources:
+            if not [action for action in actions if action["res_name"] == old["name"]]:
+                actions.append(
+                    {"action": "delete", "old_resource": old, "res_name": old["name"]}
+                )
+    return (actions, resources_changed)
+
+
+def _reference_keep_order_of_existing_resources(package_dict, resource_ids):
+    """previous implementation of _keep_order_of_existing_resources"""
+    existing_resource_ids = []
+    if package_dict.get("resources"):
+        existing_resource_ids = [
+            resource["id"]
+            for resource in package_dict["resources"]
+            if resource["id"] in resource_ids
+        ]
+    new_resource_ids = [id for id in resource_ids if id not in existing_resource_ids]
+    return existing_resource_ids + new_resource_ids
+
+
+# a small set of names and hashes, so that collisions are likely
+names = st.sampled_from(["data.csv", "data.json", "Data.csv", "Web Map Service", ""])
+hashes = st.sampled_from([None, "", "hash1", "hash2"])
+new_resources = st.lists(st.fixed_dictionaries({"name": names, "zh_hash": hashes}))
+
+
+@st.composite
+def existing_packages(draw):
+    if draw(st.booleans()):
+        return None
+    resources = draw(
+        st.lists(st.fixed_dictionaries({"name": names, "zh_hash": hashes}))
+    )
+    for i, resource in enumerate(resources):
+        resource["id"] = "id-%d" % i
+    return {"name": "test_dataset", "resources": resources}
+
+
+class TestResourcesActions(object):
+    @given(existing_packages(), new_resources)
+    def test_same_result_as_reference(self, existing_package, new_resources):
+        harvester = plugin.StadtzhHarvester()
+        assert harvester._resources_actions(
+            existing_package, new_resources
+        ) == _reference_resources_actions(existing_package, new_resources)
+
+    @given(existing_packages(), new_resources)
+    def test_same_order_as_reference(self, existing_package, new_resources):
+        harvester = plugin.StadtzhHarvester()
+        actions, _ = harvester._resources_actions(existing_package, new_resources)
+        actions.sort(key=plugin._sort_new_resources_by_name)
+        assert [a["res_name"] for a in actions] == [
+            a["res_name"]
+            for a in sorted(
+                _reference_resources_actions(existing_package, new_resources)[0],
+                key=plugin._sort_new_resources_by_name,
+            )
+        ]
+
+    def test_update_changed_resource(self):
+        harvester = plugin.StadtzhHarvester()
+        existing_package = {
+            "resources": [
+                {"id": "1", "name": "data.csv", "zh_hash": "old"},
+                {"id": "2", "name": "old.csv", "zh_hash": "old"},
+            ]
+        }
+        actions, resources_changed = harvester._resources_actions(
+            existing_package, [{"name": "data.csv", "zh_hash": "new"}]
+        )
+        assert resources_changed
+        assert [(a["action"], a["res_name"]) for a in actions] == [
+            ("update", "data.csv"),
+            ("delete", "old.csv"),
+        ]
+
+
+class TestKeepOrderOfExistingResources(object):
+    @given(
+        st.lists(st.sampled_from(["a", "b", "c", "d"]), unique=True),
+        st.lists(st.sampled_from(["a", "b", "c", "d", "e", "f"])),
+    )
+    def test_same_result_as_reference(self, existing_ids, resource_ids):
+        package_dict = {"resources": [{"id": id} for id in existing_ids]}
+        assert plugin._keep_order_of_existing_resources(
+            package_dict, resource_ids
+        ) == _reference_keep_order_of_existing_resources(package_dict, resource_ids)
+
+    def test_new_resources_at_the_end(self):
+        package_dict = {"resources": [{"id": "b"}, {"id": "a"}]}
+        assert plugin._keep_order_of_existing_resources(
+            package_dict, ["new", "a", "b"]
+        ) == ["b", "a", "new"]
@@ -0,0 +1,79 @@
+import os
+
+from ckanext.stadtzhharvest.spool import FileSpool
+from ckanext.stadtzhharvest.tests.faultfs import FaultFS
+
+
+def _write(folder, name, content):
+    path = os.path.join(folder, name)
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+
+class TestFileSpool(object):
+    def _setup(self, tmp_path, max_size=1024):
+        dropzone = os.path.join(str(tmp_path), "dropzone")
+        os.makedirs(dropzone)
+        spool = FileSpool(os.path.join(str(tmp_path), "spool"), max_size)
+        return dropzone, spool
+
+    def test_read_source_once(self, tmp_path):
+        dropzone, spool = self._setup(tmp_path)
+        path = _write(dropzone, "data.csv", b"Jahr,Anzahl")
+
+        fs = FaultFS(dropzone)
+        with fs.installed():
+            assert spool.fetch(path) == 11
+            for _ in range(3):
+                with spool.open(path) as f:
+                    assert f.read() == b"Jahr,Anzahl"
+        assert fs.stats["open"] == 1
+        assert spool.stats["misses"] == 1
+        assert spool.stats["hits"] == 3
+
+    def test_copy_keeps_size_and_mtime(self, tmp_path):
+        dropzone, spool = self._setup(tmp_path)
+        path = _write(dropzone, "data.csv", b"Jahr,Anzahl")
+        os.utime(path, ns=(0, 1500000000123456789))
+
+        with spool.open(path) as f:
+            stat = os.fstat(f.fileno())
+        assert stat.st_size == 11
+        assert stat.st_mtime == os.stat(path).st_mtime
+
+    def test_changed_file_is_copied_again(self, tmp_path):
+        dropzone, spool = self._setup(tmp_path)
+        path = _write(dropzone, "data.csv", b"Jahr,Anzahl")
+        spool.fetch(path)
+
+        _write(dropzone, "data.csv", b"Jahr,Anzahl\n2024,3")
+        with spool.open(path) as f:
+            assert f.read() == b"Jahr,Anzahl\n2024,3"
+        assert spool.stats["misses"] == 2
+        assert len(os.listdir(spool.directory)) == 1
+
+    def test_lru_eviction(self, tmp_path):
+        dropzone, spool = self._setup(tmp_path, max_size=25)
+        a = _write(dropzone, "a.csv", b"a" * 10)
+        b = _write(dropzone, "b.csv", b"b" * 10)
+        c = _write(dropzone, "c.csv", b"c" * 10)
+        spool.fetch(a)
+        spool.fetch(b)
+        # use "a", so that "b" is the least recently used copy
+        assert spool.fetch(a) == 0
+        spool.fetch(c)
+
+        assert spool.stats["evictions"] == 1
+        assert spool.fetch(a) == 0
+        assert spool.fetch(c) == 0
+        assert spool.fetch(b) == 10
+
+    def test_large_file_is_read_from_source(self, tmp_path):
+        dropzone, spool = self._setup(tmp_path, max_size=5)
+        path = _write(dropzone, "data.csv", b"Jahr,Anzahl")
+
+        with spool.open(path) as f:
+            assert f.read() == b"Jahr,Anzahl"
+        assert spool.fetch(path) == 0
+        assert os.listdir(spool.directory) == []
@@ -0,0 +1,49 @@
+import datetime
+from unittest import mock
+
+import pytest
+from sqlalchemy.exc import ProgrammingError
+
+from ckanext.stadtzhharvest import status
+
+
+class TestSourceStatus(object):
+    def test_status_dict(self):
+        row = mock.Mock(
+            _mapping={
+                "source_id": "source",
+                "gather_started": datetime.datetime(2024, 5, 1, 2, 0, 0),
+                "cache_hits": 3,
+                "cache_misses": 1,
+                "oldest_pending_change": None,
+            }
+        )
+        assert status._status_dict(row) == {
+            "source_id": "source",
+            "gather_started": "2024-05-01T02:00:00",
+            "cache_hits": 3,
+            "cache_misses": 1,
+            "oldest_pending_change": None,
+            "cache_hit_rate": 0.75,
+        }
+
+    def test_status_dict_without_cache(self):
+        row = mock.Mock(_mapping={"cache_hits": 0, "cache_misses": 0})
+        assert status._status_dict(row)["cache_hit_rate"] is None
+
+    def test_record_gather(self):
+        with mock.patch.object(status.model, "Session") as session:
+            status.record_gather("source", "job", {"datasets_gathered": 1})
+        # the previous status is replaced, no table is created at runtime
+        assert session.execute.call_count == 2
+        session.commit.assert_called_once()
+
+    def test_record_gather_rolls_back_on_error(self):
+        with mock.patch.object(status.model, "Session") as session:
+            session.execute.side_effect = ProgrammingError(
+                "DELETE", {}, Exception("relation does not exist")
+            )
+            with pytest.raises(ProgrammingError):
+                status.record_gather("source", "job", {"datasets_gathered": 1})
+        session.rollback.assert_called_once()
+        session.commit.assert_not_called()
@@ -0,0 +1,60 @@
+from ckanext.stadtzhharvest.throttle import AdaptiveThrottle
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestAdaptiveThrottle(object):
+    def _call(self, throttle, clock, latency):
+        with throttle.measure():
+            clock.now += latency
+
+    def test_no_pause_below_threshold(self):
+        clock = FakeClock()
+        throttle = AdaptiveThrottle(1.0, sleep=clock.sleep, clock=clock)
+        for _ in range(10):
+            self._call(throttle, clock, 0.5)
+        assert throttle.pause == 0
+        assert clock.sleeps == []
+
+    def test_pause_grows_up_to_max_pause(self):
+        clock = FakeClock()
+        throttle = AdaptiveThrottle(1.0, max_pause=5, sleep=clock.sleep, clock=clock)
+        for _ in range(6):
+            self._call(throttle, clock, 3.0)
+        assert clock.sleeps == [1.0, 2.0, 4.0, 5, 5]
+        assert throttle.pause == 5
+
+    def test_resume_when_latency_recovers(self):
+        clock = FakeClock()
+        throttle = AdaptiveThrottle(1.0, max_pause=4, sleep=clock.sleep, clock=clock)
+        for _ in range(4):
+            self._call(throttle, clock, 3.0)
+        assert throttle.pause == 4
+
+        for _ in range(20):
+            self._call(throttle, clock, 0.1)
+        assert throttle.average < 1.0
+        assert throttle.pause == 0
+
+    def test_latency_of_failed_calls_is_recorded(self):
+        clock = FakeClock()
+        throttle = AdaptiveThrottle(1.0, sleep=clock.sleep, clock=clock)
+        try:
+            with throttle.measure():
+                clock.now += 2.0
+                raise ValueError()
+        except ValueError:
+            pass
+        assert throttle.average == 2.0
+        assert throttle.pause == 1.0
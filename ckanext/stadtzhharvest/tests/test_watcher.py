@@ -0,0 +1,52 @@
+import os
+
+from ckanext.stadtzhharvest.watcher import DropzoneWatcher
+
+
+def _write(path, content):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as f:
+        f.write(content)
+
+
+class TestDropzoneWatcher(object):
+    def test_poll_detects_changed_folders(self, tmp_path):
+        data_path = str(tmp_path)
+        _write(os.path.join(data_path, "dataset_a", "meta.xml"), "a")
+        _write(os.path.join(data_path, "dataset_b", "meta.xml"), "b")
+
+        watcher = DropzoneWatcher(data_path, debounce=10, use_inotify=False)
+        watcher.poll(now=0)
+        assert watcher.ready_folders(now=100) == []
+
+        _write(os.path.join(data_path, "dataset_a", "data.csv"), "new file")
+        _write(os.path.join(data_path, "dataset_c", "meta.xml"), "c")
+        _write(os.path.join(data_path, ".hidden", "meta.xml"), "hidden")
+        watcher.poll(now=0)
+
+        assert watcher.ready_folders(now=100) == ["dataset_a", "dataset_c"]
+        # folders are only reported once
+        assert watcher.ready_folders(now=200) == []
+
+    def test_poll_detects_removed_folders(self, tmp_path):
+        data_path = str(tmp_path)
+        _write(os.path.join(data_path, "dataset_a", "meta.xml"), "a")
+
+        watcher = DropzoneWatcher(data_path, debounce=10, use_inotify=False)
+        watcher.poll(now=0)
+        os.remove(os.path.join(data_path, "dataset_a", "meta.xml"))
+        os.rmdir(os.path.join(data_path, "dataset_a"))
+        watcher.poll(now=0)
+
+        assert watcher.ready_folders(now=100) == ["dataset_a"]
+
+    def test_debounce(self, tmp_path):
+        watcher = DropzoneWatcher(str(tmp_path), debounce=10, use_inotify=False)
+        watcher.mark_changed("dataset_a", now=0)
+        assert watcher.ready_folders(now=5) == []
+
+        # the folder changed again, the debounce period starts over
+        watcher.mark_changed("dataset_a", now=8)
+        assert watcher.ready_folders(now=12) == []
+        assert watcher.ready_folders(now=18) == ["dataset_a"]
@@ -0,0 +1,68 @@
+# coding: utf-8
+
+import logging
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+
+class AdaptiveThrottle(object):
+    """
+    Slows down an import when CKAN (or its database and search index)
+    responds slowly.
+
+    The latency of the measured calls is tracked as exponentially weighted
+    moving average. As long as the average exceeds `threshold` seconds, the
+    pause before each call is doubled (up to `max_pause` seconds); once the
+    average is back below the threshold, the pause is halved again until
+    the import runs at full speed.
+    """
+
+    def __init__(
+        self, threshold, max_pause=60, alpha=0.3, sleep=time.sleep, clock=None
+    ):
+        self.threshold = threshold
+        self.max_pause = max_pause
+        self.alpha = alpha
+        self.average = None
+        self.pause = 0
+        self._sleep = sleep
+        self._clock = clock or time.monotonic
+
+    def record(self, latency):
+        """
+        Record the latency of a call and adapt the pause
+        """
+        if self.average is None:
+            self.average = latency
+        else:
+            self.average = self.alpha * latency + (1 - self.alpha) * self.average
+
+        if self.average > self.threshold:
+            self.pause = min(self.max_pause, max(self.pause * 2, self.threshold))
+        elif self.pause:
+            self.pause = self.pause / 2 if self.pause / 2 >= 0.01 else 0
+
+    def wait(self):
+        """
+        Pause before the next call if CKAN is slow
+        """
+        if self.pause:
+            log.info(
+                "Average latency of %.2fs exceeds %.2fs, pausing for %.2fs"
+                % (self.average, self.threshold, self.pause)
+            )
+            self._sleep(self.pause)
+
+    @contextmanager
+    def measure(self):
+        """
+        Wait if needed and record the latency of the wrapped call
+        """
+        self.wait()
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self.record(self._clock() - start)
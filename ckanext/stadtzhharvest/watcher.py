@@ -0,0 +1,146 @@
+# coding: utf-8
+
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+
+class DropzoneWatcher(object):
+    """
+    Detects changed dataset folders in a dropzone.
+
+    Changes are detected with inotify (if the optional `watchdog` package
+    is installed and `use_inotify` is set) or by comparing snapshots of the
+    dropzone, which is needed for network drives like WebDAV that do not
+    support inotify. A changed folder is only reported once it did not
+    change anymore for `debounce` seconds, so that producers can finish
+    writing their files.
+    """
+
+    def __init__(self, data_path, debounce=60, poll_interval=30, use_inotify=True):
+        self.data_path = data_path
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify and Observer is not None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def folder_signature(self, folder):
+        """
+        Return a signature of all files in the given dataset folder, it
+        changes whenever a file is added, removed or modified
+        """
+        signature = []
+        folder_path = os.path.join(self.data_path, folder)
+        for root, dirs, files in os.walk(folder_path):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                signature.append(
+                    (os.path.relpath(path, folder_path), stat.st_size, stat.st_mtime)
+                )
+        return tuple(sorted(signature))
+
+    def snapshot(self):
+        """
+        Return a dict with the signatures of all dataset folders
+        """
+        return {
+            folder: self.folder_signature(folder)
+            for folder in os.listdir(self.data_path)
+            if not folder.startswith(".")
+        }
+
+    def mark_changed(self, folder, now=None):
+        with self._lock:
+            self._pending[folder] = now if now is not None else time.time()
+
+    def poll(self, now=None):
+        """
+        Compare the dropzone with the previous snapshot and mark all
+        changed, added or removed folders as changed
+        """
+        snapshot = self.snapshot()
+        if self._snapshot is not None:
+            for folder in set(snapshot) | set(self._snapshot):
+                if snapshot.get(folder) != self._snapshot.get(folder):
+                    self.mark_changed(folder, now)
+        self._snapshot = snapshot
+
+    def ready_folders(self, now=None):
+        """
+        Return (and forget) the changed folders that did not change during
+        the debounce period
+        """
+        now = now if now is not None else time.time()
+        with self._lock:
+            ready = [
+                folder
+                for folder, changed in self._pending.items()
+                if now - changed >= self.debounce
+            ]
+            for folder in ready:
+                del self._pending[folder]
+        return sorted(ready)
+
+    def run(self, callback, stop=None):
+        """
+        Watch the dropzone and call `callback` with a list of changed
+        folders until `stop` (a threading.Event) is set
+        """
+        stop = stop or threading.Event()
+        observer = None
+        if self.use_inotify:
+            observer = Observer()
+            observer.schedule(_ChangeHandler(self), self.data_path, recursive=True)
+            observer.start()
+            log.info("Watching %s with inotify" % self.data_path)
+        else:
+            self.poll()
+            log.info("Watching %s by polling" % self.data_path)
+        try:
+            while not stop.is_set():
+                stop.wait(self.poll_interval)
+                if observer is None:
+                    self.poll()
+                folders = self.ready_folders()
+                if not folders:
+                    continue
+                try:
+                    callback(folders)
+                except Exception as e:
+                    log.exception(
+                        "Could not harvest changed folders %s: %r" % (folders, e)
+                    )
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
+
+
+class _ChangeHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        for path in (event.src_path, getattr(event, "dest_path", None)):
+            if not path:
+                continue
+            relpath = os.path.relpath(path, self.watcher.data_path)
+            folder = relpath.split(os.sep)[0]
+            if folder not in (".", "..") and not folder.startswith("."):
+                self.watcher.mark_changed(folder)